@@ -0,0 +1,70 @@
+from urllib.parse import quote
+
+CLAIM_BUSTER_URL = 'https://idir.uta.edu/claimbuster/api/v2/query/fact_matcher/'
+MEANINGCLOUD_STRUCTURE_URL = 'http://api.meaningcloud.com/documentstructure-1.0'
+MEANINGCLOUD_SUMMARY_URL = 'http://api.meaningcloud.com/summarization-1.0'
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+
+# Per-call timeouts in seconds; the summarizer has to fetch and process the whole page so it gets the longest budget
+CLAIM_BUSTER_TIMEOUT = 10
+MEANINGCLOUD_TIMEOUT = 15
+PERSPECTIVE_TIMEOUT = 5
+
+PERSPECTIVE_ATTRIBUTES = ['SEVERE_TOXICITY', 'PROFANITY', 'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'FLIRTATION']
+
+
+class ExternalApis:
+    '''
+    Awaitable wrappers around ClaimBuster, MeaningCloud and Perspective. All requests go through the shared HttpClient
+    so they never block the discord event loop.
+    '''
+
+    def __init__(self, http, claim_buster_key, meaningcloud_key, perspective_key):
+        self.http = http
+        self.claim_buster_key = claim_buster_key
+        self.meaningcloud_key = meaningcloud_key
+        self.perspective_key = perspective_key
+        # Endpoints are kept per instance so they can be pointed at a local stub server
+        self.claim_buster_url = CLAIM_BUSTER_URL
+        self.structure_url = MEANINGCLOUD_STRUCTURE_URL
+        self.summary_url = MEANINGCLOUD_SUMMARY_URL
+        self.perspective_url = PERSPECTIVE_URL
+        # Everything in a Perspective request except the comment text is the same every time, so build it once
+        self.perspective_request = {
+            'languages': ['en'],
+            'requestedAttributes': {attr: {} for attr in PERSPECTIVE_ATTRIBUTES},
+            'doNotStore': True
+        }
+
+    async def fact_check(self, input_claim):
+        # The claim is formatted as part of the endpoint, the api-key is sent as an extra header
+        api_endpoint = self.claim_buster_url + quote(input_claim, safe='')
+        request_headers = {"x-api-key": self.claim_buster_key}
+        response = await self.http.get_json(api_endpoint, headers=request_headers, timeout=CLAIM_BUSTER_TIMEOUT)
+        if not response.get("justification"):
+            return None
+        return response["justification"][0]["truth_rating"]
+
+    async def extract_title(self, input_url):
+        fields = {'key': self.meaningcloud_key, 'url': input_url}
+        response = await self.http.post_form(self.structure_url, fields, timeout=MEANINGCLOUD_TIMEOUT)
+        return response['title']
+
+    async def summarize(self, input_url):
+        fields = {'key': self.meaningcloud_key, 'url': input_url, 'sentences': '3'}
+        response = await self.http.post_form(self.summary_url, fields, timeout=MEANINGCLOUD_TIMEOUT)
+        # remove [...]'s from summary
+        return response['summary'].replace("[...]", "")
+
+    async def eval_text(self, text):
+        '''
+        Given the text of a message, forwards it to Perspective and returns a dictionary of scores.
+        '''
+        url = self.perspective_url + '?key=' + self.perspective_key
+        data_dict = dict(self.perspective_request, comment={'text': text})
+        response_dict = await self.http.post_json(url, data_dict, timeout=PERSPECTIVE_TIMEOUT)
+
+        scores = {}
+        for attr in response_dict["attributeScores"]:
+            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+        return scores
@@ -0,0 +1,471 @@
+'''
+Append-only audit log of every moderation case, moderator decision and user report, so an author's history or the
+cases of last week can be looked up locally instead of scrolling back through the mod channel over REST.
+
+Records are JSON lines in a directory of segments named after the sequence number of their first record. The newest
+segment takes appends and is indexed in memory. Once it holds SEGMENT_RECORDS records it is sealed: a binary index is
+written next to it, with its records' offsets sorted by author ID, by case ID and by time, and from then on both files
+are memory-mapped and searched in place. Nothing is ever rewritten, so a crash can at most leave a torn last line,
+which is cut off the next time the store is opened.
+
+    python audit.py author 123456789012345678      # every record about an author
+    python audit.py case 42
+    python audit.py export --since 2026-05-01 --until 2026-06-01 > may.jsonl
+'''
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger('discord')
+
+# Records per segment; only the newest segment is held in memory
+SEGMENT_RECORDS = 20000
+# Appended records are written out this often, or sooner once this many are waiting
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 500
+# Fields holding the ID of an author a record is about; each of them is indexed
+AUTHOR_FIELDS = ('author_id', 'copy_author_id', 'banned_author_id')
+# Exports are copied out of sealed segments in chunks of this many bytes
+EXPORT_CHUNK = 2 ** 20
+
+MAGIC = b'MODAUD01'
+HEADER = struct.Struct('<8sQQQ')  # magic, then the number of author, case and time entries
+KEY_ENTRY = struct.Struct('<QQ')  # author or case ID, offset of the record in the segment
+TIME_ENTRY = struct.Struct('<dQ')  # time of the record, its offset
+
+
+def index_keys(record):
+    '''
+    The author IDs and the case ID (or None) a record is filed under.
+    '''
+    authors = {record[field] for field in AUTHOR_FIELDS if isinstance(record.get(field), int)}
+    case_id = record.get('case_id')
+    return authors, case_id if isinstance(case_id, int) else None
+
+
+class Entries:
+    '''
+    A sorted run of fixed-size (key, offset) entries in an index file, binary searched without being read in.
+    '''
+
+    def __init__(self, buffer, start, count, entry):
+        self.buffer = buffer
+        self.start = start
+        self.count = count
+        self.entry = entry
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.entry.unpack_from(self.buffer, self.start + i * self.entry.size)[0]
+
+    def offset(self, i):
+        return self.entry.unpack_from(self.buffer, self.start + i * self.entry.size)[1]
+
+    def find(self, key):
+        i = bisect.bisect_left(self, key)
+        offsets = []
+        while i < self.count and self[i] == key:
+            offsets.append(self.offset(i))
+            i += 1
+        return offsets
+
+    def span(self, low, high):
+        '''
+        Positions of the entries with low <= key < high; None means unbounded.
+        '''
+        i = 0 if low is None else bisect.bisect_left(self, low)
+        j = self.count if high is None else bisect.bisect_left(self, high)
+        return i, max(i, j)
+
+
+class MemorySegment:
+    '''
+    The segment taking appends, indexed in dictionaries. A sealed segment stays one of these until its index file has
+    been written.
+    '''
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        self.lines = []  # encoded records, in order
+        self.offsets = []
+        self.times = []
+        self.size = 0
+        self.by_author = {}  # author ID -> positions in lines
+        self.by_case = {}  # case ID -> positions in lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    @classmethod
+    def load(cls, path, first_seq, repair=True):
+        '''
+        Reads a segment that has no index file yet. A torn last line is cut off the file unless repair is False.
+        '''
+        segment = cls(path, first_seq)
+        with open(path, 'rb') as f:
+            data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data) and repair:
+            logger.warning('Cutting a torn record off the end of %s', path)
+            with open(path, 'r+b') as f:
+                f.truncate(complete)
+        for line in data[:complete].splitlines(keepends=True):
+            segment.add(json.loads(line), line)
+        return segment
+
+    def add(self, record, line):
+        position = len(self.lines)
+        self.lines.append(line)
+        self.offsets.append(self.size)
+        self.times.append(record['time'])
+        self.size += len(line)
+        authors, case_id = index_keys(record)
+        for author_id in authors:
+            self.by_author.setdefault(author_id, []).append(position)
+        if case_id is not None:
+            self.by_case.setdefault(case_id, []).append(position)
+
+    def author(self, author_id):
+        return [json.loads(self.lines[i]) for i in self.by_author.get(author_id, ())]
+
+    def case(self, case_id):
+        return [json.loads(self.lines[i]) for i in self.by_case.get(case_id, ())]
+
+    def _span(self, start, end):
+        i = 0 if start is None else bisect.bisect_left(self.times, start)
+        j = len(self.times) if end is None else bisect.bisect_left(self.times, end)
+        return i, max(i, j)
+
+    def between(self, start=None, end=None):
+        i, j = self._span(start, end)
+        return [json.loads(line) for line in self.lines[i:j]]
+
+    def chunks(self, start=None, end=None):
+        i, j = self._span(start, end)
+        if i < j:
+            yield b''.join(self.lines[i:j])
+
+    def last(self):
+        return (self.first_seq + len(self) - 1, self.times[-1]) if self.lines else None
+
+    def index_bytes(self):
+        authors = sorted((author_id, self.offsets[i]) for author_id, positions in self.by_author.items()
+                         for i in positions)
+        cases = sorted((case_id, self.offsets[i]) for case_id, positions in self.by_case.items() for i in positions)
+        parts = [HEADER.pack(MAGIC, len(authors), len(cases), len(self.times))]
+        parts.extend(KEY_ENTRY.pack(*entry) for entry in authors)
+        parts.extend(KEY_ENTRY.pack(*entry) for entry in cases)
+        parts.extend(TIME_ENTRY.pack(t, offset) for t, offset in zip(self.times, self.offsets))
+        return b''.join(parts)
+
+    def close(self):
+        pass
+
+
+class MappedSegment:
+    '''
+    A sealed segment and its index, both memory-mapped; a lookup reads only the index entries it lands on and the
+    records they point to.
+    '''
+
+    def __init__(self, path, index_path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(index_path, 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, authors, cases, times = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{index_path} is not an audit index')
+        start = HEADER.size
+        self.authors = Entries(self.index, start, authors, KEY_ENTRY)
+        start += authors * KEY_ENTRY.size
+        self.cases = Entries(self.index, start, cases, KEY_ENTRY)
+        start += cases * KEY_ENTRY.size
+        self.times = Entries(self.index, start, times, TIME_ENTRY)
+
+    def __len__(self):
+        return len(self.times)
+
+    def _record(self, offset):
+        return json.loads(self.data[offset:self.data.find(b'\n', offset) + 1])
+
+    def author(self, author_id):
+        return [self._record(offset) for offset in sorted(self.authors.find(author_id))]
+
+    def case(self, case_id):
+        return [self._record(offset) for offset in sorted(self.cases.find(case_id))]
+
+    def between(self, start=None, end=None):
+        i, j = self.times.span(start, end)
+        return [self._record(self.times.offset(k)) for k in range(i, j)]
+
+    def chunks(self, start=None, end=None):
+        # Records are in time order, so a time range is one contiguous run of the file
+        i, j = self.times.span(start, end)
+        if i == j:
+            return
+        begin = self.times.offset(i)
+        stop = self.times.offset(j) if j < len(self.times) else len(self.data)
+        for chunk_start in range(begin, stop, EXPORT_CHUNK):
+            yield self.data[chunk_start:min(chunk_start + EXPORT_CHUNK, stop)]
+
+    def last(self):
+        return self.first_seq + len(self) - 1, self.times[len(self) - 1]
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class AuditStore:
+    '''
+    The audit log: append() files a record on the event loop and a background thread writes it out, in batches, the
+    way the points ledger does. Lookups see records as soon as they are appended.
+    '''
+
+    def __init__(self, path, segment_records=SEGMENT_RECORDS, readonly=False):
+        self.path = path
+        self.segment_records = segment_records
+        self.readonly = readonly
+        self.segments = []  # sealed segments, oldest first
+        self.pending = []  # lines appended since the last flush
+        self.sealing = set()  # writes of segments being sealed that haven't finished yet
+        self.writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audit')
+        self.file = None  # the writer thread's handle on the newest segment
+        self.flusher = None
+        self.flush_scheduled = False
+        self.appended = 0
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self._open()
+
+    def _data_path(self, first_seq):
+        return os.path.join(self.path, f'{first_seq:012d}.jsonl')
+
+    def _open(self):
+        names = sorted(name for name in os.listdir(self.path) if name.endswith('.jsonl')) \
+            if os.path.isdir(self.path) else []
+        self.active = None
+        for n, name in enumerate(names):
+            data_path = os.path.join(self.path, name)
+            index_path = data_path[:-len('.jsonl')] + '.idx'
+            first_seq = int(name[:-len('.jsonl')])
+            if os.path.exists(index_path):
+                self.segments.append(MappedSegment(data_path, index_path, first_seq))
+                continue
+            segment = MemorySegment.load(data_path, first_seq, repair=not self.readonly)
+            if n == len(names) - 1:
+                self.active = segment
+            elif self.readonly:
+                self.segments.append(segment)
+            else:
+                # The bot stopped while sealing this segment
+                self._write_index(segment)
+                self.segments.append(MappedSegment(data_path, index_path, first_seq))
+        last = None
+        for segment in reversed(self.segments + [self.active]):
+            if segment is not None and len(segment):
+                last = segment.last()
+                break
+        self.next_seq, self.last_time = (last[0] + 1, last[1]) if last else (1, 0.0)
+        if self.active is None:
+            self.active = MemorySegment(self._data_path(self.next_seq), self.next_seq)
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments) + len(self.active)
+
+    def append(self, event, fields=None, **more):
+        '''
+        Files a record for an event, e.g. append('closed', case_fields, outcome='satire'), and returns it.
+        '''
+        if self.readonly:
+            raise RuntimeError('The audit store was opened read-only')
+        # Times never go backwards within the store, so the time index stays sorted even if the clock is stepped
+        self.last_time = max(time.time(), self.last_time)
+        record = {'seq': self.next_seq, 'time': round(self.last_time, 6), 'event': event}
+        if fields:
+            record.update(fields)
+        record.update(more)
+        line = (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        self.active.add(record, line)
+        self.pending.append(line)
+        self.next_seq += 1
+        self.appended += 1
+        if len(self.active) >= self.segment_records:
+            self._seal()
+        elif len(self.pending) >= FLUSH_SIZE:
+            self.schedule_flush()
+        return record
+
+    def _seal(self):
+        segment = self.active
+        lines, self.pending = self.pending, []
+        self.segments.append(segment)
+        self.active = MemorySegment(self._data_path(self.next_seq), self.next_seq)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(segment.path, lines, segment)
+            self._sealed(segment)
+            return
+        future = loop.run_in_executor(self.writer_thread, self._write, segment.path, lines, segment)
+        self.sealing.add(future)
+        future.add_done_callback(lambda future: self._sealed(segment, future))
+
+    def _sealed(self, segment, future=None):
+        self.sealing.discard(future)
+        if future is not None and future.exception() is not None:
+            logger.error('Could not seal audit segment %s', segment.path, exc_info=future.exception())
+            return
+        index_path = segment.path[:-len('.jsonl')] + '.idx'
+        position = self.segments.index(segment)
+        self.segments[position] = MappedSegment(segment.path, index_path, segment.first_seq)
+
+    def _write(self, path, lines, sealing=None):
+        if lines or sealing is not None:
+            if self.file is None or self.file.name != path:
+                if self.file is not None:
+                    self.file.close()
+                self.file = open(path, 'ab')
+            self.file.write(b''.join(lines))
+            self.file.flush()
+        if sealing is not None:
+            os.fsync(self.file.fileno())
+            self._write_index(sealing)
+
+    def _write_index(self, segment):
+        index_path = segment.path[:-len('.jsonl')] + '.idx'
+        # Written under another name first, so an index file that exists is always complete
+        with open(index_path + '.tmp', 'wb') as f:
+            f.write(segment.index_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + '.tmp', index_path)
+
+    async def flush(self):
+        '''
+        Writes out everything appended so far, including segments that are still being sealed.
+        '''
+        self.flush_scheduled = False
+        if self.pending:
+            lines, self.pending = self.pending, []
+            await asyncio.get_running_loop().run_in_executor(self.writer_thread, self._write, self.active.path, lines)
+        if self.sealing:
+            await asyncio.gather(*self.sealing, return_exceptions=True)
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.ensure_future(self.flush())
+
+    async def run(self):
+        '''
+        Background task that writes out appended records every FLUSH_INTERVAL seconds.
+        '''
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if self.flusher is None and not self.readonly:
+            self.flusher = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        self.writer_thread.submit(self._close_file).result()
+        self.writer_thread.shutdown()
+        for segment in self.segments:
+            segment.close()
+
+    def _close_file(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    # Lookups, oldest record first
+
+    def _all(self):
+        return self.segments + [self.active]
+
+    def by_author(self, author_id, limit=None):
+        records = [record for segment in self._all() for record in segment.author(author_id)]
+        return records[-limit:] if limit else records
+
+    def by_case(self, case_id):
+        return [record for segment in self._all() for record in segment.case(case_id)]
+
+    def between(self, start=None, end=None):
+        return [record for segment in self._all() if len(segment) and segment.last()[1] >= (start or 0)
+                for record in segment.between(start, end)]
+
+    def export(self, out, start=None, end=None):
+        '''
+        Streams the records with start <= time < end to a binary file object as JSON lines, without parsing them.
+        Returns the number of bytes written.
+        '''
+        written = 0
+        for segment in self._all():
+            if not len(segment) or segment.last()[1] < (start or 0):
+                continue
+            for chunk in segment.chunks(start, end):
+                out.write(chunk)
+                written += len(chunk)
+        return written
+
+    def stats(self):
+        return {'records': len(self), 'appended': self.appended, 'segments': len(self.segments) + 1,
+                'pending': len(self.pending)}
+
+
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default='audit', help='audit directory (audit.N for shard N)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('author', help='records about an author').add_argument('id', type=int)
+    commands.add_parser('case', help='records about a case').add_argument('id', type=int)
+    export = commands.add_parser('export', help='stream records as JSON lines')
+    export.add_argument('--since', type=parse_time, help='epoch seconds or ISO date')
+    export.add_argument('--until', type=parse_time, help='epoch seconds or ISO date')
+    args = parser.parse_args()
+
+    # Read-only, so this is safe to run next to the bot
+    store = AuditStore(args.dir, readonly=True)
+    out = sys.stdout.buffer
+    if args.command == 'export':
+        store.export(out, args.since, args.until)
+    else:
+        records = store.by_author(args.id) if args.command == 'author' else store.by_case(args.id)
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+    for segment in store.segments:
+        segment.close()
+    store.writer_thread.shutdown()
+
+
+if __name__ == '__main__':
+    main()
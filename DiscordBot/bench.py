@@ -0,0 +1,389 @@
+'''
+Micro-benchmarks for the bot's hot paths. None of them need Discord or real API keys; anything that talks to an
+external API is pointed at a local mock server. Run `python bench.py --help` for the list of benchmarks.
+'''
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from aiohttp import web
+from unidecode import unidecode
+from http_client import HttpClient
+from apis import ExternalApis
+from cache import CachedApis
+from links import LEGACY_URL_REGEX, extract_urls
+from duplicates import DuplicateDetector
+from normalization import to_ascii, clear_cache
+from audit import AuditStore
+from prescreen import PreScreener
+from claims import ClaimIndex, STOPWORDS
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def report(name, count, elapsed, latencies=None):
+    line = f'{name:<28} {count / elapsed:>10.0f} ops/s'
+    if latencies:
+        line += f'   p50 {percentile(latencies, 50) * 1000:>8.2f} ms   p99 {percentile(latencies, 99) * 1000:>8.2f} ms'
+    print(line)
+
+
+async def start_mock_perspective(latency, port=0):
+    async def analyze(request):
+        await request.json()
+        await asyncio.sleep(latency)
+        return web.json_response({'attributeScores': {'TOXICITY': {'summaryScore': {'value': random.random()}}}})
+
+    app = web.Application()
+    app.router.add_post('/comments:analyze', analyze)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}/comments:analyze'
+
+
+async def bench_perspective(args):
+    '''
+    Perspective scoring straight through the shared connection pool, and through CachedApis, which answers repeats
+    from its cache and merges identical texts that are in flight at the same time into one request.
+    '''
+    runner, url = await start_mock_perspective(args.latency)
+    texts = [f'message number {i % args.unique}' for i in range(args.requests)]
+    try:
+        for name, wrap in (('perspective direct', lambda apis: apis), ('perspective cached', CachedApis)):
+            http = HttpClient(limit_per_host=args.concurrency)
+            apis = ExternalApis(http, '', '', 'key')
+            apis.perspective_url = url
+            scorer = wrap(apis)
+            limit = asyncio.Semaphore(args.concurrency)
+            latencies = []
+
+            async def one(text):
+                async with limit:
+                    started = time.perf_counter()
+                    await scorer.eval_text(text)
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*[one(text) for text in texts])
+            report(name, len(texts), time.perf_counter() - started, latencies)
+            if isinstance(scorer, CachedApis):
+                print(f'{"":<28} {scorer.stats()["eval_text"]}, coalesced {scorer.stats()["coalesced"]}')
+            await http.close()
+    finally:
+        await runner.cleanup()
+
+
+def time_calls(fn, inputs, repeat):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in inputs:
+            call_started = time.perf_counter()
+            fn(text)
+            latencies.append(time.perf_counter() - call_started)
+    return len(latencies), time.perf_counter() - started, latencies
+
+
+def bench_links(args):
+    words = ['the', 'vaccine', 'election', 'was', 'rigged', 'lol', 'did', 'you', 'see', 'this', 'honestly', 'wow']
+    normal = [' '.join(random.choices(words, k=random.randint(5, 30))) for _ in range(200)]
+    url_heavy = [' '.join(random.choice(words) + f' https://news{i}.example.com/2022/05/{i}/story_(part{i})?ref=x,'
+                          for i in range(random.randint(3, 10))) for _ in range(200)]
+    # Each of these makes the legacy pattern backtrack exponentially in the length of the punctuation run
+    pathological = ['http://' + '!' * n for n in (12, 14, 16, 18)]
+    legacy = lambda text: [m[0] for m in LEGACY_URL_REGEX.findall(text)]
+    for corpus_name, corpus in (('normal', normal), ('url-heavy', url_heavy), ('pathological', pathological)):
+        for name, fn in (('legacy regex', legacy), ('extract_urls', extract_urls)):
+            report(f'links {corpus_name} {name}', *time_calls(fn, corpus, args.repeat))
+    long_attack = ['http://' + '!' * 100000, 'a.bc/(' * 20000]
+    report('links 100k adversarial', *time_calls(extract_urls, long_attack, 1))
+
+
+def bench_normalization(args):
+    '''
+    unidecode on every message, as on_message used to do, against to_ascii. About 30% of each corpus repeats an
+    earlier message, the way spam and copy-pasted claims do; "cold" is one pass over it right after the cache was
+    cleared, "warm" the passes after that.
+    '''
+    scripts = {
+        'ascii': ['the', 'vaccine', 'election', 'was', 'rigged', 'lol', 'did', 'you', 'see', 'this', 'honestly'],
+        'latin': ['café', 'élection', 'truquée', 'vacuna', 'mañana', 'Wahlfälschung', 'über', 'señal', 'niño'],
+        'cyrillic': ['выборы', 'вакцина', 'подделка', 'правда', 'новости', 'смотри', 'это', 'честно'],
+        'cjk': ['选举', '疫苗', '操纵', '新闻', '真相', 'ワクチン', '選挙', '見て', '本当に'],
+        'emoji': ['😂', '🔥', '💉', '🗳️', '👀', '‼️', 'lol', 'wow', 'this'],
+    }
+    scripts['mixed'] = [word for words in scripts.values() for word in words]
+
+    def corpus(words):
+        unique = [' '.join(random.choices(words, k=random.randint(5, 30))) for _ in range(700)]
+        return unique + random.choices(unique, k=300)
+
+    for corpus_name, words in scripts.items():
+        texts = corpus(words)
+        random.shuffle(texts)
+        report(f'normalize {corpus_name} unidecode', *time_calls(unidecode, texts, args.repeat))
+        clear_cache()
+        report(f'normalize {corpus_name} cold', *time_calls(to_ascii, texts, 1))
+        report(f'normalize {corpus_name} warm', *time_calls(to_ascii, texts, args.repeat))
+
+
+async def bench_audit(args):
+    '''
+    Lookups in an audit log of --audit-records case events, against scanning the JSON lines the way a plain log
+    file would have to be searched.
+    '''
+    authors = [random.getrandbits(60) for _ in range(5000)]
+    with tempfile.TemporaryDirectory() as path:
+        store = AuditStore(path)
+        store.start()
+        first = time.time()
+        started = time.perf_counter()
+        for seq in range(args.audit_records):
+            # A few authors account for most cases, as repeat offenders do
+            author_id = authors[min(int(random.paretovariate(1.2)) - 1, len(authors) - 1)] \
+                if random.random() < 0.5 else random.choice(authors)
+            store.append(random.choice(['opened', 'claimed', 'closed']), case_id=seq // 3 + 1, author_id=author_id,
+                         guild_id=1, content='the election was rigged, see https://example.com/story ' * 2)
+        elapsed = time.perf_counter() - started
+        last = time.time()
+        await store.flush()
+        report('audit append', args.audit_records, elapsed)
+        print(f'{"":<28} {len(store.segments)} sealed segments of {store.segment_records:,} records, '
+              f'{sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 2 ** 20:.1f} MiB')
+
+        sample = random.sample(authors, 200)
+        report('audit by_author', *time_calls(store.by_author, sample, 1))
+        cases = [random.randint(1, args.audit_records // 3) for _ in range(200)]
+        report('audit by_case', *time_calls(store.by_case, cases, 1))
+        windows = [first + random.random() * (last - first) for _ in range(200)]
+        report('audit between (1%)', *time_calls(lambda start: store.between(start, start + (last - first) / 100),
+                                                windows, 1))
+
+        def scan(author_id):
+            matches = []
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.jsonl'):
+                    with open(os.path.join(path, name), 'rb') as f:
+                        matches.extend(record for record in map(json.loads, f) if record['author_id'] == author_id)
+            return matches
+
+        report('audit by_author scan', *time_calls(scan, sample[:5], 1))
+        out = io.BytesIO()
+        started = time.perf_counter()
+        written = store.export(out)
+        elapsed = time.perf_counter() - started
+        print(f'{"audit export":<28} {written / elapsed / 2 ** 20:>10.0f} MiB/s')
+        await store.close()
+
+
+# Messages the pipeline should see: false claims of the kind the bot fact-checks, and abuse for Perspective
+PRESCREEN_RISKY = [
+    'Vaccines cause autism, everyone knows it',
+    'Drinking bleach cures covid for real',
+    'The election was rigged, millions of ballots were stolen',
+    'Bill Gates put microchips in the vaccine',
+    '5G towers are spreading the virus',
+    'The moon landing was a hoax filmed in a studio',
+    'Big pharma is hiding the cure for cancer',
+    'Voter fraud in every swing state, this is proof',
+    'They dont want you to know that lemons cure diabetes',
+    'The deep state is behind the shooting',
+    'Covid was planned, it is a plandemic',
+    'Wake up sheeple, the news is lying to you',
+    'This miracle cure reverses aging in a week',
+    'Fake news media covered up the real numbers',
+    'Ballots found dumped in a river after the election',
+    'The vaxx changes your DNA',
+    'I will shoot you if you show up tomorrow',
+    'you are a stupid idiot and everyone hates you',
+    'hope you die in a fire',
+    'Exposed: the government poisons the water supply',
+    'Climate change is a conspiracy by scientists to get grants',
+    'check this out https://yournewswire.com/shocking-truth',
+    'read the real story here https://totally-real-news.net/article',
+    'BREAKING: the president has been arrested!!!',
+    'THEY ARE LYING TO ALL OF US ABOUT WHAT HAPPENED!!!',
+]
+# Everyday chatter that should never cost an API call
+PRESCREEN_BENIGN = [
+    'lol did you see the game last night', 'anyone up for lunch at 12?', 'I finished the problem set finally',
+    'what time is section on thursday', 'that movie was so good', 'can someone share the lecture notes',
+    'happy birthday!!', 'my cat just knocked my coffee over', 'gg everyone', 'brb getting food',
+    'does anyone know if office hours moved', 'the studies for the midterm are brutal', 'I died laughing at that meme',
+    'here is the repo https://github.com/example/project', 'the wifi in the library is down again',
+    'who wants to play tonight', 'thanks for the help yesterday', 'this song is stuck in my head',
+    'I hate mondays', 'see the wiki https://en.wikipedia.org/wiki/Python', 'congrats on the internship!',
+    'is the dining hall open on sundays', 'my code finally compiles', 'good luck on the exam tomorrow',
+    'we should start the project early this time',
+]
+
+
+def bench_prescreen(args):
+    '''
+    How fast the pre-screen scores a message, and how well it separates a small labelled sample: the share of claims
+    and abuse it sends on (recall) and the share of chatter it settles locally.
+    '''
+    screener = PreScreener()
+    samples = PRESCREEN_RISKY + PRESCREEN_BENIGN
+    prepared = [(text, extract_urls(text)) for text in samples]
+    report('prescreen score', *time_calls(lambda item: screener.score(*item), prepared, args.repeat))
+    missed = [text for text in PRESCREEN_RISKY if not screener.should_check(text, extract_urls(text))[0]]
+    passed = [text for text in PRESCREEN_BENIGN if screener.should_check(text, extract_urls(text))[0]]
+    print(f'{"":<28} recall {1 - len(missed) / len(PRESCREEN_RISKY):.2f} ({len(missed)} of '
+          f'{len(PRESCREEN_RISKY)} risky missed), {1 - len(passed) / len(PRESCREEN_BENIGN):.2f} of chatter skipped')
+    for text in missed:
+        print(f'{"":<28} missed: {text}')
+
+
+def bench_duplicates(args):
+    '''
+    An hour of traffic at 100k messages/hour, a third of which are lightly edited copies of a few hundred campaign
+    messages. Reports throughput, the memory the full window takes and how many copies were caught.
+    '''
+    words = ['the', 'vaccine', 'election', 'was', 'rigged', 'lol', 'did', 'you', 'see', 'this', 'honestly', 'wow',
+             'they', 'dont', 'want', 'know', 'cure', 'news', 'today', 'people', 'here', 'proof', 'just', 'look']
+    campaigns = [' '.join(random.choices(words, k=random.randint(12, 40))) + f' https://site{i}.example.com/a?id={i}'
+                 for i in range(300)]
+
+    def variant(text):
+        tokens = text.split(' ')
+        tokens[random.randrange(len(tokens))] = random.choice(words).upper() + '!'
+        return ' '.join(tokens) + random.choice(['', ' ', '?utm_source=x', ' RT'])
+
+    messages = []
+    for _ in range(args.messages):
+        if random.random() < 1 / 3:
+            messages.append((variant(random.choice(campaigns)), True))
+        else:
+            messages.append((' '.join(random.choices(words, k=random.randint(5, 40))), False))
+
+    detector = DuplicateDetector(max_size=args.messages)
+    matched = []
+    count, elapsed, latencies = time_calls(lambda text: matched.append(detector.match(text)[1]),
+                                           [text for text, _ in messages], 1)
+    # Tracing every allocation is slow, so memory is measured on a sample and scaled up to the full window
+    sample = messages[:10000]
+    sampled = DuplicateDetector(max_size=len(sample))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for text, _ in sample:
+        sampled.match(text)
+    per_entry = (tracemalloc.get_traced_memory()[0] - before) / max(len(sampled), 1)
+    tracemalloc.stop()
+    used = per_entry * len(detector)
+
+    report('duplicates match', count, elapsed, latencies)
+    copies = sum(is_copy for _, is_copy in messages)
+    caught = sum(is_copy and hit for (_, is_copy), hit in zip(messages, matched))
+    false_matches = sum(hit and not is_copy for (_, is_copy), hit in zip(messages, matched))
+    print(f'{"":<28} {count / elapsed * 3600:,.0f} messages/hour capacity, window of {len(detector):,} '
+          f'takes ~{used / 2 ** 20:.1f} MiB ({per_entry:.0f} B each)')
+    print(f'{"":<28} caught {caught:,} of {copies:,} copies ({len(campaigns)} campaigns), '
+          f'{false_matches:,} unrelated messages matched')
+
+
+def bench_claims(args):
+    '''
+    Claim index lookups against the number of rated claims in it. Claims are drawn from a vocabulary with a Zipf-like
+    spread, so common words have long postings lists as they would in real claims. A quarter of the queries are
+    rewordings of an indexed claim (stopwords and filler added, a plural changed), which should match. The rest must
+    not: indexed claims with one word swapped, indexed claims negated, and new claims.
+    '''
+    vocabulary = [f'w{rank}' for rank in range(1, 20001)]
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    stopwords = sorted(STOPWORDS)
+
+    def claim():
+        return ' '.join(random.choices(vocabulary, weights, k=random.randint(8, 20)))
+
+    def reword(text):
+        words = text.split(' ')
+        # Only words long enough to have their plural folded back; 's' on a short one makes a different word
+        plurals = [position for position, word in enumerate(words) if len(word) >= 3]
+        if plurals:
+            words[random.choice(plurals)] += 's'
+        words.insert(random.randrange(len(words)), random.choice(stopwords))
+        return ' '.join(words).capitalize() + random.choice(['', '!', '?', ' lol', ' please share'])
+
+    def swap(text):
+        words = text.split(' ')
+        words[random.randrange(len(words))] = random.choice([word for word in vocabulary[:1000] if word not in words])
+        return ' '.join(words)
+
+    def negate(text):
+        words = text.split(' ')
+        words.insert(random.randrange(1, len(words)), random.choice(['not', 'never', "don't", 'isn\u2019t', 'no']))
+        return ' '.join(words)
+
+    for size in args.claim_sizes:
+        claims = [claim() for _ in range(size)]
+        index = ClaimIndex()
+        started = time.perf_counter()
+        for text in claims:
+            index.add(text, 'False')
+        built = time.perf_counter() - started
+        queries = [(reword(random.choice(claims)), 'reworded') for _ in range(args.claim_queries // 4)]
+        queries += [(swap(random.choice(claims)), 'swapped') for _ in range(args.claim_queries // 4)]
+        queries += [(negate(random.choice(claims)), 'negated') for _ in range(args.claim_queries // 4)]
+        queries += [(claim(), 'new') for _ in range(args.claim_queries - len(queries))]
+        random.shuffle(queries)
+        matches = []
+        count, elapsed, latencies = time_calls(lambda text: matches.append(index.match(text) is not None),
+                                               [text for text, _ in queries], 1)
+        report(f'claims match {size:,}', count, elapsed, latencies)
+        kinds = Counter(kind for _, kind in queries)
+        hits = Counter(kind for (_, kind), hit in zip(queries, matches) if hit)
+        print(f'{"":<28} built in {built:.2f} s ({len(index.postings):,} words), matched {hits["reworded"]:,} of '
+              f'{kinds["reworded"]:,} rewordings, {hits["swapped"]:,} of {kinds["swapped"]:,} with a word swapped, '
+              f'{hits["negated"]:,} of {kinds["negated"]:,} negations and {hits["new"]:,} of {kinds["new"]:,} new '
+              f'claims')
+
+
+BENCHMARKS = {
+    'audit': bench_audit,
+    'claims': bench_claims,
+    'duplicates': bench_duplicates,
+    'links': bench_links,
+    'normalization': bench_normalization,
+    'perspective': bench_perspective,
+    'prescreen': bench_prescreen,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'benchmarks to run, all by default: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--requests', type=int, default=2000, help='number of calls for API benchmarks')
+    parser.add_argument('--concurrency', type=int, default=64, help='callers in flight for API benchmarks')
+    parser.add_argument('--unique', type=int, default=500, help='distinct texts among the API calls')
+    parser.add_argument('--repeat', type=int, default=20, help='passes over the corpus for CPU benchmarks')
+    parser.add_argument('--messages', type=int, default=100000, help='messages in the duplicate detection stream')
+    parser.add_argument('--audit-records', type=int, default=200000, help='records in the audit log benchmark')
+    parser.add_argument('--claim-sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='rated claims in the claim index benchmark, one run per size')
+    parser.add_argument('--claim-queries', type=int, default=2000, help='lookups per claim index size')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock API latency in seconds')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmark {", ".join(unknown)} (choose from {", ".join(BENCHMARKS)})')
+    for name in args.benchmarks or BENCHMARKS:
+        result = BENCHMARKS[name](args)
+        if asyncio.iscoroutine(result):
+            asyncio.run(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,111 +1,209 @@
 # bot.py
-import copy
-from collections import deque
+from collections import Counter
 from email.message import Message
 import discord
 from discord.ext import commands
 import os
+import argparse
+import asyncio
 import json
 import logging
 import re
-import requests
-from unidecode import unidecode
-from report import Report
-from collections import deque
+import time
+from report import Report, ReportStore, State, ABUSE_TYPES, FALSE_INFORMATION, FALSE_INFO_TYPES, regional_indicator
+from reactions import ReactionDispatcher
+from output import Output, case_embed, truncate, MESSAGE_LIMIT
+from channels import ChannelIndex, MONITORED, MOD
+from cases import CaseStore, severity
+from ledger import PointsLedger
+from http_client import HttpClient
+from apis import ExternalApis
+from cache import CachedApis
+from claims import ClaimIndex, ClaimMatchingApis
+from policy import PolicyApis, deadline_scope, MESSAGE_DEADLINE, UNSCORED
+from enrichment import Enricher, LinkResult, text_part
+from prescreen import PreScreener
+from duplicates import DuplicateDetector
+from metrics import Metrics, MeteredApis
+from ingest import IngestQueue, prepare_text
+from normalization import to_ascii, cache_stats as normalization_stats
+from shards import SharedState, shard_for, HANDOFF_INTERVAL
+from edits import AnalysisStore, EditDebouncer, TEXT
+from logs import LogWriter, log_case, case_fields
+from audit import AuditStore
+from snapshot import StateSnapshots, message_ref, restore_message
 
-# Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
+
+
+def setup_logging(filename='discord.log', case_filename='cases.log'):
+    # Log records go through a queue to a background thread, which writes them to the rotating log files and console
+    return LogWriter(filename, case_filename).start()
+
 
 # There should be a file called 'token.json' inside the same folder as this file
 token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_key = tokens['perspective']
-    claim_buster_key = tokens['claim_buster']
-    meaningcloud_key = tokens['meaningcloud']
-
-
-def fact_check(input_claim):
-    # Define the endpoint (url) with the claim formatted as part of it, api-key (api-key is sent as an extra header)
-    api_endpoint = f"https://idir.uta.edu/claimbuster/api/v2/query/fact_matcher/{input_claim}"
-    request_headers = {"x-api-key": claim_buster_key}
-
-    # Send the GET request to the API and store the api response
-    api_response = requests.get(url=api_endpoint, headers=request_headers)
-    # print(api_response.json())
-    if not api_response.json()["justification"]:
-        return None  # ADDED
-    res = api_response.json()["justification"][0]["truth_rating"]
-
-    return res
-
-# def txt_classify(input_url):
-#     pass
-
-def extract_title(input_url):
-    print("Extracting title...")
-    files = {
-        'key': (None, meaningcloud_key),
-        'url': (None, input_url)
-    }
-    response = requests.post('http://api.meaningcloud.com/documentstructure-1.0', files=files)
-    title = response.json()['title']
-    return title
-
-def summarize(input_url):
-    print("Summarizing url content...")
-    files = {
-        'key': (None, meaningcloud_key),
-        'url': (None, input_url),
-        'sentences': (None, '3'),
-    }
-    response = requests.post('http://api.meaningcloud.com/summarization-1.0', files=files)
-    summary = response.json()['summary']
-
-    # remove [...]'s from summary
-    ret = summary.replace("[...]", "")
-    return ret
+
+
+def load_tokens(path=token_path):
+    '''
+    Reads the Discord token and API keys. Only running the bot needs them, so importing this module works without.
+    '''
+    if not os.path.isfile(path):
+        raise Exception(f"{path} not found!")
+    with open(path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        return json.load(f)
+
+
+# Optional overrides for the local pre-screening keywords, domain lists and threshold
+prescreen_path = 'prescreen.json'
+# Author points and enforcement history
+ledger_path = 'ledger.sqlite3'
+# Append-only record of every case, decision and user report
+audit_path = 'audit'
+# Open cases, prompts and reports in progress, read back after a restart
+snapshot_path = 'state.json'
+# Besides the prompts of open cases, a snapshot keeps at most this many of the newest other prompts
+SNAPSHOT_PROMPTS = 1000
+# API results are kept here between restarts so the bot doesn't start with a cold cache
+cache_path = 'api_cache.json'
+# Every claim ClaimBuster has rated, so rewordings of it can be rated without calling out; shared by all shards
+claims_path = 'claims.jsonl'
+# Metrics are served in the Prometheus format on http://127.0.0.1:<metrics_port>/metrics and snapshotted to this file
+metrics_port = 9108
+metrics_path = 'metrics.log'
+# State the shard processes share when the bot runs sharded (see shards.py)
+shared_path = 'shared.sqlite3'
+
+
+# Moderator categories: emoji -> team the message is passed to, or None for false information, which has its own flow
+MOD_CATEGORIES = {
+    '🔴': 'Hate & Harassment Team',
+    '🟠': None,
+    '🟡': 'Violence/Graphic Imagery Team',
+    '🟢': 'Spam Team',
+    '🔵': 'Multidisciplinary Team',
+}
+# Harm ratings for disinformation: emoji -> (points added to the author, action taken on the message)
+HARM_LEVELS = {
+    '1️⃣': (8, 'delete'),
+    '2️⃣': (5, 'flag'),
+    '3️⃣': (2, None),
+}
+THRESHOLD_POINTS = 50
+# Typed in the mod channel by a moderator to be handed the most severe unclaimed case
+NEXT_CASE_KEYWORD = "next"
+# Typed in the mod channel by a moderator to hand every case they hold back to the queue
+RELEASE_KEYWORD = "release"
+# Typed in the mod channel to list the authors who are over THRESHOLD_POINTS
+OFFENDERS_KEYWORD = "offenders"
+
+ABUSE_TYPES_BY_NAME = {abuse_type[0]: abuse_type for abuse_type in ABUSE_TYPES.values()}
+LETTERS_BY_INDICATOR = {regional_indicator(letter): letter for abuse_type in ABUSE_TYPES.values()
+                        for letter, category in abuse_type[2]}
 
 
 class ModBot(discord.Client):
-    def __init__(self, key):
+    def __init__(self, tokens, prescreen_path=prescreen_path, ledger_path=ledger_path, cache_path=cache_path,
+                 metrics_port=metrics_port, metrics_path=metrics_path, shard_id=None, shard_count=None,
+                 shared_path=shared_path, log_writer=None, audit_path=audit_path, snapshot_path=snapshot_path,
+                 claims_path=claims_path):
         intents = discord.Intents.default()
         intents.reactions = True
         intents.messages = True
 
-        super().__init__(command_prefix='.', intents=intents)
+        super().__init__(command_prefix='.', intents=intents, shard_id=shard_id, shard_count=shard_count)
 
         self.group_num = None
-        self.mod_channels = {} # Map from guild to the mod channel id for that guild
-        self.reports = {} # Map from user IDs to the state of their report
-        self.perspective_key = key
-        # self.describe_other_disinfo = ""
-        self.more_details = ""
-        self.level_one = ""
-        self.level_two = ""
-        self.level_three = ""
-        self.sent = False
-        self.message = ""
-        self.message_author = ""
-        self.message_object = None
+        # Run as one shard of several, every shard gets its own metrics port and files, and API results are
+        # shared through SQLite instead of each shard's cache file
+        self.shared = None
+        if shard_count is not None:
+            self.shared = SharedState(shared_path)
+            cache_path = None
+            if metrics_port is not None:
+                metrics_port += shard_id
+            if metrics_path is not None:
+                metrics_path = f'{metrics_path}.{shard_id}'
+            audit_path = f'{audit_path}.{shard_id}'
+            snapshot_path = f'{snapshot_path}.{shard_id}'
+        self.handoffs = None
+        self.log_writer = log_writer
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_path = metrics_path
+        self.channels = ChannelIndex() # Monitored and mod channel of each guild, kept current by channel events
+        self.reports = ReportStore() # Map from user IDs to the state of their report
+        self.reactions = ReactionDispatcher() # Map from prompt message IDs to what each of their reactions does
+        self.output = Output(self.metrics)  # everything the bot posts, with reactions seeded in the background
+        self.perspective_key = tokens['perspective']
+        self.api_http = HttpClient()  # discord.Client already uses self.http for its own REST calls
+        self.external_apis = ExternalApis(self.api_http, tokens['claim_buster'], tokens['meaningcloud'], self.perspective_key)
+        self.policy_apis = PolicyApis(MeteredApis(self.external_apis, self.metrics))
+        self.claims = ClaimIndex(claims_path)
+        self.claim_apis = ClaimMatchingApis(self.policy_apis, self.claims)
+        self.apis = CachedApis(self.claim_apis, path=cache_path, shared=self.shared)
+        self.enricher = Enricher(self.apis)
+        self.prescreen = PreScreener.from_file(prescreen_path)
+        self.duplicates = DuplicateDetector()  # recent monitored messages, so copies of one join its cases
+        self.ingest = IngestQueue(self.check_message, self.metrics, on_shed=self.shed_message)  # monitored messages waiting to be checked
+        self.analyses = AnalysisStore()  # what the pipeline found for recent messages, to compare their edits against
+        self.edits = EditDebouncer(lambda message: self.ingest.put(message.guild.id, message))
         # ****
-        self.curr_message = discord.Message     # most recent message mods are looking at
-        self.messages_queue = deque()
-        self.points = {}  # map from user IDs to points (more points = more reports on their messages)
+        self.cases = CaseStore(first_id=(shard_id or 0) + 1, id_step=shard_count or 1)    # messages forwarded to the mod channel that are waiting for a decision
+        self.ledger = PointsLedger(ledger_path)  # points per author and guild (more points = more reports on their messages)
+        self.audit = AuditStore(audit_path)  # every case, decision and user report, by author, case and time
+        self.snapshots = StateSnapshots(snapshot_path, self.capture_state, cache=self.apis)  # for warm restarts
+        self.restored = False
+        self.register_gauges()
+
+    def register_gauges(self):
+        gauge = self.metrics.gauge
+        gauge('open_cases', 'Cases forwarded to moderators and not yet closed', lambda: len(self.cases))
+        gauge('open_reports', 'User report sessions in progress', lambda: len(self.reports))
+        gauge('open_prompts', 'Prompts whose reactions are still being listened for', lambda: len(self.reactions.prompts))
+        gauge('duplicate_window', 'Messages in the near-duplicate window', lambda: len(self.duplicates))
+        gauge('edits_waiting', 'Edited messages waiting for the edits to settle', lambda: len(self.edits))
+        gauge('normalization_cache_hits', 'Non-ASCII texts whose transliteration was remembered',
+              lambda: normalization_stats()['hits'], kind='counter')
+        gauge('normalization_cache_misses', 'Non-ASCII texts that had to be transliterated',
+              lambda: normalization_stats()['misses'], kind='counter')
+        gauge('audit_records', 'Records appended to the audit log', lambda: self.audit.appended, kind='counter')
+        gauge('ledger_pending', 'Point changes not yet written to the ledger', lambda: len(self.ledger.pending))
+        gauge('circuit_open', '1 while the circuit breaker for a provider is not closed',
+              lambda: {name: int(policy.breaker.state != 'closed') for name, policy in self.policy_apis.policies.items()},
+              label='provider')
+        caches = self.apis.caches
+        gauge('cache_hits', 'API cache hits', lambda: {name: cache.hits for name, cache in caches.items()},
+              label='method', kind='counter')
+        gauge('cache_misses', 'API cache misses', lambda: {name: cache.misses for name, cache in caches.items()},
+              label='method', kind='counter')
+        gauge('claim_index_size', 'Rated claims in the local claim index', lambda: len(self.claims))
+        gauge('claim_matches', 'Fact checks answered from the local claim index', lambda: self.claim_apis.matched,
+              kind='counter')
+        gauge('claim_misses', 'Fact checks the local claim index could not answer', lambda: self.claim_apis.missed,
+              kind='counter')
+        gauge('prescreen_skipped', 'Messages settled by the local pre-screen', lambda: self.prescreen.skipped,
+              kind='counter')
+        if self.log_writer is not None:
+            writer = self.log_writer
+            gauge('log_queue_depth', 'Log records waiting for the writer thread', lambda: writer.queue.qsize())
+            gauge('log_records_dropped', 'Log records dropped because the writer thread fell behind',
+                  lambda: writer.handler.dropped, kind='counter')
+            gauge('log_records_sampled_out', 'Debug log records left out by sampling', lambda: writer.sampler.dropped,
+                  kind='counter')
 
     async def on_ready(self):
-        print(f'{self.user.name} has connected to Discord! It is these guilds:')
-        for guild in self.guilds:
-            print(f' - {guild.name}')
-        print('Press Ctrl-C to quit.')
+        logger.info('%s has connected to Discord! It is in these guilds: %s', self.user.name,
+                    ', '.join(guild.name for guild in self.guilds))
+        logger.info('Press Ctrl-C to quit.')
+        self.ledger.start()
+        self.audit.start()
+        self.ingest.start()
+        await self.metrics.start(self.metrics_port, self.metrics_path)
+        if self.shared is not None and self.handoffs is None:
+            self.handoffs = asyncio.ensure_future(self.receive_handoffs())
 
         # Parse the group number out of the bot's name
         match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
@@ -114,11 +212,30 @@ class ModBot(discord.Client):
         else:
             raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
 
-        # Find the mod channel in each guild that this bot should report to
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
+        # Find the monitored and mod channel in each guild; the channel events below keep this up to date afterwards
+        self.channels.group_num = self.group_num
+        self.channels.rebuild(self.guilds)
+
+        # on_ready runs again after every reconnect, but the state only needs restoring once
+        if not self.restored:
+            self.restored = True
+            self.restore_state(self.snapshots.load())
+            self.snapshots.start()
+
+    async def on_guild_join(self, guild):
+        self.channels.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.channels.remove_guild(guild.id)
+
+    async def on_guild_channel_create(self, channel):
+        self.channels.add(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        self.channels.remove(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        self.channels.update(before, after)
 
     async def on_message(self, message):
         '''
@@ -126,23 +243,13 @@ class ModBot(discord.Client):
         Currently the bot is configured to only handle messages that are sent over DMs or in your group's "group-#" channel.
         '''
 
-        # Ignore messages from the bot
-        if message.author.id == self.user.id:
-            if message.content.startswith('Please provide more details'):
-                channel = message.channel
-                msg = await client.wait_for('message', check=None)
-                self.more_details = msg.content
-                await channel.send("We have received the following response: " + self.more_details)
-                return
-            # return
-
         # # Ignore messages from the bot
         # Check if this message was sent in a server ("guild") or if it's a DM
-        message.content = unidecode(message.content)
         if message.guild:
             await self.handle_channel_message(message)
         else:
-            await self.handle_dm(message)
+            with self.metrics.stage('dm').time():
+                await self.handle_dm(message)
 
     # async def on_message_edit(self, before, after):
     #     '''
@@ -151,9 +258,11 @@ class ModBot(discord.Client):
     #     await self.handle_channel_message(after)
 
     async def handle_dm(self, message):
+        # Keywords are matched on the ASCII form; the report keeps what the user actually wrote
+        text = to_ascii(message.content)
 
         # Handle a help message
-        if message.content == Report.HELP_KEYWORD:
+        if text == Report.HELP_KEYWORD:
             reply =  "Use the `report` command to begin the reporting process.\n"
             reply += "Use the `cancel` command to cancel the report process.\n"
             await message.channel.send(reply)
@@ -163,7 +272,7 @@ class ModBot(discord.Client):
         responses = []
 
         # Only respond to messages if they're part of a reporting flow
-        if author_id not in self.reports and not message.content.startswith(Report.START_KEYWORD):
+        if author_id not in self.reports and not text.startswith(Report.START_KEYWORD):
             return
 
         # If we don't currently have an active report for this user, add one
@@ -172,15 +281,8 @@ class ModBot(discord.Client):
 
         # Let the report class handle this message; forward all the messages it returns to uss
         responses = await self.reports[author_id].handle_message(message)
-
-        if responses[0] == "ORIGINAL":
-            if not self.message:
-                self.message = responses[1]
-                self.message_author = responses[2]
-                self.message_object = responses[3]
-        else:
-            for r in responses:
-                await message.channel.send(r)
+        for r in responses:
+            await self.output.send(message.channel, r)
 
         # If the report is complete or cancelled, remove it from our map
         if self.reports[author_id].report_complete():
@@ -188,369 +290,752 @@ class ModBot(discord.Client):
 
     async def handle_channel_message(self, message):
         # Only handle messages sent in the "group-#" channel xxxx
-        mod_channel = self.mod_channels[message.guild.id]
-        if message.channel.name == f'group-{self.group_num}' and len(message.content) > 10:
-
-            regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|" \
-                    r"(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-            urls = re.findall(regex, message.content)
-            url_list = [x[0] for x in urls]
-
-            processed_str = copy.deepcopy(message.content)
-            print("URL_LIST:", url_list)
-            if url_list:
-                for u in url_list:
-                    title = extract_title(u)  # extract title
-                    sum_str = summarize(u)  # extract summary
-                    # print(sum_str)
-                    msg_validity = fact_check(title)  # check validity of article summary
-                    processed_str = processed_str.replace(u, "")  # to pass in to api
-                    if msg_validity != "" and msg_validity != "True" and msg_validity != None:
-
-                        # Forward the message to the mod channel
-                        self.curr_message = message
-                        self.messages_queue.append((message, u))  # TODO (message, u)
-                        await mod_channel.send(f'Forwarded message:\n{message.author.name}: "Link: {u}\n'
-                                               f'Link title: {title}\n'
-                                               f'Link summary: {sum_str}"')
-                        await mod_channel.send(f'The content of this link has been fact checked as being potentially false')
-            print("REACHED", processed_str)
-            msg_validity = fact_check(processed_str)
-            if msg_validity != "" and msg_validity != "True" and msg_validity != None:
-                # Forward the message to the mod channel
-                self.curr_message = message
-                self.messages_queue.append((message, processed_str))
-                await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
-
-                scores = self.eval_text(message)
-                await mod_channel.send(f'This message has been fact checked as being potentially false')
-                await mod_channel.send(self.code_format(json.dumps(scores, indent=2)))
-        elif message.channel.name == f'group-{self.group_num}-mod':
-            if 'Forwarded message' in message.content:
-                # text = message.content[message.content.find('\"'):]
-                question = await mod_channel.send(f'Does the above message fall into any of the following categories? \n 🔴 Harassment/Bullying \n 🟠 False or Misleading Information \n 🟡 Violence/Graphic Imagery \n 🟢 Spam \n 🔵 Other Harmful Content \n')
-                await question.add_reaction('🔴')
-                await question.add_reaction('🟠')
-                await question.add_reaction('🟡')
-                await question.add_reaction('🟢')
-                await question.add_reaction('🔵')
+        role = self.channels.role(message.channel)
+        if role is None:
+            return
+        # Nothing to forward to, or to answer in, until the guild has a mod channel
+        mod_channel = self.channels.mod_channel(message.guild.id)
+        if mod_channel is None:
+            return
+        if role == MONITORED:
+            # The checks run on the ingest workers, so a slow one doesn't hold up the events behind it
+            self.ingest.put(message.guild.id, message)
+            return
+        if role == MOD:
+            command = to_ascii(message.content).strip()
+            # A moderator asking for the most severe case that nobody has picked up yet
+            if command == NEXT_CASE_KEYWORD and message.author.id != self.user.id:
+                # Cases whose moderator went quiet go back in the queue first
+                for case, moderator_id in self.cases.release_stale():
+                    self.record_case('released', case, reason='timeout', moderator_id=moderator_id)
+                case = self.cases.claim_next(message.author.id)
+                if case is None:
+                    await self.output.send(mod_channel, 'There are no unclaimed cases right now.')
+                    return
+                self.record_case('claimed', case)
+                scores = self.code_format(json.dumps(case.scores, indent=2)) if case.scores else None
+                embed, shown = self.render_case(case, f'Case #{case.id} is yours, {message.author.name}',
+                                                [('Content', case.content), ('Fact check', case.rating),
+                                                 ('Perspective scores', scores)])
+                await self.ask_category(mod_channel, case, embed)
+                shown()
+            # A moderator giving up the cases they claimed, e.g. one they reacted to by mistake
+            elif command == RELEASE_KEYWORD and message.author.id != self.user.id:
+                cases = self.cases.release_all(message.author.id)
+                if not cases:
+                    await self.output.send(mod_channel, 'You have no claimed cases.')
+                    return
+                for case in cases:
+                    self.record_case('released', case, reason='moderator', moderator_id=message.author.id)
+                await self.output.send(mod_channel, 'Released ' + ', '.join(f'case #{case.id}' for case in cases) +
+                                       '. Any moderator can pick ' + ('it' if len(cases) == 1 else 'them') + ' up now.')
+            # A moderator asking which authors in this guild are over the points threshold
+            elif command == OFFENDERS_KEYWORD and message.author.id != self.user.id:
+                offenders = self.ledger.over_threshold(message.guild.id, THRESHOLD_POINTS)
+                if not offenders:
+                    await self.output.send(mod_channel, 'No authors are over the points threshold.')
+                    return
+                lines = [f'<@{author_id}>: {points:.1f} points' for author_id, points in offenders]
+                await self.output.send(mod_channel, 'Authors over the points threshold:\n' + '\n'.join(lines))
 
-    async def on_raw_reaction_add(self, payload):
-        if payload.guild_id:
-            channel = await self.fetch_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            # user_id = await self.fetch_user(payload.user_id)
-            emoji = payload.emoji
-
-            # if len(self.messages_queue) > 0:
-
-            # self.messages_queue.popleft()
-
-            mod_channel = self.mod_channels[self.curr_message.guild.id]
-            # mod_channel = self.mod_channels[curr_message_obj.guild.id]
-            if (channel == mod_channel) and payload.user_id != self.user.id:
-                curr_message_obj = self.messages_queue[0][0]
-                curr_message = self.messages_queue[0][1]
-                author_id = curr_message_obj.author.id
-                if str(emoji) == str('🔴'):
-                    # await self.curr_message.add_reaction('🔴')
-                    await curr_message_obj.add_reaction('🔴')
-                    await mod_channel.send('Thank you! We have tagged this message and will inform the Hate & Harassment Team.')
-                    self.messages_queue.popleft()
-                if str(emoji) == str('🟠'):
-                    # await self.curr_message.add_reaction('🟠')
-                    await curr_message_obj.add_reaction('🟠')
-                    question1 = await mod_channel.send(f'Does the message "{curr_message}" contain false or misleading information? \n ✅ Yes \n ❌ No')
-                    await question1.add_reaction('✅')
-                    await question1.add_reaction('❌')
-                if str(emoji) == str('🟡'):
-                    # await self.curr_message.add_reaction('🟡')
-                    await curr_message_obj.add_reaction('🟡')
-                    await mod_channel.send('Thank you! We have tagged this message and will will inform the Violence/Graphic Imagery Team.')
-                    self.messages_queue.popleft()
-                if str(emoji) == str('🟢'):
-                    # await self.curr_message.add_reaction('🟢')
-                    await curr_message_obj.add_reaction('🟢')
-                    await mod_channel.send('Thank you! We have tagged this message and will will inform the Spam Team.')
-                    self.messages_queue.popleft()
-                if str(emoji) == str('🔵'):
-                    # await self.curr_message.add_reaction('🔵')
-                    await curr_message_obj.add_reaction('🔵')
-                    await mod_channel.send('Thank you! We have tagged this message and will will inform the Multidisciplinary Team.')
-                    self.messages_queue.popleft()
-                if str(emoji) == str('✅'):
-                    question2 = await mod_channel.send(f'Is the message "{curr_message}": \n ⬅️ Fabricated Content / Disinformation, or \n ➡️ Satire / Parody')
-                    await question2.add_reaction('⬅️')
-                    await question2.add_reaction('➡️')
-                if str(emoji) == str('❌'):
-                    await mod_channel.send('Thank you!')
-                    self.messages_queue.popleft()
-                if str(emoji) == str('⬅️'):
-                    question3 = await mod_channel.send(f'Please rate the harm of the message "{curr_message}": \n 1️⃣ (Immediate Harm) \n 2️⃣ (Moderate Harm) \n 3️⃣ (Low Harm)')
-                    await question3.add_reaction('1️⃣')
-                    await question3.add_reaction('2️⃣')
-                    await question3.add_reaction('3️⃣')
-                if str(emoji) == str('➡️'):
-                    await mod_channel.send('Thank you! We will take action if the issue becomes more serious.')
-                    self.messages_queue.popleft()
-                THRESHOLD_POINTS = 50
-                if str(emoji) == str('1️⃣'):
-                    # await mod_channel.send(f'message: "{self.curr_message.content}"')
-                    # await self.curr_message.delete()
-                    await curr_message_obj.delete()
-                    await mod_channel.send('Thank you! We have taken down the message.')
-                    self.points[author_id] = self.points.get(author_id, 0) + 8
-                    self.messages_queue.popleft()
-                if str(emoji) == str('2️⃣'):
-                    # await self.curr_message.add_reaction('🚩')
-                    await curr_message_obj.add_reaction('🚩')
-                    await mod_channel.send('Thank you! We have flagged the message.')
-                    self.points[author_id] = self.points.get(author_id, 0) + 5
-                    self.messages_queue.popleft()
-                if str(emoji) == str('3️⃣'):
-                    await mod_channel.send('Thank you! We will take action if the issue becomes more serious.')
-                    self.points[author_id] = self.points.get(author_id, 0) + 2
-                    self.messages_queue.popleft()
-                if self.points.get(author_id, 0) > THRESHOLD_POINTS:
-                    await mod_channel.send('The author of the message has been banned because they have exceeded the threshold of allowed points for reports against them.')
-
-            # await channel.send("Hello")
-        else:
-            if payload.user_id == self.user.id:
+    async def check_message(self, message):
+        '''
+        Runs on an ingest worker for each monitored message: pre-screening, duplicate detection and, if the message
+        needs it, the API pipeline, whose findings are forwarded to the mod channel.
+        '''
+        mod_channel = self.channels.mod_channel(message.guild.id)
+        if mod_channel is None:
+            return
+        # An edit to a message we have already looked at only needs the parts that changed checked again
+        analysis = self.analyses.get(message.id)
+        if analysis is not None:
+            with self.metrics.stage('recheck').time():
+                await self.recheck_message(message, mod_channel, analysis)
+            return
+        # The checks work on an ASCII transliteration; message.content stays as written for the moderators
+        normalized, url_list, sig = await self.prepare(message)
+        if len(normalized) <= 10:
+            return
+        logger.debug('Links in message %s: %s', message.id, url_list)
+        # Clearly benign messages are settled locally without spending any API calls
+        with self.metrics.stage('prescreen').time():
+            risky, verdict = self.prescreen.should_check(normalized, url_list)
+        if not risky:
+            return
+
+        # Copies of a message already in the window reuse its verdict instead of going through the pipeline again
+        with self.metrics.stage('duplicates').time():
+            cluster, seen = self.duplicates.match_signature(sig, message.guild.id)
+        if seen:
+            if not cluster.settled:
+                # Waiting here for the first copy would hold this worker until its pipeline finishes, and a burst of
+                # copies would take every worker from the other guilds. The copy is parked on the cluster instead
+                self.park_copy(message, cluster)
                 return
-            channel = discord.Client.get_channel(self, payload.channel_id)
+            if self.attach_copy(message, cluster):
+                return
+            # Moderators have already dealt with the earlier copy, so this one is reviewed on its own
+            cluster = self.duplicates.restart(cluster)
+
+        started = time.monotonic()
+        analysis = self.analyses.start(message.id, message.content, normalized)
+        try:
+            async with analysis.lock:
+                with deadline_scope(MESSAGE_DEADLINE):
+                    async for result in self.enricher.enrich(normalized, url_list):
+                        key = result.url if isinstance(result, LinkResult) else TEXT
+                        analysis.results[key] = result
+                        case = await self.forward_result(message, mod_channel, result)
+                        if case is not None:
+                            cluster.case_ids.append(case.id)
+                            analysis.case_ids[key] = case.id
+        finally:
+            cluster.finish()
+        elapsed = time.monotonic() - started
+        self.prescreen.record_pipeline(elapsed)
+        self.metrics.stage('pipeline').observe(elapsed)
 
-            if self.sent:
+    def attach_copy(self, message, cluster):
+        '''
+        Attaches a copy to the open cases of the message it duplicates, once that one has been checked. Returns False
+        if the copy has to be reviewed on its own because moderators have already decided all of those cases.
+        '''
+        cases = [self.cases.get(case_id) for case_id in cluster.case_ids]
+        # Clusters never span guilds, but a decision in one guild must never act on a message in another
+        cases = [case for case in cases if case is not None and case.message.guild.id == message.guild.id]
+        if not cases and cluster.case_ids:
+            return False
+        for case in cases:
+            # An edited copy comes back through here and must not be attached twice
+            if all(copy.id != message.id for copy in case.messages()):
+                case.duplicates.append(message)
+                self.record_case('duplicate_attached', case, copy_id=message.id, copy_author_id=message.author.id)
+                self.show_copies(case)
+        if cases:
+            self.metrics.counter('duplicates_attached', 'Copies attached to open cases').inc()
+        return True
+
+    def park_copy(self, message, cluster):
+        cluster.on_settled(lambda: self.resume_copy(message, cluster))
+
+    def resume_copy(self, message, cluster):
+        '''
+        Runs when the first message of the cluster a copy was parked on has been checked. If its cases were decided
+        in the meantime, the copy goes back on the queue and, with the cluster forgotten, starts a new one.
+        '''
+        if not self.attach_copy(message, cluster):
+            self.duplicates.forget(cluster)
+            self.ingest.put(message.guild.id, message)
+
+    async def prepare(self, message):
+        '''
+        prepare_text() for the message, on the process pool if there is one. 'prepare' times all of it, including
+        the trip to the pool; the steps inside are timed on their own.
+        '''
+        with self.metrics.stage('prepare').time():
+            normalized, url_list, sig, timings = await self.ingest.run_cpu(prepare_text, message.content)
+        for stage, seconds in timings.items():
+            self.metrics.stage(stage).observe(seconds)
+        return normalized, url_list, sig
+
+    async def recheck_message(self, message, mod_channel, analysis):
+        '''
+        Brings the cases of an edited message up to date. Links and text that are unchanged keep their earlier results;
+        the rest are looked up again and update the case for that part, or open one if it is newly flagged.
+        '''
+        async with analysis.lock:
+            # Discord also reports an edit when it adds link previews, which leaves the content as it was
+            if message.content == analysis.raw:
                 return
+            normalized, url_list, sig = await self.prepare(message)
+            analysis.raw, analysis.normalized = message.content, normalized
+            changed, removed = analysis.parts(url_list, normalized)
+            urls = [key for key in changed if key is not TEXT]
+            text = text_part(normalized, url_list) if TEXT in changed else None
+            with deadline_scope(MESSAGE_DEADLINE):
+                async for result in self.enricher.enrich_parts(urls, text):
+                    key = result.url if isinstance(result, LinkResult) else TEXT
+                    analysis.results[key] = result
+                    case = self.cases.get(analysis.case_ids.get(key))
+                    if case is not None:
+                        await self.update_case(case, message, mod_channel, result)
+                        continue
+                    case = await self.forward_result(message, mod_channel, result)
+                    if case is not None:
+                        analysis.case_ids[key] = case.id
+            for key in removed:
+                result = analysis.results.pop(key)
+                case = self.cases.get(analysis.case_ids.pop(key, None))
+                if case is not None:
+                    content, scores, fields = self.describe_result(message, result)
+                    fields.append(('Edited', 'The author has since removed this link from the message'))
+                    await self.edit_case_prompt(case, mod_channel, fields)
+
+    def shed_message(self, message, reason):
+        logger.warning('Monitored message %s was not checked: the ingest queue is full (%s)', message.id, reason)
+
+    def is_flagged(self, result):
+        msg_validity = result.rating
+        return not (msg_validity == "" or msg_validity == "True" or msg_validity == None)
+
+    async def forward_result(self, message, mod_channel, result):
+        if not self.is_flagged(result):
+            return None
+        author_points = self.ledger.get(message.guild.id, message.author.id)
+        content, scores, fields = self.describe_result(message, result)
+        fields.append(('Author history', self.author_history(message.author.id)))
+        case = self.cases.open(message, content, severity(scores, result.rating, author_points), scores=scores,
+                               rating=result.rating)
+        # Everything about the case goes to the mod channel as one embed on the category prompt
+        self.record_case('opened', case, source='pipeline', content=content, scores=scores)
+        case.title, case.fields = f'Forwarded message (case #{case.id})', fields
+        await self.ask_category(mod_channel, case, case_embed(case.title, case.fields))
+        self.metrics.counter('cases_forwarded', 'Cases forwarded to moderators', {'source': 'pipeline'}).inc()
+        return case
+
+    async def update_case(self, case, message, mod_channel, result):
+        author_points = self.ledger.get(message.guild.id, message.author.id)
+        content, scores, fields = self.describe_result(message, result)
+        self.cases.update(case, content, severity(scores, result.rating, author_points), scores=scores,
+                          rating=result.rating)
+        case.message = message
+        self.record_case('updated', case, content=content, scores=scores)
+        fields.append(('Edited', 'The author has edited the message; the above is for the latest version'))
+        await self.edit_case_prompt(case, mod_channel, fields)
+
+    async def edit_case_prompt(self, case, mod_channel, fields):
+        case.title, case.fields = f'Forwarded message (case #{case.id}, edited)', fields
+        embed, shown = self.render_case(case)
+        # The category prompt is the first one posted for a case and the one carrying its embed
+        try:
+            await self.output.edit(mod_channel, case.prompt_ids[0], embed)
+        except (IndexError, discord.HTTPException):
+            logger.warning('Could not update the prompt of case #%s', case.id, exc_info=True)
+            return
+        shown()
 
-            if str(payload.emoji) == '1️⃣':
-                self.level_one = "Harassment/Bullying"
-                await channel.send("Please select the type of Harassment/Bullying:")
-                options = ":regional_indicator_a: Bullying\n"
-                options += ":regional_indicator_b: Sexual Harassment\n"
-                options += ":regional_indicator_c: Threat\n"
-                options += ":regional_indicator_d: Cyberstalking\n"
-                options += ":regional_indicator_e: Hate Speech\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('🇦')
-                await options_msg.add_reaction('🇧')
-                await options_msg.add_reaction('🇨')
-                await options_msg.add_reaction('🇩')
-                await options_msg.add_reaction('🇪')
-            if str(payload.emoji) == '🇦':
-                self.level_two = "Bullying"
-            if str(payload.emoji) == '🇧':
-                self.level_two = "Sexual Harassment"
-            if str(payload.emoji) == '🇨':
-                self.level_two = "Threat"
-            if str(payload.emoji) == '🇩':
-                self.level_two = "Cyberstalking"
-            if str(payload.emoji) == '🇪':
-                self.level_two = "Hate Speech"
-
-            if str(payload.emoji) == '2️⃣':
-                self.level_one = "False/Misleading Information"
-                await channel.send("Please select the type of False/Misleading Information:")
-                options = ":regional_indicator_f: Public Health\n"
-                options += ":regional_indicator_g: Elections\n"
-                options += ":regional_indicator_h: Politics\n"
-                options += ":regional_indicator_i: Fake News/Other\n"
-                # options += ":regional_indicator_j: Other\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('🇫')
-                await options_msg.add_reaction('🇬')
-                await options_msg.add_reaction('🇭')
-                await options_msg.add_reaction('🇮')
-            if str(payload.emoji) == '🇫':
-                self.level_two = "Public Health"
-            if str(payload.emoji) == '🇬':
-                self.level_two = "Elections"
-            if str(payload.emoji) == '🇭':
-                self.level_two = "Politics"
-            if str(payload.emoji) == '🇮':
-                self.level_two = "Fake News/Other"
-
-            if str(payload.emoji) == '3️⃣':
-                self.level_one = "Violence/Graphic Imagery"
-                await channel.send("Please select the type of Violence/Graphic Imagery:")
-                options = ":regional_indicator_k: Terrorism\n"
-                options += ":regional_indicator_l: Gore\n"
-                options += ":regional_indicator_m: Self-Harm/Suicide\n"
-                options += ":regional_indicator_n: Sexually Explicit\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('🇰')
-                await options_msg.add_reaction('🇱')
-                await options_msg.add_reaction('🇲')
-                await options_msg.add_reaction('🇳')
-            if str(payload.emoji) == '🇰':
-                self.level_two = "Terrorism"
-            if str(payload.emoji) == '🇱':
-                self.level_two = "Gore"
-            if str(payload.emoji) == '🇲':
-                self.level_two = "Self-Harm/Suicide"
-            if str(payload.emoji) == '🇳':
-                self.level_two = "Sexually Explicit"
-
-            if str(payload.emoji) == '4️⃣':
-                self.level_one = "Spam"
-                await channel.send("Please select the type of Spam:")
-                options = ":regional_indicator_o: Impersonation\n"
-                options += ":regional_indicator_p: Fraud/Phishing\n"
-                options += ":regional_indicator_q: Solicitation\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('🇴')
-                await options_msg.add_reaction('🇵')
-                await options_msg.add_reaction('🇶')
-
-            if str(payload.emoji) == '🇴':
-                self.level_two = "Impersonation"
-            if str(payload.emoji) == '🇵':
-                self.level_two = "Fraud/Phishing"
-            if str(payload.emoji) == '🇶':
-                self.level_two = "Solicitation"
-
-            if str(payload.emoji) == '5️⃣':
-                self.level_one = "Other"
-                await channel.send("Please select the closest category to Other:")
-                options = ":regional_indicator_r: Harm to Minors\n"
-                options += ":regional_indicator_s: Copyright Violation\n"
-                options += ":regional_indicator_t: Animal Cruelty\n"
-                options += ":regional_indicator_u: Dangerous Organizations\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('🇷')
-                await options_msg.add_reaction('🇸')
-                await options_msg.add_reaction('🇹')
-                await options_msg.add_reaction('🇺')
-            if str(payload.emoji) == '🇷':
-                self.level_two = "Harm to Minors"
-            if str(payload.emoji) == '🇸':
-                self.level_two = "Copyright Violation"
-            if str(payload.emoji) == '🇹':
-                self.level_two = "Animal Cruelty"
-            if str(payload.emoji) == '🇺':
-                self.level_two = "Dangerous Organizations"
-
-            false_info = ['🇫', '🇬', '🇭', '🇮', '🇯']
-            if str(payload.emoji) in false_info:
-                await channel.send("Please choose the option that best describes "
-                                   "the type of false information you are reporting:")
-                options = ":arrow_left: Purposefully falsified information for " \
-                          "obvious political, financial, or other gains.\n"
-                options += ":arrow_right: False information due to suspected hacking, or unintentional " \
-                           "false information\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('⬅️')
-                await options_msg.add_reaction('➡️')
-            if str(payload.emoji) == '⬅️':
-                self.level_three = "Purposefully falsified information for " \
-                          "obvious political, financial, or other gains."
-            if str(payload.emoji) == '➡️':
-                self.level_three = "False information due to suspected hacking, or unintentional false information\n"
-
-            targeted = ['🇦', '🇧', '🇨', '🇩', '🇪', '🇰', '🇱', '🇲', '🇳', '🇴', '🇵', '🇶', '🇷', '🇸', '🇹', '🇺', '⬅️','➡️']
-            if str(payload.emoji) in targeted:
-                await channel.send("Would you like to provide more details on how the content violates the community "
-                                   "guidelines?")
-                options = ":white_check_mark: Yes\n"
-                options += ":x: No\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('✅')
-                await options_msg.add_reaction('❌')
-
-            if str(payload.emoji) == '✅':
-                await channel.send("Please provide more details on how the content violates the community guidelines.")
-                await client.wait_for('message', check=None)
-
-            if str(payload.emoji) == '❌':
-                self.level_three = "N/A"
-
-            if str(payload.emoji) == '❌' or str(payload.emoji) == '✅':
-                await channel.send("Would you like to block this user?")
-                options = ":no_entry_sign: Yes\n"
-                options += ":o: No\n"
-                options_msg = await channel.send(options)
-                await options_msg.add_reaction('🚫')
-                await options_msg.add_reaction('⭕')
-
-            if str(payload.emoji) == '🚫':
-                await channel.send("The user has been blocked.")
-            if str(payload.emoji) == '⭕' or str(payload.emoji) == '🚫':
-                await channel.send("We appreciate you taking the time to help us uphold the community guidelines. "
-                                   "Our team will take the appropriate action, which may result in the "
-                                   "content or account removal. To submit another report, reply with `report`.")
-
-                for guild in self.guilds:
-                    for channel in guild.text_channels:
-                        if channel.name == f'group-{self.group_num}-mod':
-                            self.curr_message = self.message_object
-                            self.messages_queue.append((self.message_object, self.message))
-                            print("REACHED self.message")
-                            await channel.send(f'Forwarded message (from user report):\nOriginal author: '
-                                               f'{self.message_author}\nOriginal content: "'
-                                               f'{self.message}"\nPrimary Abuse Type: "'
-                                               f'{self.level_one}"\nCategory of Abuse Type: "'
-                                               f'{self.level_two}"\nDisinformation Type: "'
-                                               f'{self.level_three}"\nMore Details from User: "'
-                                               f'{self.more_details}"')
-                            self.sent = True
-                            # self.reports[payload.user_id].set_complete()
-                            self.reports.pop(payload.user_id)
-                            self.more_details = ""
-                            self.level_one = ""
-                            self.level_two = ""
-                            self.level_three = ""
-                            self.sent = False
-                            self.message = ""
-                            self.message_author = ""
-                            self.message_object = None
+    def render_case(self, case, title=None, fields=None):
+        '''
+        The embed of a case's category prompt, with the copies attached to it so far, and a function to call once it
+        is up, which lets decisions on the case act on those copies.
+        '''
+        title = title or case.title or f'Forwarded message (case #{case.id})'
+        fields = list(case.fields if fields is None else fields)
+        count = len(case.duplicates)
+        if count:
+            authors = ', '.join(dict.fromkeys(copy.author.name for copy in case.duplicates))
+            fields.append(('Copies', f'{count} near-identical {"copy" if count == 1 else "copies"} of this message '
+                                     f'by {authors}. The decision on this case applies to them too.'))
 
+        def shown():
+            case.copies_shown = max(case.copies_shown, count)
+        return case_embed(title, fields), shown
+
+    def show_copies(self, case):
+        mod_channel = self.channels.mod_channel(case.message.guild.id)
+        if mod_channel is None or not case.prompt_ids:
+            return
+        # A case decided in the meantime keeps the embed the moderator decided on
+        self.output.update(mod_channel, case.prompt_ids[0],
+                           lambda: self.render_case(case) if self.cases.get(case.id) is case else None)
+
+    def describe_result(self, message, result):
+        '''
+        What a case about one pipeline result covers: the flagged content, the Perspective scores if any, and the
+        fields of its embed.
+        '''
+        msg_validity = result.rating
+        if isinstance(result, LinkResult):
+            if msg_validity == UNSCORED:
+                fact_check = f'[{UNSCORED}] The content of this link could not be fact checked, please review it manually'
+            elif not self.is_flagged(result):
+                fact_check = 'The content of this link is no longer fact checked as being potentially false'
+            else:
+                fact_check = 'The content of this link has been fact checked as being potentially false'
+            fields = [('Author', message.author.name), ('Link', result.url), ('Link title', result.title),
+                      ('Link summary', result.summary), ('Fact check', fact_check)]
+            return result.url, None, fields
+        if msg_validity == UNSCORED:
+            fact_check = f'[{UNSCORED}] This message could not be fact checked, please review it manually'
+        elif not self.is_flagged(result):
+            fact_check = 'This message is no longer fact checked as being potentially false'
+        else:
+            fact_check = 'This message has been fact checked as being potentially false'
+        if result.scores is None:
+            scores = f'[{UNSCORED}] Perspective scores are unavailable'
+        else:
+            scores = self.code_format(json.dumps(result.scores, indent=2))
+        fields = [('Author', message.author.name), ('Message', message.content), ('Fact check', fact_check),
+                  ('Perspective scores', scores)]
+        return result.text, result.scores, fields
+
+    async def on_raw_reaction_add(self, payload):
+        # Our own reactions, and reactions on messages that aren't one of our prompts, are dropped before any API call
+        if payload.user_id == self.user.id:
+            return
+        with self.metrics.stage('reaction').time():
+            await self.reactions.dispatch(payload)
+
+    async def on_error(self, event_method, *args, **kwargs):
+        self.metrics.counter('event_errors', 'Event handlers that raised', {'event': event_method}).inc()
+        await super().on_error(event_method, *args, **kwargs)
+
+    async def resolve_channel(self, channel_id):
+        return self.get_channel(channel_id) or await self.fetch_channel(channel_id)
+
+    async def prompt(self, channel, text, handlers, embed=None):
+        '''
+        Posts a question, registers what each of its reactions should do and seeds the reactions in the background.
+        '''
+        question = await self.output.send(channel, text, embed)
+        self.reactions.register(question.id, handlers)
+        self.output.seed(question, handlers)
+        return question
+
+    # Moderator flow, driven by reactions on the prompts posted in the mod channel
+
+    async def mod_prompt(self, mod_channel, case, text, handlers, embed=None):
+        question = await self.prompt(mod_channel, text, handlers, embed)
+        self.cases.attach_prompt(case, question.id)
+
+    def record_case(self, event, case, **fields):
+        '''
+        Files something that happened to a case in the audit log and the case log.
+        '''
+        fields = dict(case_fields(case), **fields)
+        self.audit.append(event, fields)
+        log_case(event, fields)
+
+    def author_history(self, author_id):
+        '''
+        How earlier cases about an author went, from the audit log, for the embed of a new case about them.
+        '''
+        opened = 0
+        outcomes = Counter()
+        for record in self.audit.by_author(author_id):
+            if record.get('author_id') != author_id:
+                continue
+            if record['event'] == 'opened':
+                opened += 1
+            elif record['event'] == 'closed':
+                outcomes[record['outcome']] += 1
+        if not opened:
+            return None
+        history = f'{opened} earlier case{"s" if opened != 1 else ""}'
+        if outcomes:
+            history += ': ' + ', '.join(f'{count} {outcome}' for outcome, count in outcomes.most_common())
+        return history
+
+    def close_case(self, case, outcome, **fields):
+        self.cases.close(case)
+        self.record_case('closed', case, outcome=outcome, **fields)
+        for prompt_id in case.prompt_ids:
+            self.reactions.forget(prompt_id)
+
+    def claimed_case(self, payload):
+        '''
+        The case a mod-channel prompt belongs to, claimed for the moderator who reacted, or None if the case is closed
+        or another moderator is working on it. A moderator who has let their claim lapse loses the case here.
+        '''
+        case = self.cases.by_prompt(payload.message_id)
+        if case is None:
+            return None
+        previous = case.claimed_by
+        if not self.cases.claim(case, payload.user_id):
+            return None
+        if previous != payload.user_id:
+            self.record_case('claimed', case, previous_moderator_id=previous)
+        return case
+
+    async def act_on_messages(self, case, act):
+        '''
+        Awaits act(message) for the message of a case and every copy of it shown on the case prompt. A copy that can't
+        be acted on, usually because its author has deleted it, is skipped, so the decision still goes through for the
+        rest.
+        '''
+        for message in case.shown_messages():
+            try:
+                await act(message)
+            except discord.NotFound:
+                logger.info('Message %s of case #%s was deleted before the decision on it', message.id, case.id)
+            except discord.HTTPException:
+                logger.warning('Could not act on message %s of case #%s', message.id, case.id, exc_info=True)
+
+    async def ask_category(self, mod_channel, case, embed=None):
+        await self.mod_prompt(mod_channel, case, f'Does the message in case #{case.id} fall into any of the following categories? \n 🔴 Harassment/Bullying \n 🟠 False or Misleading Information \n 🟡 Violence/Graphic Imagery \n 🟢 Spam \n 🔵 Other Harmful Content \n',
+                              {emoji: self.choose_mod_category for emoji in MOD_CATEGORIES}, embed)
+
+    async def choose_mod_category(self, payload):
+        case = self.claimed_case(payload)
+        if case is None:
+            return False
+        mod_channel = await self.resolve_channel(payload.channel_id)
+        emoji = str(payload.emoji)
+        await self.act_on_messages(case, lambda message: message.add_reaction(emoji))
+        team = MOD_CATEGORIES[emoji]
+        if team is None:
+            await self.mod_prompt(mod_channel, case, f'Does the message "{case.content}" contain false or misleading information? \n ✅ Yes \n ❌ No',
+                                  {'✅': self.confirm_false_information, '❌': self.reject_false_information})
+            return
+        self.output.notice(mod_channel, f'Thank you! We have tagged this message and will inform the {team}.')
+        self.close_case(case, 'referred', category=emoji, team=team)
+
+    async def confirm_false_information(self, payload):
+        case = self.claimed_case(payload)
+        if case is None:
+            return False
+        mod_channel = await self.resolve_channel(payload.channel_id)
+        await self.mod_prompt(mod_channel, case, f'Is the message "{case.content}": \n ⬅️ Fabricated Content / Disinformation, or \n ➡️ Satire / Parody',
+                              {'⬅️': self.confirm_disinformation, '➡️': self.mark_satire})
+
+    async def reject_false_information(self, payload):
+        case = self.claimed_case(payload)
+        if case is None:
+            return False
+        mod_channel = await self.resolve_channel(payload.channel_id)
+        self.output.notice(mod_channel, 'Thank you!')
+        self.close_case(case, 'not_false_information')
+
+    async def mark_satire(self, payload):
+        case = self.claimed_case(payload)
+        if case is None:
+            return False
+        mod_channel = await self.resolve_channel(payload.channel_id)
+        self.output.notice(mod_channel, 'Thank you! We will take action if the issue becomes more serious.')
+        self.close_case(case, 'satire')
+
+    async def confirm_disinformation(self, payload):
+        case = self.claimed_case(payload)
+        if case is None:
+            return False
+        mod_channel = await self.resolve_channel(payload.channel_id)
+        await self.mod_prompt(mod_channel, case, f'Please rate the harm of the message "{case.content}": \n 1️⃣ (Immediate Harm) \n 2️⃣ (Moderate Harm) \n 3️⃣ (Low Harm)',
+                              {emoji: self.rate_harm for emoji in HARM_LEVELS})
+
+    async def rate_harm(self, payload):
+        case = self.claimed_case(payload)
+        if case is None:
+            return False
+        mod_channel = await self.resolve_channel(payload.channel_id)
+        points, action = HARM_LEVELS[str(payload.emoji)]
+        # The decision covers every copy of the message the moderator could see on the case prompt
+        messages = case.shown_messages()
+        if action == 'delete':
+            await self.act_on_messages(case, lambda message: message.delete())
+            self.output.notice(mod_channel, 'Thank you! We have taken down the message.')
+        elif action == 'flag':
+            await self.act_on_messages(case, lambda message: message.add_reaction('🚩'))
+            self.output.notice(mod_channel, 'Thank you! We have flagged the message.')
+        else:
+            self.output.notice(mod_channel, 'Thank you! We will take action if the issue becomes more serious.')
+        self.close_case(case, 'disinformation', harm=str(payload.emoji), action=action, points=points,
+                        message_ids=[message.id for message in messages])
+        guild_id = case.message.guild.id
+        for author_id in dict.fromkeys(message.author.id for message in messages):
+            balance = self.ledger.add(guild_id, author_id, points)
+            if balance > THRESHOLD_POINTS:
+                self.ledger.record_enforcement(guild_id, author_id, 'ban', balance)
+                self.record_case('author_banned', case, banned_author_id=author_id, points=balance)
+                self.output.notice(mod_channel, 'The author of the message has been banned because they have exceeded the threshold of allowed points for reports against them.')
+
+    # User report flow, driven by reactions on the prompts sent over DM
+
+    async def choose_abuse_type(self, payload):
+        report = self.reports.get(payload.user_id)
+        if report is None or report.sent:
+            return
+        channel = await self.resolve_channel(payload.channel_id)
+        report.level_one, question, categories = ABUSE_TYPES[str(payload.emoji)]
+        options = "".join(f":regional_indicator_{letter}: {category}\n" for letter, category in categories)
+        await self.prompt(channel, question + "\n" + options, {regional_indicator(letter): self.choose_abuse_category
+                                             for letter, category in categories})
+
+    async def choose_abuse_category(self, payload):
+        report = self.reports.get(payload.user_id)
+        if report is None or report.sent:
+            return
+        channel = await self.resolve_channel(payload.channel_id)
+        categories = dict(ABUSE_TYPES_BY_NAME[report.level_one][2])
+        report.level_two = categories[LETTERS_BY_INDICATOR[str(payload.emoji)]]
+        if report.level_one == FALSE_INFORMATION:
+            options = "Please choose the option that best describes the type of false information you are reporting:\n"
+            options += "".join(text + "\n" for text, level_three in FALSE_INFO_TYPES.values())
+            await self.prompt(channel, options, {emoji: self.choose_false_info_type for emoji in FALSE_INFO_TYPES})
+        else:
+            await self.ask_more_details(channel)
+
+    async def choose_false_info_type(self, payload):
+        report = self.reports.get(payload.user_id)
+        if report is None or report.sent:
+            return
+        channel = await self.resolve_channel(payload.channel_id)
+        report.level_three = FALSE_INFO_TYPES[str(payload.emoji)][1]
+        await self.ask_more_details(channel)
+
+    async def ask_more_details(self, channel):
+        options = "Would you like to provide more details on how the content violates the community guidelines?\n"
+        options += ":white_check_mark: Yes\n"
+        options += ":x: No\n"
+        await self.prompt(channel, options, {'✅': self.choose_more_details, '❌': self.choose_more_details})
+
+    async def choose_more_details(self, payload):
+        report = self.reports.get(payload.user_id)
+        if report is None or report.sent:
+            return
+        channel = await self.resolve_channel(payload.channel_id)
+        if str(payload.emoji) == '✅':
+            # The block question waits for the details, so the report can't be sent without them
+            report.awaiting_details = True
+            await self.output.send(channel, "Please provide more details on how the content violates the community "
+                                            "guidelines.")
+            return
+        report.level_three = "N/A"
+        await self.ask_block(channel)
+
+    async def ask_block(self, channel, details=None):
+        options = "Would you like to block this user?\n"
+        options += ":no_entry_sign: Yes\n"
+        options += ":o: No\n"
+        if details is not None:
+            # The details are echoed back with the question, cut short if both wouldn't fit in one message
+            echo = "We have received the following response: {}\n\n"
+            options = echo.format(truncate(details, MESSAGE_LIMIT - len(echo.format('')) - len(options))) + options
+        await self.prompt(channel, options, {'🚫': self.finish_report, '⭕': self.finish_report})
+
+    async def finish_report(self, payload):
+        report = self.reports.get(payload.user_id)
+        if report is None or report.sent:
+            return
+        channel = await self.resolve_channel(payload.channel_id)
+        reply = "The user has been blocked.\n" if str(payload.emoji) == '🚫' else ""
+        reply += ("We appreciate you taking the time to help us uphold the community guidelines. "
+                  "Our team will take the appropriate action, which may result in the "
+                  "content or account removal. To submit another report, reply with `report`.")
+        await self.output.send(channel, reply)
+
+        reported = report.message_object
+        report.sent = True
+        fields = [('Original author', report.message_author), ('Original content', report.message),
+                  ('Primary Abuse Type', report.level_one), ('Category of Abuse Type', report.level_two),
+                  ('Disinformation Type', report.level_three), ('More Details from User', report.more_details)]
+        self.audit.append('report_submitted', reporter_id=payload.user_id, guild_id=reported.guild.id,
+                          channel_id=reported.channel.id, message_id=reported.id, author_id=reported.author.id,
+                          content=report.message, abuse_type=report.level_one, category=report.level_two,
+                          disinformation_type=report.level_three, details=report.more_details,
+                          blocked=str(payload.emoji) == '🚫')
+        if self.is_remote_guild(reported.guild.id):
+            # Reactions on the case prompt will reach the shard that owns the guild, so that shard opens the case
+            self.shared.hand_off(shard_for(reported.guild.id, self.shard_count), {
+                'channel_id': reported.channel.id, 'message_id': reported.id, 'content': report.message,
+                'fields': fields})
+        else:
+            await self.forward_report(reported, report.message, fields)
+        self.reports.pop(payload.user_id)
+
+    async def forward_report(self, reported, content, fields):
+        author_points = self.ledger.get(reported.guild.id, reported.author.id)
+        fields = fields + [('Author history', self.author_history(reported.author.id))]
+        case = self.cases.open(reported, content, severity(author_points=author_points, user_report=True))
+        case.title, case.fields = f'Forwarded message (case #{case.id}, from user report)', fields
+        self.record_case('opened', case, source='user_report', content=content)
+        self.metrics.counter('cases_forwarded', 'Cases forwarded to moderators', {'source': 'user_report'}).inc()
+        # The report goes to the mod channel of the guild the reported message was posted in
+        mod_channel = self.channels.mod_channel(reported.guild.id)
+        if mod_channel is None:
+            logger.warning('No mod channel in guild %s for case #%s', reported.guild.id, case.id)
+        else:
+            await self.ask_category(mod_channel, case, case_embed(case.title, case.fields))
+
+    # Warm restarts
+
+    def capture_state(self):
+        '''
+        Everything a restart would otherwise lose, for the snapshot: open cases, the prompts still waiting for
+        reactions and the reports users are in the middle of.
+        '''
+        now, monotonic = time.time(), time.monotonic()
+        cases = [{'id': case.id, 'message': message_ref(case.message), 'content': case.content,
+                  'severity': case.severity, 'scores': case.scores, 'rating': case.rating,
+                  'prompt_ids': list(case.prompt_ids), 'claimed_by': case.claimed_by, 'claimed_at': case.claimed_at,
+                  'created_at': case.created_at, 'title': case.title, 'fields': case.fields,
+                  'duplicates': [message_ref(message) for message in case.duplicates],
+                  'copies_shown': case.copies_shown} for case in self.cases]
+        # Prompts of open cases are always kept. Other prompts belong to user reports, and only the newest of those
+        # can still be answered before their report goes idle
+        case_prompts = {prompt_id for case in self.cases for prompt_id in case.prompt_ids}
+        prompts = []
+        others = 0
+        for prompt_id, (handlers, once) in reversed(self.reactions.prompts.items()):
+            if prompt_id not in case_prompts:
+                if others >= SNAPSHOT_PROMPTS:
+                    continue
+                others += 1
+            # Every handler is one of our own methods, which is stored by name
+            names = {emoji: handler.__name__ for emoji, handler in handlers.items()
+                     if getattr(handler, '__self__', None) is self}
+            if len(names) == len(handlers):
+                prompts.append([prompt_id, names, once])
+        prompts.reverse()
+        reports = [{'user_id': user_id, 'state': report.state.name, 'message': report.message,
+                    'message_author': report.message_author,
+                    'message_object': message_ref(report.message_object) if report.message_object else None,
+                    'level_one': report.level_one, 'level_two': report.level_two, 'level_three': report.level_three,
+                    'more_details': report.more_details, 'awaiting_details': report.awaiting_details,
+                    'sent': report.sent, 'last_active_at': round(now - (monotonic - report.last_active))}
+                   for user_id, report in self.reports.reports.items()]
+        return {'next_case_id': self.cases.next_id, 'cases': cases, 'prompts': prompts, 'reports': reports}
+
+    def restore_state(self, state):
+        '''
+        Puts back what capture_state() saved. Messages are restored from what the snapshot kept of them, without
+        fetching anything, so this takes milliseconds.
+        '''
+        if state is None:
+            return
+        started = time.perf_counter()
+        self.cases.next_id = max(self.cases.next_id, state['next_case_id'])
+        for data in state['cases']:
+            case = self.cases.open(restore_message(self, data['message']), data['content'], data['severity'],
+                                   data['scores'], data['rating'], case_id=data['id'])
+            if data['claimed_by'] is not None:
+                self.cases.claim(case, data['claimed_by'], data.get('claimed_at'))
+            case.created_at = data['created_at']
+            case.duplicates = [restore_message(self, ref) for ref in data['duplicates']]
+            case.title, case.copies_shown = data.get('title'), data.get('copies_shown', 0)
+            case.fields = [tuple(field) for field in data.get('fields', [])]
+            for prompt_id in data['prompt_ids']:
+                self.cases.attach_prompt(case, prompt_id)
+        for prompt_id, names, once in state['prompts']:
+            handlers = {emoji: getattr(self, name, None) for emoji, name in names.items()}
+            if all(handlers.values()):
+                self.reactions.register(prompt_id, handlers, once)
+        now, monotonic = time.time(), time.monotonic()
+        for data in state['reports']:
+            report = Report(self)
+            for name in ('message', 'message_author', 'level_one', 'level_two', 'level_three', 'more_details',
+                         'awaiting_details', 'sent'):
+                setattr(report, name, data[name])
+            report.state = State[data['state']]
+            if data['message_object'] is not None:
+                report.message_object = restore_message(self, data['message_object'])
+            report.last_active = monotonic - (now - data['last_active_at'])
+            self.reports.reports[data['user_id']] = report
+        self.reports.evict_idle()
+        logger.info('Restored %s cases, %s prompts and %s reports from the snapshot in %.1f ms', len(state['cases']),
+                    len(state['prompts']), len(self.reports), (time.perf_counter() - started) * 1000)
+
+    # Sharding
+
+    def is_remote_guild(self, guild_id):
+        '''
+        Whether the guild belongs to another shard process. Its channels can still be reached over REST, but its
+        events, and so the reactions on any prompt posted there, go to that shard.
+        '''
+        return self.shard_count is not None and shard_for(guild_id, self.shard_count) != self.shard_id
+
+    async def fetch_remote_channel(self, channel_id):
+        try:
+            return await self.fetch_channel(channel_id)
+        except discord.HTTPException:
+            return None
+
+    async def receive_handoffs(self):
+        '''
+        Background task that opens the cases for user reports made on another shard about messages in our guilds.
+        '''
+        while True:
+            await asyncio.sleep(HANDOFF_INTERVAL)
+            try:
+                handoffs = await self.shared.take_handoffs(self.shard_id)
+            except Exception:
+                logger.exception('Could not read reports handed off by other shards')
+                continue
+            for handoff in handoffs:
+                channel = self.get_channel(handoff['channel_id'])
+                reported = None
+                if channel is not None:
+                    try:
+                        reported = await channel.fetch_message(handoff['message_id'])
+                    except discord.HTTPException:
+                        pass
+                if reported is None:
+                    logger.warning('Reported message %s is gone, dropping its report', handoff['message_id'])
+                    continue
+                await self.forward_report(reported, handoff['content'], [tuple(field) for field in handoff['fields']])
 
     async def on_raw_message_edit(self, payload):
+        # The event carries the edited message, so there is nothing to fetch
+        new_msg = payload.message
+        if new_msg.author.id == self.user.id:
+            return
         if not payload.guild_id:  # this is for DMs
-            channel = discord.Client.get_channel(self, payload.channel_id)
-            new_msg = await channel.fetch_message(payload.message_id)
-            if not self.sent:
+            channel = new_msg.channel
+            report = self.reports.get(new_msg.author.id)
+            if report is not None and not report.sent:
                 await channel.send("We have received your edited response: " + new_msg.content)
-                self.more_details = new_msg.content
+                report.more_details = new_msg.content
             else:
                 await channel.send("Sorry, we cannot process your edited response because the report has already "
                                    "been sent to the moderators. Please submit another report with your "
                                    "edited response.")
-        else:
-            channel = discord.Client.get_channel(self, payload.channel_id)
-            after = await channel.fetch_message(payload.message_id)
-            await self.handle_channel_message(after)
+        elif self.channels.role(new_msg.channel) == MONITORED:
+            # Only the latest version is checked, once the author has stopped editing
+            self.edits.edited(new_msg)
 
 
-    def eval_text(self, message):
+    async def eval_text(self, message):
         '''
         Given a message, forwards the message to Perspective and returns a dictionary of scores.
         '''
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
-
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-        data_dict = {
-            'comment': {'text': message.content},
-            'languages': ['en'],
-            'requestedAttributes': {
-                                    'SEVERE_TOXICITY': {}, 'PROFANITY': {},
-                                    'IDENTITY_ATTACK': {}, 'THREAT': {},
-                                    'TOXICITY': {}, 'FLIRTATION': {}
-                                },
-            'doNotStore': True
-        }
-        response = requests.post(url, data=json.dumps(data_dict))
-        response_dict = response.json()
+        return await self.apis.eval_text(message.content)
 
-        scores = {}
-        for attr in response_dict["attributeScores"]:
-            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
-
-        return scores
+    async def close(self):
+        if self.handoffs is not None:
+            self.handoffs.cancel()
+        self.edits.close()
+        logger.info('Edit stats: %s', self.edits.stats())
+        await self.ingest.close()
+        logger.info('Ingest stats: %s', self.ingest.stats())
+        await self.metrics.close()
+        await self.output.close()
+        logger.info('Output stats: %s', self.output.stats())
+        await self.snapshots.close()
+        self.apis.save()
+        logger.info('API cache stats: %s', self.apis.stats())
+        self.claims.close()
+        logger.info('Claim matching stats: %s', self.claim_apis.stats())
+        logger.info('Pre-screening stats: %s', self.prescreen.stats())
+        await self.ledger.close()
+        await self.audit.close()
+        if self.shared is not None:
+            self.shared.close()
+        await self.api_http.close()
+        await super().close()
 
     def code_format(self, text):
         return "```" + text + "```"
 
 
-client = ModBot(perspective_key)
-client.run(discord_token)
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description='Run the moderation bot, or one shard of it (see shards.py).')
+    parser.add_argument('--shard-id', type=int)
+    parser.add_argument('--shard-count', type=int)
+    args = parser.parse_args()
+    if (args.shard_id is None) != (args.shard_count is None):
+        parser.error('--shard-id and --shard-count go together')
+
+    if args.shard_id is None:
+        log_writer = setup_logging()
+    else:
+        log_writer = setup_logging(f'discord.{args.shard_id}.log', f'cases.{args.shard_id}.log')
+    try:
+        tokens = load_tokens()
+        client = ModBot(tokens, shard_id=args.shard_id, shard_count=args.shard_count, log_writer=log_writer)
+        # discord.py would otherwise add its own console handler, which writes on the event loop
+        client.run(tokens['discord'], log_handler=None)
+    finally:
+        log_writer.stop()
+
+
+if __name__ == '__main__':
+    main()
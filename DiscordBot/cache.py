@@ -0,0 +1,190 @@
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from singleflight import SingleFlight
+
+# Query parameters that only identify where a click came from and never change the page being linked to
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid', 'ref', 'ref_src', 'si',
+                   '_ga', 'yclid', 'spm'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# How long each kind of result stays valid, in seconds
+TITLE_TTL = 24 * 60 * 60
+SUMMARY_TTL = 24 * 60 * 60
+FACT_CHECK_TTL = 6 * 60 * 60
+PERSPECTIVE_TTL = 60 * 60
+CACHE_SIZE = 10000
+
+_MISSING = object()
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_url(url):
+    '''
+    Canonical form of a URL for use as a cache key: scheme and host are lowercased, default ports, fragments and
+    tracking parameters are dropped and the remaining query parameters are sorted.
+    '''
+    if '://' not in url:
+        url = 'http://' + url
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        # A port that isn't a number or a bracketed host that isn't closed; the URL as written is still a usable key
+        return url.lower()
+    scheme = parts.scheme.lower()
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host += f':{port}'
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k.lower() not in TRACKING_PARAMS and not k.lower().startswith('utm_')]
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ''))
+
+
+def normalize_text(text):
+    return _WHITESPACE.sub(' ', text).strip().casefold()
+
+
+class TTLCache:
+    '''
+    Bounded mapping where every entry expires after a fixed time to live. When full, the least recently used entry is
+    evicted. Expiry times are wall-clock so that entries loaded from disk keep their original deadline.
+    '''
+
+    def __init__(self, ttl, maxsize=CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, expires_at=None):
+        self.entries[key] = (expires_at if expires_at is not None else time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def dump(self):
+        now = time.time()
+        return [[key, expires_at, value] for key, (expires_at, value) in self.entries.items() if expires_at > now]
+
+    def load(self, rows):
+        now = time.time()
+        for key, expires_at, value in rows:
+            if expires_at > now:
+                self.set(key, value, expires_at)
+
+
+class CachedApis:
+    '''
+    Drop-in replacement for ExternalApis that answers repeated lookups from per-API TTL/LRU caches. URLs are keyed on
+    their normalized form and text on its case- and whitespace-folded form. Concurrent misses for the same key share a
+    single outgoing call. If a path is given the caches are loaded from it on creation and written back by save().
+    With a shared store (shards.SharedState) a local miss is looked up there before calling out, and every new result
+    is written to it, so shard processes don't each pay for the same lookup.
+    '''
+
+    def __init__(self, apis, path=None, maxsize=CACHE_SIZE, shared=None):
+        self.apis = apis
+        self.path = path
+        self.shared = shared
+        self.caches = {
+            'extract_title': TTLCache(TITLE_TTL, maxsize),
+            'summarize': TTLCache(SUMMARY_TTL, maxsize),
+            'fact_check': TTLCache(FACT_CHECK_TTL, maxsize),
+            'eval_text': TTLCache(PERSPECTIVE_TTL, maxsize),
+        }
+        self.flights = SingleFlight()
+        self.saved_misses = 0  # misses counted when the caches were last snapshotted
+        if path and os.path.isfile(path):
+            self.load()
+
+    async def _cached(self, name, key, fn, arg):
+        cache = self.caches[name]
+        value = cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = await self.flights.do((name, key), self._fill, name, cache, key, fn, arg)
+        return value
+
+    async def _fill(self, name, cache, key, fn, arg):
+        if self.shared is not None:
+            entry = self.shared.cache_get(name, key)
+            if entry is not None:
+                cache.set(key, entry[1], entry[0])
+                return entry[1]
+        value = await fn(arg)
+        cache.set(key, value)
+        if self.shared is not None:
+            self.shared.cache_put(name, key, cache.entries[key][0], value)
+        return value
+
+    async def extract_title(self, input_url):
+        return await self._cached('extract_title', normalize_url(input_url), self.apis.extract_title, input_url)
+
+    async def summarize(self, input_url):
+        return await self._cached('summarize', normalize_url(input_url), self.apis.summarize, input_url)
+
+    async def fact_check(self, input_claim):
+        return await self._cached('fact_check', normalize_text(input_claim), self.apis.fact_check, input_claim)
+
+    async def eval_text(self, text):
+        return await self._cached('eval_text', normalize_text(text), self.apis.eval_text, text)
+
+    def stats(self):
+        stats = {name: {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache)}
+                 for name, cache in self.caches.items()}
+        stats['coalesced'] = self.flights.stats()
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            stored = json.load(f)
+        for name, rows in stored.items():
+            if name in self.caches:
+                self.caches[name].load(rows)
+
+    def snapshot(self):
+        '''
+        The caches as save() writes them, or None if nothing new can have been stored since the last snapshot. Every
+        stored result follows a miss, so the miss counts tell.
+        '''
+        misses = sum(cache.misses for cache in self.caches.values())
+        if not self.path or misses == self.saved_misses:
+            return None
+        self.saved_misses = misses
+        return {name: cache.dump() for name, cache in self.caches.items()}
+
+    def save(self, stored=None):
+        '''
+        Writes the caches, or a snapshot() of them taken earlier, to the cache file.
+        '''
+        if not self.path:
+            return
+        if stored is None:
+            stored = {name: cache.dump() for name, cache in self.caches.items()}
+        # Write to a temporary file and swap it in so a crash mid-write never leaves a truncated cache behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, self.path)
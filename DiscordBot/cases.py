@@ -0,0 +1,195 @@
+import heapq
+import time
+
+# How much each ClaimBuster truth rating adds to a case's severity; anything not listed counts as UNRATED_SEVERITY
+RATING_SEVERITY = {
+    'Pants on Fire!': 1.0,
+    'False': 0.9,
+    'Mostly False': 0.7,
+    'Half True': 0.4,
+    'Mostly True': 0.1,
+}
+UNRATED_SEVERITY = 0.3
+# User reports have no scores of their own, but a person took the time to flag the message
+USER_REPORT_SEVERITY = 0.8
+# Points at which an author's history stops adding to the severity of new cases
+POINTS_SATURATION = 50
+# A moderator who hasn't acted on a claimed case for this many seconds loses it to the next moderator who does, and it
+# goes back into the queue for 'next'
+CLAIM_TIMEOUT = 30 * 60
+
+
+def severity(scores=None, rating=None, author_points=0, user_report=False):
+    '''
+    Single number used to order the case backlog: the worst Perspective score, how false the fact check found the
+    message and how many points its author already has.
+    '''
+    value = max(scores.values()) if scores else 0.0
+    if user_report:
+        value += USER_REPORT_SEVERITY
+    elif rating is not None:
+        value += RATING_SEVERITY.get(rating, UNRATED_SEVERITY)
+    value += 0.5 * min(author_points, POINTS_SATURATION) / POINTS_SATURATION
+    return value
+
+
+class Case:
+    '''
+    One forwarded message under review, along with every mod-channel prompt that was posted about it.
+    '''
+    __slots__ = ('id', 'message', 'content', 'author_id', 'severity', 'scores', 'rating', 'prompt_ids', 'claimed_by',
+                 'claimed_at', 'created_at', 'duplicates', 'title', 'fields', 'copies_shown')
+
+    def __init__(self, case_id, message, content, severity, scores=None, rating=None):
+        self.id = case_id
+        self.message = message  # the discord.Message under review
+        self.content = content  # the part of it that was flagged, e.g. one link
+        self.author_id = message.author.id if message is not None else None
+        self.severity = severity
+        self.scores = scores
+        self.rating = rating
+        self.prompt_ids = []
+        self.claimed_by = None  # ID of the moderator working on the case
+        self.claimed_at = None  # when they last acted on it
+        self.created_at = time.time()
+        self.duplicates = []  # near-identical copies of the message that were attached instead of forwarded again
+        self.title = None  # title and (name, value) fields of the embed on the case's category prompt
+        self.fields = []
+        self.copies_shown = 0  # how many of the duplicates that embed lists, oldest first
+
+    def messages(self):
+        return [self.message] + self.duplicates
+
+    def shown_messages(self):
+        '''
+        The message and the copies moderators can see on the case prompt. Copies are only matched by estimated
+        similarity, so a decision never acts on one that nobody has looked at.
+        '''
+        return [self.message] + self.duplicates[:self.copies_shown]
+
+
+class CaseStore:
+    '''
+    Open moderation cases, indexed by case ID and by the IDs of their mod-channel prompts, plus a priority index that
+    hands the most severe unclaimed case to the next free moderator in O(log n). The heap is cleaned lazily: entries
+    for cases that were closed or claimed in the meantime are skipped when they reach the top. A claim lapses after
+    claim_timeout seconds without the moderator acting on the case, or when they release it.
+    '''
+
+    def __init__(self, first_id=1, id_step=1, claim_timeout=CLAIM_TIMEOUT):
+        self.cases = {}
+        self.by_prompt_id = {}
+        self.heap = []  # (-severity, case ID)
+        self.claimed = {}  # case ID -> case, for the cases moderators are working on
+        self.claim_timeout = claim_timeout
+        # Shard processes number their cases first_id, first_id + id_step, ... so case numbers never collide
+        self.next_id = first_id
+        self.id_step = id_step
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __iter__(self):
+        return iter(self.cases.values())
+
+    def get(self, case_id):
+        return self.cases.get(case_id)
+
+    def open(self, message, content, severity, scores=None, rating=None, case_id=None):
+        if case_id is None:
+            case_id = self.next_id
+            self.next_id += self.id_step
+        case = Case(case_id, message, content, severity, scores, rating)
+        self.cases[case.id] = case
+        heapq.heappush(self.heap, (-case.severity, case.id))
+        return case
+
+    def attach_prompt(self, case, prompt_id):
+        case.prompt_ids.append(prompt_id)
+        self.by_prompt_id[prompt_id] = case.id
+
+    def by_prompt(self, prompt_id):
+        return self.cases.get(self.by_prompt_id.get(prompt_id))
+
+    def claim(self, case, moderator_id, now=None):
+        '''
+        Gives the case to the moderator unless someone else already has it and has acted on it within the claim
+        timeout. Returns whether they now hold it; if so, the timeout starts over.
+        '''
+        now = time.time() if now is None else now
+        if case.claimed_by is None or (case.claimed_by != moderator_id and self.is_stale(case, now)):
+            case.claimed_by = moderator_id
+            self.claimed[case.id] = case
+        if case.claimed_by != moderator_id:
+            return False
+        case.claimed_at = now
+        return True
+
+    def claim_next(self, moderator_id):
+        '''
+        Claims and returns the most severe open case nobody is working on, or None if there isn't one. Cases whose
+        claim has lapsed are only back in the queue once release_stale() has run.
+        '''
+        while self.heap:
+            _, case_id = heapq.heappop(self.heap)
+            case = self.cases.get(case_id)
+            if case is not None and case.claimed_by is None:
+                self.claim(case, moderator_id)
+                return case
+        return None
+
+    def is_stale(self, case, now):
+        return case.claimed_at is None or now - case.claimed_at > self.claim_timeout
+
+    def release(self, case):
+        '''
+        Hands a claimed case back to the queue.
+        '''
+        self.claimed.pop(case.id, None)
+        if case.id in self.cases and case.claimed_by is not None:
+            case.claimed_by = None
+            case.claimed_at = None
+            heapq.heappush(self.heap, (-case.severity, case.id))
+
+    def release_all(self, moderator_id):
+        '''
+        Hands every case the moderator holds back to the queue and returns them.
+        '''
+        cases = [case for case in self.claimed.values() if case.claimed_by == moderator_id]
+        for case in cases:
+            self.release(case)
+        return cases
+
+    def release_stale(self, now=None):
+        '''
+        Hands back the cases whose moderator hasn't acted on them within the claim timeout. Returns them as
+        (case, moderator ID) pairs.
+        '''
+        now = time.time() if now is None else now
+        released = [(case, case.claimed_by) for case in self.claimed.values() if self.is_stale(case, now)]
+        for case, moderator_id in released:
+            self.release(case)
+        return released
+
+    def update(self, case, content, severity, scores=None, rating=None):
+        '''
+        Replaces what a case is about, e.g. after its message was edited.
+        '''
+        case.content = content
+        case.scores = scores
+        case.rating = rating
+        if severity != case.severity:
+            case.severity = severity
+            # The entry under the old severity stays in the heap and is skipped once the case has been claimed
+            if case.claimed_by is None:
+                heapq.heappush(self.heap, (-severity, case.id))
+
+    def close(self, case):
+        self.cases.pop(case.id, None)
+        self.claimed.pop(case.id, None)
+        for prompt_id in case.prompt_ids:
+            self.by_prompt_id.pop(prompt_id, None)
+        # Drop stale heap entries once they make up most of it, so closed cases don't pile up there
+        if len(self.heap) > 2 * len(self.cases) + 64:
+            self.heap = [(-c.severity, c.id) for c in self.cases.values() if c.claimed_by is None]
+            heapq.heapify(self.heap)
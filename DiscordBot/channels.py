@@ -0,0 +1,67 @@
+MONITORED = 'monitored'
+MOD = 'mod'
+
+
+class ChannelIndex:
+    '''
+    Which channels the bot watches and where each guild's mod channel is. Built once from the guild list when the
+    bot connects and then kept current from guild and channel create, update and delete events, so the message path
+    answers "is this a channel we care about" and "where do we forward it" with dict lookups instead of scans.
+    '''
+
+    def __init__(self, group_num=None):
+        self.group_num = group_num
+        self.roles = {}  # channel ID -> MONITORED or MOD
+        self.by_guild = {}  # guild ID -> {MONITORED: channel, MOD: channel}
+
+    def role_for_name(self, name):
+        if self.group_num is None:
+            return None
+        if name == f'group-{self.group_num}':
+            return MONITORED
+        if name == f'group-{self.group_num}-mod':
+            return MOD
+        return None
+
+    def rebuild(self, guilds):
+        self.roles.clear()
+        self.by_guild.clear()
+        for guild in guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild):
+        for channel in guild.text_channels:
+            self.add(channel)
+
+    def remove_guild(self, guild_id):
+        for channel in self.by_guild.pop(guild_id, {}).values():
+            self.roles.pop(channel.id, None)
+
+    def add(self, channel):
+        role = self.role_for_name(getattr(channel, 'name', None))
+        if role is None:
+            return
+        self.roles[channel.id] = role
+        self.by_guild.setdefault(channel.guild.id, {})[role] = channel
+
+    def remove(self, channel):
+        role = self.roles.pop(channel.id, None)
+        if role is None:
+            return
+        guild_channels = self.by_guild.get(channel.guild.id, {})
+        if guild_channels.get(role) is not None and guild_channels[role].id == channel.id:
+            del guild_channels[role]
+
+    def update(self, before, after):
+        # A rename can move a channel into or out of either role
+        self.remove(before)
+        self.add(after)
+
+    def role(self, channel):
+        return self.roles.get(channel.id)
+
+    def mod_channel(self, guild_id):
+        return self.by_guild.get(guild_id, {}).get(MOD)
+
+    def monitored_channel(self, guild_id):
+        return self.by_guild.get(guild_id, {}).get(MONITORED)
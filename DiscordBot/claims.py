@@ -0,0 +1,237 @@
+'''
+Local claim matching. Every claim ClaimBuster rates goes into an inverted index, and a claim that is a close enough
+rewording of one already rated gets that rating without calling out. Candidates are ranked with BM25 and one is only
+used when it says the same thing in other words: the two may differ in stopwords, plurals, word order and chat filler,
+but not in a single word that carries meaning. Swapping one verb, name or number can flip a claim's rating, and a wrong
+local rating is worse than a call to ClaimBuster. Negations are kept as words, so they count as such a word.
+'''
+import heapq
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from cache import normalize_text
+
+logger = logging.getLogger('discord')
+
+# BM25 parameters: how quickly repeating a term stops adding to the score, and how much long claims are penalized
+K1 = 1.2
+B = 0.75
+# Indexed claims sharing less than this share of their words with the claim (Jaccard similarity of the word sets) are
+# not considered at all
+MATCH_THRESHOLD = 0.75
+# Claims with fewer distinct words than this are too vague to match locally
+MIN_CLAIM_TOKENS = 3
+# Best-scoring indexed claims checked for a confident match
+CANDIDATES = 5
+
+TOKEN_REGEX = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset('a an and are as at be been but by do does for from had has have he her his i if in into is it '
+                      'its me my of on or our she so than that the their them then there these they this to us was we '
+                      'were what when which who will with you your'.split())
+# Words that turn a claim into its opposite. They all become the one word NEGATION, as do contractions like "don't"
+NEGATIONS = frozenset(['no', 'not', 'never', 'cannot', 'nor'])
+NEGATION = 'not'
+# Words the claim and a matched claim may differ in: chat filler that leaves what the claim says as it was
+FILLER = frozenset('actually breaking honestly just lol literally lmao omg please pls really rt share very wow'
+                   .split())
+
+Match = namedtuple('Match', ['claim', 'rating', 'similarity'])
+
+
+def tokenize(text):
+    '''
+    The words of a claim that say something about it: lowercased, without stopwords, with a plural 's' dropped so
+    "vaccines" and "vaccine" count as the same word, and with every negation as NEGATION.
+    '''
+    tokens = []
+    for token in TOKEN_REGEX.findall(text.lower().replace('\u2019', "'")):
+        if token in NEGATIONS or token.endswith("n't"):
+            token = NEGATION
+        elif token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class Claim:
+    __slots__ = ('text', 'rating', 'terms', 'words', 'length')
+
+    def __init__(self, text, rating, tokens):
+        self.text = text
+        self.rating = rating
+        self.terms = Counter(tokens)  # word -> number of times it occurs in the claim
+        self.words = frozenset(self.terms)
+        self.length = len(tokens)
+
+
+class ClaimIndex:
+    '''
+    Claims ClaimBuster has rated, in an inverted index searched with BM25. Repeats of a claim seldom come word for word,
+    so the API cache misses them, but they share nearly all their words with the rated original. The index is loaded
+    from a JSON lines file and every claim added afterwards is appended to it by a background thread.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.claims = []  # claim ID -> Claim
+        self.by_text = {}  # normalized claim text -> claim ID
+        self.postings = {}  # word -> IDs of the claims it occurs in
+        self.total_length = 0
+        self.writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='claims') if path else None
+        if path and os.path.isfile(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.claims)
+
+    def load(self):
+        lines = 0
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash; the claim will be looked up and added again
+                    continue
+                # Later lines win, so a claim that was re-rated has its latest rating
+                self.add(entry['claim'], entry['rating'], persist=False)
+                lines += 1
+        logger.info('Loaded %s rated claims from %s (%s lines)', len(self.claims), self.path, lines)
+
+    def add(self, text, rating, persist=True):
+        key = normalize_text(text)
+        claim_id = self.by_text.get(key)
+        if claim_id is not None:
+            claim = self.claims[claim_id]
+            if claim.rating == rating:
+                return
+            claim.rating = rating
+        else:
+            tokens = tokenize(text)
+            if not tokens:
+                return
+            claim_id = len(self.claims)
+            self.claims.append(Claim(text, rating, tokens))
+            self.by_text[key] = claim_id
+            self.total_length += len(tokens)
+            for token in set(tokens):
+                self.postings.setdefault(token, set()).add(claim_id)
+        if persist and self.writer_thread is not None:
+            self.writer_thread.submit(self._append, json.dumps({'claim': text, 'rating': rating}) + '\n')
+
+    def _append(self, line):
+        # One write per line on a file opened for appending, so shards adding to the same file don't interleave
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+    def search(self, text, limit=CANDIDATES):
+        '''
+        The indexed claims that best match the text by BM25, as (score, claim ID) pairs, best first.
+        '''
+        words = set(tokenize(text))
+        candidates = set()
+        for word in words:
+            candidates.update(self.postings.get(word, ()))
+        return self.rank(words, candidates, limit)
+
+    def rank(self, words, candidates, limit):
+        if not candidates:
+            return []
+        count = len(self.claims)
+        average_length = self.total_length / count
+        idfs = []
+        for word in words:
+            frequency = len(self.postings.get(word, ()))
+            if frequency:
+                idfs.append((word, math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))))
+        scores = []
+        for claim_id in candidates:
+            claim = self.claims[claim_id]
+            norm = K1 * (1 - B + B * claim.length / average_length)
+            score = 0.0
+            for word, idf in idfs:
+                frequency = claim.terms.get(word)
+                if frequency:
+                    score += idf * frequency * (K1 + 1) / (frequency + norm)
+            scores.append((score, claim_id))
+        return heapq.nlargest(limit, scores)
+
+    def match(self, text, threshold=MATCH_THRESHOLD):
+        '''
+        The rated claim the text is a repeat of, or None if no indexed claim is close enough to be sure.
+        '''
+        words = frozenset(tokenize(text))
+        if len(words) < MIN_CLAIM_TOKENS:
+            return None
+        # A claim close enough to match shares at least `shared` of the words, so it has to contain one of the
+        # len(words) - shared + 1 rarest ones. Only their postings are read; those of the common words, which can
+        # list most of the index, never are
+        shared = math.ceil(threshold * len(words) - 1e-9)
+        rarest = sorted(words, key=lambda word: len(self.postings.get(word, ())))[:len(words) - shared + 1]
+        candidates = set()
+        for word in rarest:
+            candidates.update(self.postings.get(word, ()))
+        # Nor can it be much shorter or longer than the text
+        candidates = [claim_id for claim_id in candidates
+                      if shared <= len(self.claims[claim_id].words) <= len(words) / threshold]
+        best = None
+        for score, claim_id in self.rank(words, candidates, CANDIDATES):
+            claim = self.claims[claim_id]
+            # "X causes Y" and "X prevents Y", or "X does not cause Y", share nearly every word but get opposite ratings
+            if not (words ^ claim.words) <= FILLER:
+                continue
+            similarity = len(words & claim.words) / len(words | claim.words)
+            if similarity >= threshold and (best is None or similarity > best.similarity):
+                best = Match(claim.text, claim.rating, similarity)
+        return best
+
+    def close(self):
+        if self.writer_thread is not None:
+            self.writer_thread.shutdown()
+
+    def stats(self):
+        return {'claims': len(self.claims), 'words': len(self.postings)}
+
+
+class ClaimMatchingApis:
+    '''
+    Answers fact checks from the ClaimIndex when a claim is a confident match for one ClaimBuster has already rated,
+    and only calls out on a miss. Every rating that comes back is added to the index. The other lookups are passed
+    straight through.
+    '''
+
+    def __init__(self, apis, index):
+        self.apis = apis
+        self.index = index
+        self.matched = 0
+        self.missed = 0
+
+    async def fact_check(self, input_claim):
+        match = self.index.match(input_claim)
+        if match is not None:
+            self.matched += 1
+            return match.rating
+        self.missed += 1
+        rating = await self.apis.fact_check(input_claim)
+        # No justification only means ClaimBuster knows no matching claim, which is not a rating worth indexing
+        if rating is not None:
+            self.index.add(input_claim, rating)
+        return rating
+
+    async def extract_title(self, input_url):
+        return await self.apis.extract_title(input_url)
+
+    async def summarize(self, input_url):
+        return await self.apis.summarize(input_url)
+
+    async def eval_text(self, text):
+        return await self.apis.eval_text(text)
+
+    def stats(self):
+        return dict(self.index.stats(), matched=self.matched, missed=self.missed)
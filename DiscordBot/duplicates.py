@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import re
+import time
+from array import array
+from collections import deque
+from cache import normalize_url, normalize_text
+from links import extract_urls
+
+logger = logging.getLogger('discord')
+
+# Signatures are compared for this long, and at most this many are kept, so memory stays flat under any load
+DUPLICATE_WINDOW = 60 * 60
+DUPLICATE_WINDOW_SIZE = 100000
+# Messages whose shingle sets overlap at least this much (estimated Jaccard similarity) are near-duplicates
+SIMILARITY_THRESHOLD = 0.6
+# Words per shingle; consecutive word triples keep word order without making one changed word change everything
+SHINGLE_SIZE = 3
+
+# MinHash signature of NUM_HASHES values, split into BANDS bands. Two messages become candidates when they agree on a
+# whole band, which with these numbers almost always happens above SIMILARITY_THRESHOLD and rarely far below it
+NUM_HASHES = 30
+BANDS = 10
+ROWS = NUM_HASHES // BANDS
+_HASH_BYTES = array('I').itemsize
+_BAND_BYTES = ROWS * _HASH_BYTES
+
+_WORD = re.compile(r'\w+')
+
+
+def shingles(content):
+    '''
+    The set of word shingles a message is compared on. Links are reduced to their normalized form, so copies that
+    differ only in tracking parameters or capitalization look the same.
+    '''
+    words = []
+    for token in normalize_text(content).split(' '):
+        urls = extract_urls(token) if '.' in token else []
+        if urls:
+            words.append(normalize_url(urls[0]))
+        else:
+            words.extend(_WORD.findall(token))
+    if len(words) < SHINGLE_SIZE:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def signature(content):
+    '''
+    MinHash signature of a message packed into bytes, or None if it has no words to compare. The fraction of
+    positions two signatures agree on estimates the Jaccard similarity of the messages' shingle sets.
+    '''
+    # One extendable-output hash per shingle supplies all NUM_HASHES independent hash values at once
+    hashes = [array('I', hashlib.shake_128(s.encode()).digest(NUM_HASHES * _HASH_BYTES)) for s in shingles(content)]
+    if not hashes:
+        return None
+    return array('I', map(min, zip(*hashes))).tobytes()
+
+
+def similarity(first, second):
+    return sum(x == y for x, y in zip(array('I', first), array('I', second))) / NUM_HASHES
+
+
+class Cluster:
+    '''
+    A message that went through the pipeline and the copies of it seen since in the same guild. Copies that arrive
+    while the first message is still being checked are parked here and attached to its cases once it has finished.
+    '''
+    __slots__ = ('signature', 'guild_id', 'seen_at', 'case_ids', 'copies', 'settled', 'waiters')
+
+    def __init__(self, signature, seen_at, guild_id=None):
+        self.signature = signature
+        self.guild_id = guild_id
+        self.seen_at = seen_at
+        self.case_ids = []  # cases opened for the first message; empty if it turned out to be benign
+        self.copies = 0
+        self.settled = False
+        self.waiters = None  # callbacks of parked copies; only created if one has to wait, since most clusters never do
+
+    def on_settled(self, callback):
+        '''
+        Calls callback once the first message has finished, or right away if it already has.
+        '''
+        if self.settled:
+            callback()
+            return
+        if self.waiters is None:
+            self.waiters = []
+        self.waiters.append(callback)
+
+    def finish(self):
+        self.settled = True
+        waiters, self.waiters = self.waiters or [], None
+        for callback in waiters:
+            try:
+                callback()
+            except Exception:
+                logger.exception('Finishing a parked copy failed')
+
+
+class DuplicateDetector:
+    '''
+    Streaming near-duplicate detection over a sliding window of recent monitored messages, using MinHash with
+    locality-sensitive banding. A lookup only compares against messages that share a band with the new one, so the
+    cost per message doesn't grow with the window. The window is shared by all guilds, but band keys start with the
+    guild ID, so a message only ever matches earlier ones from its own guild.
+    '''
+
+    def __init__(self, window=DUPLICATE_WINDOW, max_size=DUPLICATE_WINDOW_SIZE, threshold=SIMILARITY_THRESHOLD):
+        self.window = window
+        self.max_size = max_size
+        self.threshold = threshold
+        self.recent = deque()  # clusters, oldest first
+        self.bands = [{} for _ in range(BANDS)]  # band bytes -> clusters with that band, per band
+        self.matched = 0
+        self.missed = 0
+
+    def __len__(self):
+        return len(self.recent)
+
+    def _band_keys(self, sig, guild_id):
+        prefix = (guild_id or 0).to_bytes(8, 'little')
+        return [prefix + sig[i * _BAND_BYTES:(i + 1) * _BAND_BYTES] for i in range(BANDS)]
+
+    # Almost every band value belongs to a single message, so a bucket holds the cluster itself until a second one
+    # shares it and only then becomes a list; that roughly halves the memory the window takes
+
+    def _index(self, cluster):
+        self.recent.append(cluster)
+        for band, key in zip(self.bands, self._band_keys(cluster.signature, cluster.guild_id)):
+            bucket = band.get(key)
+            if bucket is None:
+                band[key] = cluster
+            elif isinstance(bucket, list):
+                bucket.append(cluster)
+            else:
+                band[key] = [bucket, cluster]
+
+    def _unindex(self, cluster):
+        for band, key in zip(self.bands, self._band_keys(cluster.signature, cluster.guild_id)):
+            bucket = band.get(key)
+            if bucket is cluster:
+                del band[key]
+            elif isinstance(bucket, list) and cluster in bucket:
+                bucket.remove(cluster)
+                if len(bucket) == 1:
+                    band[key] = bucket[0]
+
+    def _evict(self, now):
+        while self.recent and (len(self.recent) > self.max_size or now - self.recent[0].seen_at > self.window):
+            self._unindex(self.recent.popleft())
+
+    def find(self, sig, guild_id=None):
+        best, best_similarity = None, self.threshold
+        checked = set()
+        for band, key in zip(self.bands, self._band_keys(sig, guild_id)):
+            bucket = band.get(key)
+            if bucket is None:
+                continue
+            for cluster in bucket if isinstance(bucket, list) else (bucket,):
+                if id(cluster) in checked:
+                    continue
+                checked.add(id(cluster))
+                value = similarity(cluster.signature, sig)
+                if value >= best_similarity:
+                    best, best_similarity = cluster, value
+        return best
+
+    def match(self, content, guild_id=None):
+        '''
+        Returns (cluster, True) if the message is a near-duplicate of one in the window from the same guild, otherwise
+        starts a new cluster for it and returns (cluster, False).
+        '''
+        return self.match_signature(signature(content), guild_id)
+
+    def match_signature(self, sig, guild_id=None):
+        '''
+        match() for a message whose signature has already been computed, e.g. in a worker process.
+        '''
+        now = time.time()
+        self._evict(now)
+        if sig is None:
+            # Nothing to compare, e.g. only emoji; the message goes through the pipeline on its own
+            self.missed += 1
+            return Cluster(None, now, guild_id), False
+        cluster = self.find(sig, guild_id)
+        if cluster is not None:
+            cluster.copies += 1
+            self.matched += 1
+            return cluster, True
+
+        self.missed += 1
+        cluster = Cluster(sig, now, guild_id)
+        self._index(cluster)
+        self._evict(now)
+        return cluster, False
+
+    def forget(self, cluster):
+        '''
+        Stops matching new messages against a cluster, so the next copy starts a fresh one.
+        '''
+        self._unindex(cluster)
+
+    def restart(self, cluster):
+        '''
+        Replaces a cluster whose cases have all been decided with a fresh one, so the next copy is reviewed again.
+        '''
+        self._unindex(cluster)
+        fresh = Cluster(cluster.signature, time.time(), cluster.guild_id)
+        self._index(fresh)
+        return fresh
+
+    def stats(self):
+        return {'window': len(self.recent), 'matched': self.matched, 'missed': self.missed}
@@ -0,0 +1,104 @@
+import asyncio
+from collections import OrderedDict
+from cache import normalize_text
+from enrichment import text_part
+
+# Edits to a message are handled once it has gone this many seconds without another one, so fixing three typos in a
+# row costs one re-check instead of three
+EDIT_DEBOUNCE = 3.0
+# Analyses of recently checked messages kept for comparing edits against; edits to older messages are checked from
+# scratch
+ANALYSIS_SIZE = 10000
+
+# Key of the result for a message's text, next to the results for its links, which are keyed by URL
+TEXT = None
+
+
+class MessageAnalysis:
+    '''
+    What the pipeline found for one message: the result for each link and for the text, and the case each of them
+    was forwarded in, along with the message as written and as the checks saw it. An edit is compared against this,
+    so only the parts that changed are looked up again.
+    '''
+    __slots__ = ('raw', 'normalized', 'results', 'case_ids', 'lock')
+
+    def __init__(self, raw, normalized):
+        self.raw = raw  # the content as the author wrote it
+        self.normalized = normalized  # its ASCII transliteration, which the checks ran on
+        self.results = {}  # URL, or TEXT -> LinkResult or TextResult
+        self.case_ids = {}  # URL, or TEXT -> ID of the case opened for that part
+        self.lock = asyncio.Lock()  # held while the message is being checked, so an edit waits for it to finish
+
+    def parts(self, url_list, content):
+        '''
+        The keys of an edited version of the message that need a fresh lookup, and the keys of parts that are gone.
+        Text is compared after folding case and whitespace, the same way the API cache keys it.
+        '''
+        changed = [url for url in dict.fromkeys(url_list) if url not in self.results]
+        text = self.results.get(TEXT)
+        if text is None or normalize_text(text.text) != normalize_text(text_part(content, url_list)):
+            changed.append(TEXT)
+        removed = [key for key in self.results if key is not TEXT and key not in url_list]
+        return changed, removed
+
+
+class AnalysisStore:
+    '''
+    MessageAnalysis of the most recently checked messages, by message ID.
+    '''
+
+    def __init__(self, max_size=ANALYSIS_SIZE):
+        self.max_size = max_size
+        self.analyses = OrderedDict()
+
+    def __len__(self):
+        return len(self.analyses)
+
+    def get(self, message_id):
+        return self.analyses.get(message_id)
+
+    def start(self, message_id, raw, normalized):
+        analysis = MessageAnalysis(raw, normalized)
+        self.analyses[message_id] = analysis
+        self.analyses.move_to_end(message_id)
+        while len(self.analyses) > self.max_size:
+            self.analyses.popitem(last=False)
+        return analysis
+
+
+class EditDebouncer:
+    '''
+    Holds back message edits until the message has stopped changing for `delay` seconds, then passes on only the
+    latest version.
+    '''
+
+    def __init__(self, callback, delay=EDIT_DEBOUNCE):
+        self.callback = callback
+        self.delay = delay
+        self.pending = {}  # message ID -> (timer, latest version of the message)
+        self.edits = 0
+        self.passed = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def edited(self, message):
+        self.edits += 1
+        entry = self.pending.get(message.id)
+        if entry is not None:
+            entry[0].cancel()
+        timer = asyncio.get_running_loop().call_later(self.delay, self._settled, message.id)
+        self.pending[message.id] = (timer, message)
+
+    def _settled(self, message_id):
+        timer, message = self.pending.pop(message_id)
+        self.passed += 1
+        self.callback(message)
+
+    def close(self):
+        for timer, message in self.pending.values():
+            timer.cancel()
+        self.pending.clear()
+
+    def stats(self):
+        return {'edits': self.edits, 'checked': self.passed, 'waiting': len(self.pending)}
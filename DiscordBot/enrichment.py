@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from collections import namedtuple
+from policy import UNSCORED
+
+logger = logging.getLogger('discord')
+
+LinkResult = namedtuple('LinkResult', ['url', 'title', 'summary', 'rating'])
+TextResult = namedtuple('TextResult', ['text', 'rating', 'scores'])
+
+# Caps on the number of API calls that may be outstanding at once, for a single message and for the whole bot
+GLOBAL_CONCURRENCY = 32
+PER_MESSAGE_CONCURRENCY = 6
+
+
+def text_part(content, url_list):
+    '''
+    What is left of a message for the text checks once its links are taken out.
+    '''
+    for url in url_list:
+        content = content.replace(url, '')
+    return content
+
+
+class Enricher:
+    '''
+    Runs every external lookup for a message at the same time instead of one after another. For each URL the title and
+    summary are fetched together and the title is fact checked as soon as it arrives; the leftover text is fact checked
+    and scored by Perspective alongside them. Results are yielded in the order they finish so the caller can forward
+    them to the mod channel right away. A lookup that fails leaves its field as None, or UNSCORED for a rating, so the
+    message can still be forwarded for manual review.
+    '''
+
+    def __init__(self, apis, global_limit=GLOBAL_CONCURRENCY, per_message_limit=PER_MESSAGE_CONCURRENCY):
+        self.apis = apis
+        self.global_limit = asyncio.Semaphore(global_limit)
+        self.per_message_limit = per_message_limit
+
+    async def _call(self, local_limit, fn, *args):
+        async with local_limit, self.global_limit:
+            return await fn(*args)
+
+    async def _guarded(self, local_limit, fn, arg, failed=None):
+        try:
+            return await self._call(local_limit, fn, arg)
+        except Exception:
+            logger.exception('Enrichment lookup %s failed', fn.__name__)
+            return failed
+
+    async def _link(self, local_limit, url):
+        title, summary = await asyncio.gather(self._guarded(local_limit, self.apis.extract_title, url),
+                                              self._guarded(local_limit, self.apis.summarize, url))
+        if title is None:
+            return LinkResult(url, title, summary, UNSCORED)
+        rating = await self._guarded(local_limit, self.apis.fact_check, title, UNSCORED)
+        return LinkResult(url, title, summary, rating)
+
+    async def _text(self, local_limit, text):
+        rating, scores = await asyncio.gather(self._guarded(local_limit, self.apis.fact_check, text, UNSCORED),
+                                              self._guarded(local_limit, self.apis.eval_text, text))
+        return TextResult(text, rating, scores)
+
+    async def enrich(self, content, url_list):
+        '''
+        Async generator over the LinkResult for each URL and the TextResult for the content with the URLs removed.
+        '''
+        async for result in self.enrich_parts(url_list, text_part(content, url_list)):
+            yield result
+
+    async def enrich_parts(self, url_list, text=None):
+        '''
+        enrich() for just some parts of a message: the given URLs, and the text unless it is None.
+        '''
+        local_limit = asyncio.Semaphore(self.per_message_limit)
+        tasks = [asyncio.ensure_future(self._link(local_limit, u)) for u in url_list]
+        if text is not None:
+            tasks.append(asyncio.ensure_future(self._text(local_limit, text)))
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,61 @@
+import asyncio
+import aiohttp
+
+
+class HttpClient:
+    '''
+    Shared async HTTP client for all of the bot's external API calls. A single aiohttp session is created lazily on the
+    running event loop and reused, so connections to each host stay open (keep-alive) and are pooled per host instead
+    of being reopened for every request. Every call takes an optional timeout that overrides the default.
+    '''
+
+    def __init__(self, limit=100, limit_per_host=10, keepalive_timeout=30, timeout=10):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session = None
+        self._lock = asyncio.Lock()
+
+    async def session(self):
+        if self._session is None or self._session.closed:
+            async with self._lock:
+                if self._session is None or self._session.closed:
+                    connector = aiohttp.TCPConnector(limit=self.limit,
+                                                     limit_per_host=self.limit_per_host,
+                                                     keepalive_timeout=self.keepalive_timeout,
+                                                     ttl_dns_cache=300)
+                    self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _timeout(self, timeout):
+        return aiohttp.ClientTimeout(total=self.timeout if timeout is None else timeout)
+
+    async def get_json(self, url, headers=None, timeout=None):
+        session = await self.session()
+        async with session.get(url, headers=headers, timeout=self._timeout(timeout)) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def post_json(self, url, payload, headers=None, timeout=None):
+        session = await self.session()
+        async with session.post(url, json=payload, headers=headers, timeout=self._timeout(timeout)) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def post_form(self, url, fields, headers=None, timeout=None):
+        '''
+        Sends the fields as multipart/form-data, which is what the MeaningCloud endpoints expect.
+        '''
+        form = aiohttp.FormData()
+        for name, value in fields.items():
+            form.add_field(name, value)
+        session = await self.session()
+        async with session.post(url, data=form, headers=headers, timeout=self._timeout(timeout)) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from normalization import to_ascii
+from links import extract_urls
+from duplicates import signature
+
+logger = logging.getLogger('discord')
+
+# Monitored messages being checked at the same time. Most of a check is waiting on the external APIs, or on the first
+# copy of a duplicate to finish, so this is about how many checks may wait at once rather than about CPU cores
+INGEST_WORKERS = 32
+# Messages waiting to be checked, in total and per guild; a single guild can fill at most this much of the queue
+QUEUE_SIZE = 1000
+GUILD_QUEUE_SIZE = 250
+# What goes when the queue is full: the longest-waiting message of the guild with the most queued (so the freshest
+# messages are the ones checked), or that guild's newest message (so whatever has waited longest is not wasted)
+SHED_OLDEST = 'oldest'
+SHED_NEWEST = 'newest'
+SHED_POLICY = SHED_OLDEST
+# Processes for the CPU-bound text work on each message; 0 keeps it on the event loop, which is faster unless
+# messages are long or arrive faster than one core can normalize and hash them
+PROCESS_WORKERS = 0
+
+
+def prepare_text(content):
+    '''
+    The CPU-bound part of checking a message: its ASCII-normalized text, the links in it and its near-duplicate
+    signature, plus how many seconds each of the three steps took, by stage name. A plain function of the content so
+    it can run in a worker process.
+    '''
+    started = time.perf_counter()
+    content = to_ascii(content)
+    normalized = time.perf_counter()
+    urls = extract_urls(content)
+    extracted = time.perf_counter()
+    sig = signature(content)
+    timings = {'unidecode': normalized - started, 'extract_urls': extracted - normalized,
+               'signature': time.perf_counter() - extracted}
+    return content, urls, sig, timings
+
+
+class IngestQueue:
+    '''
+    Bounded queue between the gateway and the checks run on monitored messages. on_message only has to put a message
+    here, and a fixed pool of worker tasks takes them off. Each guild has its own queue and the workers take from the
+    guilds in turn, so a burst in one guild delays only that guild's messages. When a guild or the whole queue is
+    full, a message from the guild with the most queued is shed according to the policy.
+    '''
+
+    def __init__(self, handler, metrics, workers=INGEST_WORKERS, max_size=QUEUE_SIZE,
+                 guild_max_size=GUILD_QUEUE_SIZE, policy=SHED_POLICY, process_workers=PROCESS_WORKERS, on_shed=None):
+        if policy not in (SHED_OLDEST, SHED_NEWEST):
+            raise ValueError(f'Unknown shed policy {policy!r}')
+        self.handler = handler
+        self.metrics = metrics
+        self.workers = workers
+        self.max_size = max_size
+        self.guild_max_size = guild_max_size
+        self.policy = policy
+        self.process_workers = process_workers
+        self.on_shed = on_shed  # called with each message that is dropped and the reason
+        self.queues = OrderedDict()  # guild ID -> deque of (time queued, message), in the order the guilds are served
+        self.size = 0
+        self.nonempty = asyncio.Event()
+        self.tasks = []
+        self.pool = None
+        self.queued = 0
+        self.handled = 0
+        self.shed = 0
+        self.wait = metrics.histogram('queue_wait_seconds', 'Time monitored messages spend queued before a worker '
+                                      'takes them')
+        metrics.gauge('queue_depth', 'Monitored messages waiting for a worker', lambda: self.size)
+
+    def __len__(self):
+        return self.size
+
+    def start(self):
+        if self.tasks:
+            return
+        if self.process_workers:
+            self.pool = ProcessPoolExecutor(self.process_workers)
+        self.tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def put(self, guild_id, message):
+        '''
+        Queues a message for the workers. Returns False if the queue was full and it was the message that got shed.
+        '''
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = deque()
+        queue.append((time.monotonic(), message))
+        self.size += 1
+        self.queued += 1
+        accepted = True
+        if len(queue) > self.guild_max_size:
+            accepted = self._shed(guild_id, 'guild_full') is not message
+        elif self.size > self.max_size:
+            longest = max(self.queues, key=lambda key: len(self.queues[key]))
+            accepted = self._shed(longest, 'queue_full') is not message
+        self.nonempty.set()
+        return accepted
+
+    def _shed(self, guild_id, reason):
+        queue = self.queues[guild_id]
+        queued_at, message = queue.popleft() if self.policy == SHED_OLDEST else queue.pop()
+        if not queue:
+            del self.queues[guild_id]
+        self.size -= 1
+        self.shed += 1
+        self.metrics.counter('queue_shed', 'Monitored messages dropped because the queue was full',
+                             {'reason': reason}).inc()
+        if self.on_shed is not None:
+            self.on_shed(message, reason)
+        return message
+
+    def _take(self):
+        guild_id, queue = next(iter(self.queues.items()))
+        queued_at, message = queue.popleft()
+        # The guild goes to the back of the line, or out of it if that was its last message
+        if queue:
+            self.queues.move_to_end(guild_id)
+        else:
+            del self.queues[guild_id]
+        self.size -= 1
+        return queued_at, message
+
+    async def _work(self):
+        while True:
+            while not self.size:
+                self.nonempty.clear()
+                await self.nonempty.wait()
+            queued_at, message = self._take()
+            self.wait.observe(time.monotonic() - queued_at)
+            try:
+                await self.handler(message)
+            except Exception:
+                logger.exception('Checking message %s failed', getattr(message, 'id', None))
+            self.handled += 1
+
+    async def run_cpu(self, fn, *args):
+        '''
+        Runs fn in the process pool if there is one, otherwise right here.
+        '''
+        if self.pool is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.size:
+            logger.warning('%s queued messages were not checked before shutting down', self.size)
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def stats(self):
+        return {'queued': self.queued, 'handled': self.handled, 'shed': self.shed, 'waiting': self.size}
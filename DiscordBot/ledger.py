@@ -0,0 +1,169 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Points halve every this many seconds, so old offences count for less; None turns decay off
+DECAY_HALF_LIFE = 30 * 24 * 60 * 60
+# Pending point changes are written out this often, or sooner once this many authors have changes waiting
+FLUSH_INTERVAL = 2.0
+FLUSH_SIZE = 500
+# Recently read or changed balances kept in memory so repeated lookups don't go to SQLite
+RECENT_SIZE = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS points (
+    guild_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    points REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (guild_id, author_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS points_by_guild ON points (guild_id, points);
+CREATE INDEX IF NOT EXISTS points_by_author ON points (author_id);
+CREATE TABLE IF NOT EXISTS enforcement (
+    guild_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    points REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS enforcement_by_author ON enforcement (guild_id, author_id, created_at);
+'''
+
+
+def decayed(points, updated_at, now, half_life=DECAY_HALF_LIFE):
+    if half_life is None or points == 0:
+        return points
+    return points * 0.5 ** (max(0.0, now - updated_at) / half_life)
+
+
+class PointsLedger:
+    '''
+    Durable per-guild points for message authors, backed by SQLite in WAL mode. Changes are collected in memory and
+    written in batches by a single background thread, so reaction handlers never wait on disk; reads go through a
+    separate connection, which WAL lets run alongside the writer. Balances decay over time and are only ever loaded
+    one author at a time, so the table can hold millions of authors.
+    '''
+
+    def __init__(self, path, half_life=DECAY_HALF_LIFE):
+        self.path = path
+        self.half_life = half_life
+        self.pending = {}  # (guild ID, author ID) -> points added since the last flush
+        self.pending_enforcement = []
+        self.recent = OrderedDict()  # (guild ID, author ID) -> (points, updated_at) as last stored
+        self.writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ledger')
+        self.flusher = None
+        self.flush_scheduled = False
+
+        self.reader = self._connect(check_same_thread=True)
+        self.reader.executescript(SCHEMA)
+        self.writer = self._connect(check_same_thread=False)
+
+    def _connect(self, check_same_thread):
+        connection = sqlite3.connect(self.path, check_same_thread=check_same_thread, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.create_function('decayed', 3, lambda p, u, n: decayed(p, u, n, self.half_life), deterministic=True)
+        return connection
+
+    def _stored(self, key):
+        entry = self.recent.get(key)
+        if entry is None:
+            row = self.reader.execute('SELECT points, updated_at FROM points WHERE guild_id = ? AND author_id = ?',
+                                      key).fetchone()
+            entry = row if row else (0.0, time.time())
+            self.recent[key] = entry
+            if len(self.recent) > RECENT_SIZE:
+                self.recent.popitem(last=False)
+        else:
+            self.recent.move_to_end(key)
+        return entry
+
+    def get(self, guild_id, author_id):
+        key = (guild_id, author_id)
+        points, updated_at = self._stored(key)
+        return decayed(points, updated_at, time.time(), self.half_life) + self.pending.get(key, 0)
+
+    def add(self, guild_id, author_id, points):
+        '''
+        Adds points to an author and returns their new balance. The change reaches disk on the next flush.
+        '''
+        key = (guild_id, author_id)
+        self.pending[key] = self.pending.get(key, 0) + points
+        if len(self.pending) >= FLUSH_SIZE:
+            self.schedule_flush()
+        return self.get(guild_id, author_id)
+
+    def record_enforcement(self, guild_id, author_id, action, points):
+        self.pending_enforcement.append((guild_id, author_id, action, points, time.time()))
+
+    def over_threshold(self, guild_id, threshold, limit=100):
+        '''
+        Authors in the guild whose decayed balance is above threshold, highest first, as (author ID, points) pairs.
+        Balances only shrink between writes, so the index on stored points narrows the scan before decay is applied.
+        '''
+        now = time.time()
+        rows = self.reader.execute(
+            'SELECT author_id, decayed(points, updated_at, ?) AS current FROM points '
+            'WHERE guild_id = ? AND points > ? AND current > ? ORDER BY current DESC LIMIT ?',
+            (now, guild_id, threshold, threshold, limit)).fetchall()
+        # Fold in changes that haven't been written yet
+        balances = dict(rows)
+        for (pending_guild, author_id), delta in self.pending.items():
+            if pending_guild == guild_id:
+                balances[author_id] = self.get(guild_id, author_id)
+        over = [(author_id, points) for author_id, points in balances.items() if points > threshold]
+        return sorted(over, key=lambda item: -item[1])[:limit]
+
+    def _write(self, changes, enforcement):
+        now = time.time()
+        self.writer.execute('BEGIN')
+        self.writer.executemany(
+            'INSERT INTO points (guild_id, author_id, points, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (guild_id, author_id) DO UPDATE SET '
+            'points = decayed(points, updated_at, excluded.updated_at) + excluded.points, '
+            'updated_at = excluded.updated_at',
+            [(guild_id, author_id, delta, now) for (guild_id, author_id), delta in changes.items()])
+        self.writer.executemany('INSERT INTO enforcement VALUES (?, ?, ?, ?, ?)', enforcement)
+        self.writer.execute('COMMIT')
+        return now
+
+    async def flush(self):
+        self.flush_scheduled = False
+        if not self.pending and not self.pending_enforcement:
+            return
+        changes, self.pending = self.pending, {}
+        enforcement, self.pending_enforcement = self.pending_enforcement, []
+        # Until the write lands the cached balances plus the changes in flight are the truth
+        for key, delta in changes.items():
+            points, updated_at = self._stored(key)
+            self.recent[key] = (decayed(points, updated_at, time.time(), self.half_life) + delta, time.time())
+        await asyncio.get_running_loop().run_in_executor(self.writer_thread, self._write, changes, enforcement)
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.ensure_future(self.flush())
+
+    async def run(self):
+        '''
+        Background task that flushes pending changes every FLUSH_INTERVAL seconds.
+        '''
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        self.writer_thread.submit(self.writer.close).result()
+        self.writer_thread.shutdown()
+        self.reader.close()
@@ -0,0 +1,129 @@
+import re
+
+# The URL pattern the bot used to run directly over every message. It is kept for reference and for the benchmark in
+# bench.py: its nested quantifiers backtrack exponentially on inputs such as 'http://' followed by punctuation.
+LEGACY_URL_REGEX = re.compile(
+    r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|"
+    r"(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))")
+
+# Discord message links end in /<guild id>/<channel id>/<message id>
+MESSAGE_LINK_REGEX = re.compile(r'/(\d+)/(\d+)/(\d+)')
+
+# None of these patterns has nested or overlapping quantifiers, so all of them run in linear time
+_SCHEME_OR_WWW = re.compile(r'(?i)\b(?:https?://|www\d{0,3}\.)')
+_PLAIN_RUN = re.compile(r'[^()<>]*')
+# Every whitespace-separated token that could hold a link, i.e. has a '.' or ':' in it. The lookbehind only lets a
+# match start at the beginning of a token, so each token is scanned once. The common case is a token that is one link
+# starting with a scheme or www, with no '<' or '>' and only balanced parentheses (at most one nested level, as the
+# legacy pattern allowed); it is matched whole as `simple`, with its prefix as `prefix`. Its runs of plain characters
+# are separated by groups, which are the only things that start with '(', so there is only ever one way to match it
+_PLAIN = r'[^\s()<>]*'
+_GROUP = rf'\({_PLAIN}(?:\([^\s()<>]+\){_PLAIN})*\)'
+_CANDIDATE = re.compile(rf'(?<!\S)(?:(?P<simple>(?P<prefix>(?i:https?://|www\d{{0,3}}\.)){_PLAIN}(?:{_GROUP}{_PLAIN})*)(?!\S)'
+                        r'|\S*[.:]\S*)')
+
+_LETTERS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_DOMAIN_CHARS = _LETTERS | frozenset('0123456789.-')
+_TRAILING_PUNCTUATION = frozenset('`!()[]{};:\'".,<>?«»“”‘’')
+# In a `simple` token, a ')' at the end always closes a group, and those are kept
+_TRAILING_OUTSIDE_GROUP = ''.join(_TRAILING_PUNCTUATION - {')'})
+
+
+def might_contain_url(text):
+    '''
+    Cheap check that rules out most chat messages: every URL form we recognise has a '.' or '://' in it.
+    '''
+    return '.' in text or '://' in text
+
+
+def _url_starts(token):
+    '''
+    Everything in token that begins a URL (a scheme, a www prefix, or a domain with a 2-4 letter TLD directly
+    followed by a slash) as sorted (start, prefix end) pairs. A URL has to run past the end of its prefix, so a bare
+    'https://' or 'www.' is not one. Each character is looked at a bounded number of times.
+    '''
+    starts = {m.start(): m.end() for m in _SCHEME_OR_WWW.finditer(token)}
+    prev = 0  # a domain can't reach back past the previous slash
+    slash = token.find('/')
+    while slash != -1:
+        tld = slash
+        while tld > prev and slash - tld < 5 and token[tld - 1] in _LETTERS:
+            tld -= 1
+        if 2 <= slash - tld <= 4 and tld - 1 > prev and token[tld - 1] == '.':
+            start = tld - 1
+            while start > prev and token[start - 1] in _DOMAIN_CHARS:
+                start -= 1
+            # The domain has to begin on a word boundary, i.e. not with '.' or '-'
+            while start < tld - 1 and not token[start].isalnum():
+                start += 1
+            if start < tld - 1:
+                starts.setdefault(start, start + 1)
+        prev = slash + 1
+        slash = token.find('/', prev)
+    return sorted(starts.items())
+
+
+def _group_end(token, i):
+    '''
+    For the '(' at index i, the index just past the ')' that closes it, or -1 if it isn't closed. Like the legacy
+    pattern, a group may contain at most one level of non-empty nested parentheses.
+    '''
+    j = _PLAIN_RUN.match(token, i + 1).end()
+    while j < len(token):
+        ch = token[j]
+        if ch == ')':
+            return j + 1
+        if ch != '(':
+            return -1
+        k = _PLAIN_RUN.match(token, j + 1).end()
+        if k == j + 1 or k == len(token) or token[k] != ')':
+            return -1
+        j = _PLAIN_RUN.match(token, k + 1).end()
+    return -1
+
+
+def _url_end(token, start):
+    '''
+    End index of the URL that begins at start. The body runs until '<', '>', a stray ')' or a '(' that isn't closed;
+    trailing punctuation is then dropped unless it closes a parenthesised group.
+    '''
+    i = _PLAIN_RUN.match(token, start).end()
+    last_group_end = -1
+    while i < len(token) and token[i] == '(':
+        end = _group_end(token, i)
+        if end == -1:
+            break
+        last_group_end = end
+        i = _PLAIN_RUN.match(token, end).end()
+    while i > start and token[i - 1] in _TRAILING_PUNCTUATION and i != last_group_end:
+        i -= 1
+    return i
+
+
+def extract_urls(text):
+    '''
+    Returns the URLs in text, in order. Finds the same links as LEGACY_URL_REGEX on ordinary messages but only makes a
+    bounded number of passes over each whitespace-separated token, so adversarial input can't make it backtrack.
+    '''
+    if not might_contain_url(text):
+        return []
+    urls = []
+    for candidate in _CANDIDATE.finditer(text):
+        if candidate['simple'] is not None:
+            # Whatever else the token contains is part of this one link
+            url = candidate['simple'].rstrip(_TRAILING_OUTSIDE_GROUP)
+            if len(url) > len(candidate['prefix']):
+                urls.append(url)
+            continue
+        token = candidate[0]
+        if '.' not in token and '://' not in token:
+            continue
+        pos = 0
+        for start, prefix_end in _url_starts(token):
+            if start < pos:
+                continue
+            end = _url_end(token, start)
+            if end > prefix_end:
+                urls.append(token[start:end])
+                pos = end
+    return urls
@@ -0,0 +1,671 @@
+'''
+Offline load test for the whole moderation pipeline. The bot runs against stub Discord objects and local mock
+ClaimBuster, MeaningCloud and Perspective servers, so neither a Discord server nor API keys are needed. A synthetic or
+recorded corpus of channel messages, DMs and reactions is replayed at a target rate, and the run reports throughput,
+end-to-end latency percentiles and API calls per message.
+
+    python loadtest.py --events 2000 --rate 100 --api-latency 0.05 --error-rate 0.02
+    python loadtest.py --save-corpus corpus.jsonl        # write the synthetic corpus out to edit or reuse
+    python loadtest.py --corpus corpus.jsonl --max-p99 500  # exits 1 if p99 goes over 500 ms
+    python shards.py --shards 4 -- python loadtest.py --shard-id {shard_id} --shard-count {shard_count} --shared-dir /tmp/shards
+
+A corpus is a JSON lines file of events, replayed in order:
+    {"type": "message", "channel": "monitored" or "mod", "author": 42, "content": "..."}
+    {"type": "dm", "author": 42, "content": "report"}
+    {"type": "react", "channel": "mod" or "dm", "user": 42, "emoji": "🟠"}
+    {"type": "edit", "message": 7, "content": "..."}
+An edit replaces the content of the monitored message posted by event N. "{message:N}" in a DM is replaced with the link to the message posted by event N. A reaction goes on the oldest open
+prompt in its channel that takes that emoji; with no emoji it picks one of the emojis the oldest open prompt takes.
+Events from the same author or user run one after another, the way a person would answer one prompt at a time.
+
+Run as one of several shards, every shard replays the same corpus into its own guild, and every other report is about
+the next shard's copy of the message instead, so it is handed off to that shard to open the case.
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import types
+from collections import Counter, defaultdict, deque
+import discord
+from aiohttp import web
+from apis import PERSPECTIVE_ATTRIBUTES
+from bench import percentile
+from bot import ModBot, NEXT_CASE_KEYWORD
+from edits import EDIT_DEBOUNCE
+from logs import LogWriter
+from shards import HANDOFF_INTERVAL
+from ingest import INGEST_WORKERS, QUEUE_SIZE, SHED_POLICY, SHED_OLDEST, SHED_NEWEST, PROCESS_WORKERS
+
+GROUP = '0'
+GUILD_ID = 1
+BOT_ID = 2
+MODERATORS = [11, 12, 13]
+TRUTH_RATINGS = ['Pants on Fire!', 'False', 'Mostly False', 'Half True', 'Mostly True', 'True']
+
+_ids = itertools.count(10 ** 17)
+
+
+def not_found(text):
+    return discord.NotFound(types.SimpleNamespace(status=404, reason='Not Found'), text)
+
+
+# Stub Discord objects: just enough of the discord.py interface for the bot, with a fixed delay on every REST call
+
+class StubUser:
+    def __init__(self, harness, user_id, name):
+        self.harness = harness
+        self.id = user_id
+        self.name = name
+        self.bot = False
+        self.dm_channel = None
+
+    async def send(self, content=None, embed=None):
+        return await self.harness.dm_channel(self).send(content, embed=embed)
+
+
+class StubMessage:
+    def __init__(self, harness, channel, author, content, embed=None, message_id=None):
+        self.harness = harness
+        self.id = message_id if message_id is not None else next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.reactions = []
+        self.jump_url = f'https://discord.com/channels/{self.guild.id if self.guild else "@me"}/{channel.id}/{self.id}'
+
+    async def add_reaction(self, emoji):
+        await self.harness.rest_call('add_reaction')
+        self.reactions.append(emoji)
+
+    async def delete(self):
+        await self.harness.rest_call('delete')
+        self.channel.messages.pop(self.id, None)
+
+
+class StubChannel:
+    def __init__(self, harness, name, guild=None, channel_id=None):
+        self.harness = harness
+        self.id = channel_id if channel_id is not None else next(_ids)
+        self.name = name
+        self.guild = guild
+        self.messages = {}
+        self.prompts = deque()  # IDs of messages the bot posted here, oldest first
+
+    async def send(self, content=None, embed=None):
+        await self.harness.rest_call('send')
+        message = StubMessage(self.harness, self, self.harness.bot_user, content, embed)
+        self.messages[message.id] = message
+        self.prompts.append(message.id)
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.harness.rest_call('fetch_message')
+        if message_id not in self.messages:
+            raise not_found('Unknown Message')
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id):
+        return StubPartialMessage(self, message_id)
+
+
+class StubPartialMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, embed=None):
+        await self.channel.harness.rest_call('edit')
+        self.channel.messages[self.id].embed = embed
+
+    async def add_reaction(self, emoji):
+        await self.channel.harness.rest_call('add_reaction')
+        self.channel.messages[self.id].reactions.append(emoji)
+
+    async def delete(self):
+        await self.channel.harness.rest_call('delete')
+        self.channel.messages.pop(self.id, None)
+
+
+class StubGuild:
+    def __init__(self, harness, guild_id):
+        self.id = guild_id
+        self.name = 'Load test guild'
+        # Channel IDs follow from the guild ID, so the shard processes agree on them
+        self.monitored = StubChannel(harness, f'group-{GROUP}', self, guild_id << 8 | 1)
+        self.mod = StubChannel(harness, f'group-{GROUP}-mod', self, guild_id << 8 | 2)
+        self.text_channels = [self.monitored, self.mod]
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.text_channels if channel.id == channel_id), None)
+
+
+class StubPayload:
+    def __init__(self, message, emoji, user_id):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = message.guild.id if message.guild else None
+        self.emoji = emoji
+        self.user_id = user_id
+
+
+class StubEditPayload:
+    def __init__(self, message):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = message.guild.id if message.guild else None
+        self.message = message
+
+
+# Mock external APIs
+
+class MockApis:
+    '''
+    Local stand-ins for ClaimBuster, MeaningCloud and Perspective. Every call waits about `latency` seconds and fails
+    with a 429 or 5xx response with probability `error_rate`.
+    '''
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self.runner = None
+
+    async def _respond(self, name, body):
+        self.calls[name] += 1
+        await asyncio.sleep(max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+        if random.random() < self.error_rate:
+            self.errors[name] += 1
+            return web.json_response({'error': 'mock failure'}, status=random.choice((429, 500, 503)))
+        return web.json_response(body)
+
+    async def claim_buster(self, request):
+        justification = [{'truth_rating': random.choice(TRUTH_RATINGS)}] if random.random() < 0.7 else []
+        return await self._respond('claim_buster', {'justification': justification})
+
+    async def structure(self, request):
+        await request.post()
+        return await self._respond('meaningcloud_structure', {'title': 'Mock page title'})
+
+    async def summary(self, request):
+        await request.post()
+        return await self._respond('meaningcloud_summary', {'summary': 'A mock summary [...] of the linked page.'})
+
+    async def perspective(self, request):
+        await request.json()
+        scores = {attr: {'summaryScore': {'value': random.random()}} for attr in PERSPECTIVE_ATTRIBUTES}
+        return await self._respond('perspective', {'attributeScores': scores})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/claimbuster/{claim:.*}', self.claim_buster)
+        app.router.add_post('/structure', self.structure)
+        app.router.add_post('/summary', self.summary)
+        app.router.add_post('/comments:analyze', self.perspective)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        return f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+
+    def point(self, external_apis, base_url):
+        external_apis.claim_buster_url = base_url + '/claimbuster/'
+        external_apis.structure_url = base_url + '/structure'
+        external_apis.summary_url = base_url + '/summary'
+        external_apis.perspective_url = base_url + '/comments:analyze'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# Corpus
+
+BENIGN = ['anyone up for games tonight after class?', 'the lecture notes for week 5 are posted now',
+          'lol that meme is great, thanks for sharing', 'does anyone know when the project is due?',
+          'check out the docs here https://github.com/Rapptz/discord.py', 'good morning everyone, have a nice day']
+RISKY = ['BREAKING: the election was rigged and they dont want you to know!!',
+         'vaccines contain a microchip, wake up sheeple, big pharma is hiding it',
+         'this miracle cure ends covid in a day, the plandemic is a hoax',
+         'deep state cover up exposed, voter fraud everywhere, spread the word',
+         'read the proof before it gets banned https://freedom-news-daily.example.com/truth?utm_source=x',
+         'they are lying to you about 5g, full story at https://naturalnews.com/2022/5g-exposed']
+DETAILS = ['This is spreading false health claims.', 'It is targeting people in the server.', 'Seems like spam.']
+
+
+def synthetic_corpus(count, seed=0):
+    '''
+    A mix of everyday chat, risky messages (a third of them lightly edited copies), moderators working through cases
+    and users reporting messages over DM.
+    '''
+    rng = random.Random(seed)
+    events = []
+    posted = []  # indexes of monitored message events
+    authors = list(range(100, 160))
+    reporters = itertools.count(1000)
+    while len(events) < count:
+        roll = rng.random()
+        if roll < 0.75:
+            if rng.random() < 0.6:
+                content = rng.choice(BENIGN)
+            else:
+                content = rng.choice(RISKY)
+                if rng.random() < 0.33:
+                    content = content.replace('the', 'teh', 1) + rng.choice(['', '!', ' RT', ' please share'])
+            posted.append(len(events))
+            author = rng.choice(authors)
+            events.append({'type': 'message', 'channel': 'monitored', 'author': author, 'content': content})
+            # Some authors go back and fix their message, often more than once in quick succession
+            if rng.random() < 0.1:
+                index = len(events) - 1
+                for _ in range(rng.randint(1, 3)):
+                    content = rng.choice([content + '!', content.replace('teh', 'the'), content + ' (edit: typo)'])
+                    events.append({'type': 'edit', 'author': author, 'message': index, 'content': content})
+        elif roll < 0.9:
+            moderator = rng.choice(MODERATORS)
+            # A moderator answers every question of a case in turn, or asks for the next case
+            if rng.random() < 0.1:
+                events.append({'type': 'message', 'channel': 'mod', 'author': moderator,
+                               'content': NEXT_CASE_KEYWORD})
+            for _ in range(rng.randint(1, 4)):
+                events.append({'type': 'react', 'channel': 'mod', 'user': moderator, 'emoji': None})
+        elif posted:
+            reporter = next(reporters)
+            events.append({'type': 'dm', 'author': reporter, 'content': 'report'})
+            events.append({'type': 'dm', 'author': reporter, 'content': f'{{message:{rng.choice(posted)}}}'})
+            for step in range(5):
+                events.append({'type': 'react', 'channel': 'dm', 'user': reporter, 'emoji': None})
+                if step == 3:
+                    events.append({'type': 'dm', 'author': reporter, 'content': rng.choice(DETAILS)})
+    return events[:count]
+
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_corpus(events, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+
+# Harness
+
+class Harness:
+    def __init__(self, args, workdir, log_writer=None):
+        self.args = args
+        self.rest = Counter()
+        self.bot_user = StubUser(self, BOT_ID, f'Group {GROUP} Bot')
+        # Run as one of several shards, the guild gets an ID that Discord would route to this shard
+        guild_id = GUILD_ID if args.shard_count is None else args.shard_id << 22 | GUILD_ID
+        self.guild = StubGuild(self, guild_id)
+        # The next shard's guild, whose channels this shard only reaches over REST
+        self.remote_guild = None
+        if args.shard_count is not None and args.shard_count > 1:
+            self.remote_guild = StubGuild(self, (args.shard_id + 1) % args.shard_count << 22 | GUILD_ID)
+        self.users = {}
+        self.dm_channels = {}
+        self.channels = {channel.id: channel for channel in self.guild.text_channels}
+        self.posted = {}  # corpus index -> message posted by that event
+        self.latencies = defaultdict(list)
+        self.failures = Counter()
+
+        tokens = {'discord': '', 'perspective': 'key', 'claim_buster': 'key', 'meaningcloud': 'key'}
+        self.bot = ModBot(tokens, prescreen_path=args.prescreen, ledger_path=os.path.join(workdir, 'ledger.sqlite3'),
+                          audit_path=os.path.join(workdir, 'audit'),
+                          snapshot_path=os.path.join(workdir, 'state.json'),
+                          claims_path=os.path.join(workdir, 'claims.jsonl'),
+                          cache_path=None, metrics_port=None, metrics_path=None, shard_id=args.shard_id,
+                          shard_count=args.shard_count, shared_path=os.path.join(workdir, 'shared.sqlite3'),
+                          log_writer=log_writer)
+        self.bot._connection.user = self.bot_user
+        self.bot.get_channel = self.channels.get
+        self.bot.get_guild = lambda guild_id: self.guild if guild_id == self.guild.id else None
+        self.bot.fetch_channel = self.fetch_channel
+        self.handoffs = Counter()
+        if self.bot.shared is not None:
+            hand_off, take_handoffs = self.bot.shared.hand_off, self.bot.shared.take_handoffs
+
+            def handed_off(shard_id, payload):
+                self.handoffs['sent'] += 1
+                return hand_off(shard_id, payload)
+
+            async def taken(shard_id):
+                handoffs = await take_handoffs(shard_id)
+                self.handoffs['received'] += len(handoffs)
+                return handoffs
+
+            self.bot.shared.hand_off, self.bot.shared.take_handoffs = handed_off, taken
+        # A monitored message is done once a worker has checked it or the queue has shed it
+        ingest = self.bot.ingest
+        ingest.workers, ingest.max_size, ingest.policy = args.workers, args.queue_size, args.shed_policy
+        ingest.guild_max_size = min(ingest.guild_max_size, args.queue_size)
+        ingest.process_workers = args.process_workers
+        self.bot.edits.delay = args.edit_debounce
+        check = ingest.handler
+
+        async def checked(message):
+            try:
+                await check(message)
+            finally:
+                # A copy parked on the cluster of a message still being checked is done once it has been attached
+                if not getattr(message, 'parked', False):
+                    message.done.set()
+
+        park, resume = self.bot.park_copy, self.bot.resume_copy
+
+        def parked(message, cluster):
+            message.parked = True
+            park(message, cluster)
+
+        def resumed(message, cluster):
+            message.parked = False
+            try:
+                resume(message, cluster)
+            finally:
+                message.done.set()
+        self.bot.park_copy, self.bot.resume_copy = parked, resumed
+
+        def shed(message, reason):
+            self.failures['shed'] += 1
+            message.done.set()
+        ingest.handler, ingest.on_shed = checked, shed
+
+    async def rest_call(self, name):
+        self.rest[name] += 1
+        if self.args.discord_latency:
+            await asyncio.sleep(self.args.discord_latency)
+
+    async def fetch_channel(self, channel_id):
+        await self.rest_call('fetch_channel')
+        remote = self.remote_guild.get_channel(channel_id) if self.remote_guild is not None else None
+        channel = remote or self.channels.get(channel_id)
+        if channel is None:
+            raise not_found('Unknown Channel')
+        return channel
+
+    def message_link(self, index):
+        # Every other report is about the next shard's copy of the message, which that shard has to open the case for
+        if self.remote_guild is not None and index % 2:
+            message = self.remote_guild.monitored.messages.get(self.remote_guild.id << 24 | index)
+        else:
+            message = self.posted.get(index)
+        return message.jump_url if message is not None else 'https://discord.com/channels/1/1/1'
+
+    def user(self, user_id):
+        if user_id not in self.users:
+            self.users[user_id] = StubUser(self, user_id, f'user{user_id}')
+        return self.users[user_id]
+
+    def dm_channel(self, user):
+        if user.id not in self.dm_channels:
+            channel = StubChannel(self, f'dm-{user.id}')
+            self.dm_channels[user.id] = channel
+            self.channels[channel.id] = channel
+        return self.dm_channels[user.id]
+
+    def open_prompt(self, channel, emoji):
+        # Prompts that were answered or forgotten are dropped from the front as we go
+        while channel.prompts and channel.prompts[0] not in self.bot.reactions:
+            channel.prompts.popleft()
+        for prompt_id in channel.prompts:
+            entry = self.bot.reactions.prompts.get(prompt_id)
+            if entry is None:
+                continue
+            handlers = entry[0]
+            if emoji is None:
+                return channel.messages[prompt_id], random.choice(list(handlers))
+            if emoji in handlers:
+                return channel.messages[prompt_id], emoji
+        return None, None
+
+    async def run_event(self, index, event):
+        kind = event['type']
+        if kind == 'message':
+            channel = self.guild.monitored if event['channel'] == 'monitored' else self.guild.mod
+            # Message IDs follow from the event too, so a shard can link to another shard's copy of the message
+            message = StubMessage(self, channel, self.user(event['author']), event['content'],
+                                  message_id=self.guild.id << 24 | index)
+            channel.messages[message.id] = message
+            self.posted[index] = message
+            if self.remote_guild is not None and channel is self.guild.monitored:
+                # The next shard replays the same corpus, so it posts the same message in its own guild
+                remote = self.remote_guild.monitored
+                remote.messages[self.remote_guild.id << 24 | index] = StubMessage(
+                    self, remote, message.author, message.content, message_id=self.remote_guild.id << 24 | index)
+            message.done = asyncio.Event()
+            await self.bot.on_message(message)
+            if channel is self.guild.monitored:
+                await message.done.wait()
+            return f'{event["channel"]} message'
+        if kind == 'dm':
+            user = self.user(event['author'])
+            content = re.sub(r'\{message:(\d+)\}', lambda m: self.message_link(int(m.group(1))), event['content'])
+            channel = self.dm_channel(user)
+            await self.bot.on_message(StubMessage(self, channel, user, content))
+            return 'dm'
+        if kind == 'react':
+            channel = self.guild.mod if event['channel'] == 'mod' else self.dm_channel(self.user(event['user']))
+            prompt, emoji = self.open_prompt(channel, event.get('emoji'))
+            if prompt is None:
+                return None
+            await self.bot.on_raw_reaction_add(StubPayload(prompt, emoji, event['user']))
+            return f'{event["channel"]} reaction'
+        if kind == 'edit':
+            original = self.posted.get(event['message'])
+            if original is None:
+                return None
+            # discord.py hands over a new Message object for the edited version
+            message = StubMessage(self, original.channel, original.author, event['content'], message_id=original.id)
+            # Nothing waits for the re-check, but the worker marks it done all the same
+            message.done = asyncio.Event()
+            original.channel.messages[message.id] = message
+            await self.bot.on_raw_message_edit(StubEditPayload(message))
+            return 'edit'
+        raise ValueError(f'Unknown event type {kind!r}')
+
+    async def timed(self, index, event, previous):
+        # Wait for this person's previous event, then time this one from when it could start
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        started = time.perf_counter()
+        try:
+            kind = await self.run_event(index, event)
+        except Exception as e:
+            self.failures[type(e).__name__] += 1
+            return
+        if kind is not None:
+            self.latencies[kind].append(time.perf_counter() - started)
+
+    async def replay(self, events):
+        self.bot.channels.group_num = GROUP
+        self.bot.channels.rebuild([self.guild])
+        self.bot.ledger.start()
+        self.bot.audit.start()
+        self.bot.snapshots.start()
+        self.bot.ingest.start()
+        if self.bot.shared is not None:
+            self.bot.handoffs = asyncio.ensure_future(self.bot.receive_handoffs())
+        last_by_actor = {}
+        tasks = []
+        started = time.perf_counter()
+        for index, event in enumerate(events):
+            delay = started + index / self.args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            actor = event.get('author', event.get('user'))
+            task = asyncio.ensure_future(self.timed(index, event, last_by_actor.get(actor)))
+            last_by_actor[actor] = task
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        # Edits are only checked once they settle, so wait for those and whatever they queued
+        ingest = self.bot.ingest
+        while len(self.bot.edits) or ingest.queued > ingest.handled + ingest.shed:
+            await asyncio.sleep(0.05)
+        if self.bot.handoffs is not None:
+            # Give the other shards' last hand-offs time to arrive
+            await asyncio.sleep(2 * HANDOFF_INTERVAL)
+        await self.bot.output.close()
+        return time.perf_counter() - started
+
+    async def close(self):
+        if self.bot.handoffs is not None:
+            self.bot.handoffs.cancel()
+        await self.bot.ingest.close()
+        await self.bot.ledger.close()
+        await self.bot.audit.close()
+        await self.bot.snapshots.close()
+        self.bot.claims.close()
+        if self.bot.shared is not None:
+            self.bot.shared.close()
+        await self.bot.api_http.close()
+
+
+def summarize(harness, mock, events, elapsed):
+    all_latencies = [value for values in harness.latencies.values() for value in values]
+    monitored = len(harness.latencies.get('monitored message', []))
+    api_calls = sum(mock.calls.values())
+    summary = {
+        'events': len(events),
+        'elapsed_seconds': elapsed,
+        'throughput': len(events) / elapsed,
+        'latency_ms': {kind: {p: percentile(values, p) * 1000 for p in (50, 95, 99)}
+                       for kind, values in sorted(harness.latencies.items())},
+        'monitored_messages': monitored,
+        'api_calls': dict(mock.calls),
+        'api_errors': dict(mock.errors),
+        'api_calls_per_message': api_calls / monitored if monitored else 0.0,
+        'rest_calls': dict(harness.rest),
+        'cases_open': len(harness.bot.cases),
+        'failures': dict(harness.failures),
+        'cache': harness.bot.apis.stats(),
+        'prescreen': harness.bot.prescreen.stats(),
+        'duplicates': harness.bot.duplicates.stats(),
+        'ingest': harness.bot.ingest.stats(),
+        'edits': harness.bot.edits.stats(),
+        'audit': harness.bot.audit.stats(),
+        'snapshots': harness.bot.snapshots.stats(),
+        'claims': harness.bot.claim_apis.stats(),
+        # Where the time went inside the bot, from its own stage histograms
+        'stages_ms': {stage: {'count': h.count, 'mean': h.sum / h.count * 1000}
+                      for stage, h in sorted(harness.bot.metrics.stages.items()) if h.count},
+    }
+    if harness.bot.shared is not None:
+        summary['handoffs'] = dict(harness.handoffs)
+    if harness.bot.log_writer is not None:
+        summary['logs'] = harness.bot.log_writer.stats()
+    if all_latencies:
+        summary['latency_ms']['all'] = {p: percentile(all_latencies, p) * 1000 for p in (50, 95, 99)}
+    return summary
+
+
+def print_summary(summary):
+    print(f'{summary["events"]} events in {summary["elapsed_seconds"]:.1f} s, {summary["throughput"]:.0f} events/s')
+    for kind, values in summary['latency_ms'].items():
+        print(f'  {kind:<20} p50 {values[50]:>8.1f} ms   p95 {values[95]:>8.1f} ms   p99 {values[99]:>8.1f} ms')
+    print(f'  API calls per monitored message: {summary["api_calls_per_message"]:.2f} '
+          f'({summary["monitored_messages"]} messages, calls {summary["api_calls"]}, errors {summary["api_errors"]})')
+    print(f'  Discord REST calls: {summary["rest_calls"]}')
+    print(f'  Open cases: {summary["cases_open"]}   failures: {summary["failures"] or "none"}')
+    for name in ('cache', 'prescreen', 'duplicates', 'ingest', 'edits', 'audit', 'snapshots', 'claims', 'handoffs', 'logs'):
+        if name in summary:
+            print(f'  {name}: {summary[name]}')
+    for stage, values in summary['stages_ms'].items():
+        print(f'  stage {stage:<18} {values["count"]:>6} x   mean {values["mean"]:>8.2f} ms')
+
+
+async def run(args):
+    events = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.events, args.seed)
+    if args.save_corpus:
+        save_corpus(events, args.save_corpus)
+    random.seed(args.seed)
+    mock = MockApis(args.api_latency, args.api_jitter, args.error_rate)
+    base_url = await mock.start()
+    # Shards started together by shards.py share a directory, and with it the ledger and the shared store
+    if args.shared_dir:
+        os.makedirs(args.shared_dir, exist_ok=True)
+    workdir = contextlib.nullcontext(args.shared_dir) if args.shared_dir else tempfile.TemporaryDirectory()
+    log_writer = None
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+        log_writer = LogWriter(os.path.join(args.log_dir, 'discord.log'), os.path.join(args.log_dir, 'cases.log'),
+                               console=args.verbose).start()
+    with workdir as workdir:
+        harness = Harness(args, workdir, log_writer)
+        mock.point(harness.bot.external_apis, base_url)
+        # The bot prints as it goes; keep that out of the report unless asked for
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        try:
+            with output:
+                elapsed = await harness.replay(events)
+        finally:
+            await harness.close()
+            await mock.stop()
+            if log_writer is not None:
+                log_writer.stop()
+    return summarize(harness, mock, events, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help='JSON lines corpus to replay instead of a synthetic one')
+    parser.add_argument('--save-corpus', help='write the corpus that is replayed to this file')
+    parser.add_argument('--events', type=int, default=1000, help='size of the synthetic corpus')
+    parser.add_argument('--rate', type=float, default=50, help='events started per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-latency', type=float, default=0.05, help='mock API latency in seconds')
+    parser.add_argument('--api-jitter', type=float, default=0.02, help='mock API latency varies by up to this much')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mock API calls that fail')
+    parser.add_argument('--discord-latency', type=float, default=0.0, help='delay of every stub Discord REST call')
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help='ingest workers checking messages')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='monitored messages that can wait')
+    parser.add_argument('--shed-policy', choices=[SHED_OLDEST, SHED_NEWEST], default=SHED_POLICY,
+                        help='which message is dropped when the queue is full')
+    parser.add_argument('--process-workers', type=int, default=PROCESS_WORKERS,
+                        help='processes for the CPU-bound text work, 0 for none')
+    parser.add_argument('--edit-debounce', type=float, default=EDIT_DEBOUNCE,
+                        help='seconds an edited message has to stay unchanged before it is checked')
+    parser.add_argument('--shard-id', type=int, help='run as this shard, e.g. under shards.py')
+    parser.add_argument('--shard-count', type=int)
+    parser.add_argument('--shared-dir', help='directory for the ledger and shared store, common to all shards')
+    parser.add_argument('--prescreen', default='prescreen.json', help='pre-screening config, if it exists')
+    parser.add_argument('--log-dir', help="write the bot's discord.log and cases.log here, as bot.py does")
+    parser.add_argument('--verbose', action='store_true', help="show the bot's own output")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--max-p99', type=float, help='fail if the overall p99 latency in ms is above this')
+    parser.add_argument('--min-throughput', type=float, help='fail if fewer events per second than this')
+    args = parser.parse_args()
+    if (args.shard_id is None) != (args.shard_count is None):
+        parser.error('--shard-id and --shard-count go together')
+
+    summary = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(summary, indent=2, default=str))
+    else:
+        print_summary(summary)
+
+    failed = []
+    p99 = summary['latency_ms'].get('all', {}).get(99, 0.0)
+    if args.max_p99 is not None and p99 > args.max_p99:
+        failed.append(f'p99 latency {p99:.1f} ms is above {args.max_p99} ms')
+    if args.min_throughput is not None and summary['throughput'] < args.min_throughput:
+        failed.append(f'throughput {summary["throughput"]:.0f} events/s is below {args.min_throughput}')
+    if failed:
+        print('FAILED: ' + '; '.join(failed), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+'''
+Logging that never touches a file on the event loop. Handlers on the loop only put records on a bounded queue, and a
+background thread formats them and writes them out: discord.log for the bot and discord.py, with rotation, the console
+for INFO and above, and cases.log with one JSON object per line for everything that happens to a moderation case.
+'''
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+logger = logging.getLogger('discord')
+# Case records don't propagate to the 'discord' logger, so they only end up in the case log
+case_logger = logging.getLogger('modbot.cases')
+
+FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+# A log file is rotated once it reaches LOG_MAX_BYTES, keeping LOG_BACKUPS old ones; setting LOG_ROTATE_WHEN (e.g.
+# 'midnight', see TimedRotatingFileHandler) rotates by time instead
+LOG_MAX_BYTES = 10 * 2 ** 20
+LOG_BACKUPS = 5
+LOG_ROTATE_WHEN = None
+CONSOLE_LEVEL = logging.INFO
+# Records waiting for the writer thread; if it falls this far behind, new records are dropped rather than waited on
+LOG_QUEUE_SIZE = 10000
+# discord.py logs every gateway event it dispatches at DEBUG. Of each run of debug records with the same message
+# template from the same logger, one in DEBUG_SAMPLE_EVERY is kept
+DEBUG_SAMPLE_EVERY = 100
+# The sampler forgets its counts once it has seen this many templates, in case something logs preformatted text
+SAMPLE_KEYS = 10000
+
+
+class DebugSampler(logging.Filter):
+    '''
+    Lets through every record above DEBUG, and the first of every `every` DEBUG records per logger and template.
+    '''
+
+    def __init__(self, every=DEBUG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self.seen = {}  # (logger name, message template) -> debug records seen
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        key = (record.name, record.msg)
+        count = self.seen.get(key, 0)
+        if len(self.seen) >= SAMPLE_KEYS and count == 0:
+            self.seen.clear()
+        self.seen[key] = count + 1
+        if count % self.every:
+            self.dropped += 1
+            return False
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records to the writer thread as they are. The stock QueueHandler formats the message on the calling thread
+    first; here that is left to the writer, so the arguments of a log call must not be changed after it.
+    '''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per record: its time, the message as the event name and whatever was passed as extra fields.
+    '''
+
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def rotating_handler(path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, when=LOG_ROTATE_WHEN):
+    # Appends, so a restart no longer wipes the log of the run before it
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backups, encoding='utf-8',
+                                                         delay=True)
+    return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8',
+                                                delay=True)
+
+
+def is_case_record(record):
+    return record.name == case_logger.name
+
+
+class LogWriter:
+    '''
+    The queue, the handler that feeds it and the thread that drains it. start() attaches the handler to the bot's
+    loggers; stop() writes out whatever is still queued.
+    '''
+
+    def __init__(self, path='discord.log', case_path='cases.log', console=True, max_bytes=LOG_MAX_BYTES,
+                 backups=LOG_BACKUPS, when=LOG_ROTATE_WHEN, sample_every=DEBUG_SAMPLE_EVERY,
+                 queue_size=LOG_QUEUE_SIZE):
+        self.queue = queue.Queue(queue_size)
+        self.handler = LogQueueHandler(self.queue)
+        self.sampler = DebugSampler(sample_every)
+        self.handler.addFilter(self.sampler)
+        text = logging.Formatter(FORMAT)
+        handlers = []
+        log_file = rotating_handler(path, max_bytes, backups, when)
+        log_file.setFormatter(text)
+        log_file.addFilter(lambda record: not is_case_record(record))
+        handlers.append(log_file)
+        if console:
+            stream = logging.StreamHandler(sys.stderr)
+            stream.setLevel(CONSOLE_LEVEL)
+            stream.setFormatter(text)
+            stream.addFilter(lambda record: not is_case_record(record))
+            handlers.append(stream)
+        if case_path is not None:
+            case_file = rotating_handler(case_path, max_bytes, backups, when)
+            case_file.setFormatter(JsonFormatter())
+            case_file.addFilter(is_case_record)
+            handlers.append(case_file)
+        self.handlers = handlers
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(self.handler)
+        case_logger.setLevel(logging.INFO)
+        case_logger.propagate = False
+        case_logger.addHandler(self.handler)
+        self.listener.start()
+        return self
+
+    def stop(self):
+        logger.removeHandler(self.handler)
+        case_logger.removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+    def stats(self):
+        return {'dropped': self.handler.dropped, 'sampled_out': self.sampler.dropped, 'waiting': self.queue.qsize()}
+
+
+def case_fields(case):
+    '''
+    What identifies a case in a structured record.
+    '''
+    message = case.message
+    return {'case_id': case.id, 'guild_id': message.guild.id if message is not None else None,
+            'channel_id': message.channel.id if message is not None else None,
+            'message_id': message.id if message is not None else None, 'author_id': case.author_id,
+            'severity': round(case.severity, 3), 'rating': case.rating, 'claimed_by': case.claimed_by}
+
+
+def log_case(event, fields):
+    '''
+    Writes one structured record to the case log, e.g. log_case('closed', dict(case_fields(case), outcome='satire')).
+    '''
+    case_logger.info(event, extra={'fields': fields})
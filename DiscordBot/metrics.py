@@ -0,0 +1,275 @@
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+from aiohttp import web
+
+logger = logging.getLogger('discord')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# How often a snapshot of every metric is appended to the snapshot file
+SNAPSHOT_INTERVAL = 60
+
+
+class Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        '''
+        Context manager that observes how long its block took.
+        '''
+        return Timer(self)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket', dict(labels, le=le), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum}
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _NullMetric:
+    '''
+    Stands in for every metric when metrics are turned off, so instrumented code costs next to nothing.
+    '''
+    _timer = _NullTimer()
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return self._timer
+
+    def inc(self, amount=1):
+        pass
+
+
+_NULL = _NullMetric()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+class Metrics:
+    '''
+    In-process metrics: latency histograms, counters, and gauges read from the bot's own state when they are
+    collected. They can be scraped in the Prometheus text format over a local HTTP endpoint and are periodically
+    appended to a file as JSON lines. Recording a value is a dict lookup and an addition, and with enabled=False every
+    metric is a no-op.
+    '''
+
+    def __init__(self, enabled=True, prefix='modbot'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.families = {}  # name -> (type, help, {label values: metric})
+        self.gauges = {}  # name -> (type, help, function returning a value or {label value: value}, label name)
+        self.stages = {}
+        self.runner = None
+        self.snapshotter = None
+
+    def _metric(self, kind, factory, name, help, labels):
+        if not self.enabled:
+            return _NULL
+        name = f'{self.prefix}_{name}'
+        family = self.families.setdefault(name, (kind, help, {}))[2]
+        key = tuple(sorted((labels or {}).items()))
+        if key not in family:
+            family[key] = factory()
+        return family[key]
+
+    def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self._metric('histogram', lambda: Histogram(buckets), name, help, labels)
+
+    def counter(self, name, help, labels=None):
+        return self._metric('counter', Counter, name + '_total', help, labels)
+
+    def gauge(self, name, help, fn, label=None, kind='gauge'):
+        '''
+        A value read by calling fn when metrics are collected. With a label name, fn returns {label value: value}.
+        Totals that something else already keeps, like the cache's hit count, are registered with kind='counter'.
+        '''
+        if self.enabled:
+            name = f'{self.prefix}_{name}_total' if kind == 'counter' else f'{self.prefix}_{name}'
+            self.gauges[name] = (kind, help, fn, label)
+
+    def stage(self, stage):
+        '''
+        Latency histogram for one step of handling an event.
+        '''
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.histogram('stage_seconds', 'Time spent in each stage of handling an event',
+                                       {'stage': stage})
+            self.stages[stage] = histogram
+        return histogram
+
+    def _gauge_values(self, fn, label):
+        try:
+            value = fn()
+        except Exception:
+            logger.exception('Collecting a gauge failed')
+            return []
+        if label is None:
+            return [({}, value)]
+        return [({label: key}, item) for key, item in value.items()]
+
+    def render(self):
+        lines = []
+        for name, (kind, help, family) in sorted(self.families.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, metric in family.items():
+                for sample_name, labels, value in metric.samples(name, dict(key)):
+                    lines.append(f'{sample_name}{_format_labels(labels)} {value}')
+        for name, (kind, help, fn, label) in sorted(self.gauges.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in self._gauge_values(fn, label):
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        snapshot = {'time': time.time()}
+        for name, (kind, help, family) in self.families.items():
+            for key, metric in family.items():
+                snapshot[name + _format_labels(dict(key))] = metric.snapshot()
+        for name, (kind, help, fn, label) in self.gauges.items():
+            for labels, value in self._gauge_values(fn, label):
+                snapshot[name + _format_labels(labels)] = value
+        return snapshot
+
+    async def _serve_metrics(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Prometheus-Format': '0.0.4'})
+
+    async def serve(self, port, host='127.0.0.1'):
+        app = web.Application()
+        app.router.add_get('/metrics', self._serve_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def write_snapshots(self, path, interval=SNAPSHOT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            line = json.dumps(self.snapshot()) + '\n'
+            # Appending a line is quick, but keep the file write off the event loop all the same
+            await asyncio.get_running_loop().run_in_executor(None, self._append, path, line)
+
+    def _append(self, path, line):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+    async def start(self, port=None, snapshot_path=None, interval=SNAPSHOT_INTERVAL):
+        if not self.enabled:
+            return
+        if port is not None and self.runner is None:
+            try:
+                await self.serve(port)
+            except OSError:
+                logger.exception('Could not serve metrics on port %s', port)
+        if snapshot_path is not None and self.snapshotter is None:
+            self.snapshotter = asyncio.ensure_future(self.write_snapshots(snapshot_path, interval))
+
+    async def close(self):
+        if self.snapshotter is not None:
+            self.snapshotter.cancel()
+            self.snapshotter = None
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class MeteredApis:
+    '''
+    Innermost wrapper around ExternalApis: times every request that actually goes out and counts the ones that fail,
+    per API method.
+    '''
+
+    def __init__(self, apis, metrics):
+        self.apis = apis
+        self.metrics = metrics
+
+    async def _call(self, method, fn, arg):
+        with self.metrics.histogram('api_seconds', 'Latency of requests to external APIs', {'method': method}).time():
+            try:
+                return await fn(arg)
+            except Exception as e:
+                self.metrics.counter('api_errors', 'Failed requests to external APIs',
+                                     {'method': method, 'error': type(e).__name__}).inc()
+                raise
+
+    async def fact_check(self, input_claim):
+        return await self._call('fact_check', self.apis.fact_check, input_claim)
+
+    async def extract_title(self, input_url):
+        return await self._call('extract_title', self.apis.extract_title, input_url)
+
+    async def summarize(self, input_url):
+        return await self._call('summarize', self.apis.summarize, input_url)
+
+    async def eval_text(self, text):
+        return await self._call('eval_text', self.apis.eval_text, text)
@@ -0,0 +1,34 @@
+from functools import lru_cache
+from unidecode import unidecode
+
+# Normalized forms of this many distinct non-ASCII texts are remembered, since spam and copy-pasted claims repeat
+NORMALIZE_CACHE_SIZE = 4096
+# Longer texts are rarely repeated word for word, so they are normalized without taking up a cache slot
+MEMO_MAX_LENGTH = 512
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _transliterate(text):
+    return unidecode(text)
+
+
+def to_ascii(text):
+    '''
+    ASCII transliteration of a message for the checks that only understand ASCII. Text that is ASCII already, which
+    is most of it, is returned as the same object: str.isascii() only reads a flag CPython keeps on every string, so
+    that costs neither a scan nor a copy.
+    '''
+    if text.isascii():
+        return text
+    if len(text) > MEMO_MAX_LENGTH:
+        return unidecode(text)
+    return _transliterate(text)
+
+
+def cache_stats():
+    info = _transliterate.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+
+
+def clear_cache():
+    _transliterate.cache_clear()
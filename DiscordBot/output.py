@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import discord
+from reactions import add_reactions
+
+logger = logging.getLogger('discord')
+
+# Prompts being seeded with reactions at the same time. Each prompt's own reactions still go on one after another so
+# they show up in order; discord.py's rate limiter queues whatever the per-route bucket can't take yet
+REACTION_CONCURRENCY = 4
+# Low-priority notices for a channel are held this long and then sent together as one message
+NOTICE_DELAY = 2.0
+# Discord's limits on message and embed text
+MESSAGE_LIMIT = 2000
+TITLE_LIMIT = 256
+FIELD_LIMIT = 1024
+
+
+def truncate(text, limit):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def case_embed(title, fields):
+    '''
+    One embed holding everything about a case, given as (name, value) pairs; empty values are left out.
+    '''
+    embed = discord.Embed(title=truncate(title, TITLE_LIMIT))
+    for name, value in fields:
+        if value:
+            embed.add_field(name=name, value=truncate(value, FIELD_LIMIT), inline=False)
+    return embed
+
+
+class Output:
+    '''
+    Everything the bot posts goes through here. Prompts are seeded with their reactions in the background instead of
+    holding up the handler that posted them, and notices that nobody has to act on are collected per channel and sent
+    as one message, so each case costs as few REST calls as possible.
+    '''
+
+    def __init__(self, metrics, reaction_concurrency=REACTION_CONCURRENCY, notice_delay=NOTICE_DELAY):
+        self.metrics = metrics
+        self.seeding = asyncio.Semaphore(reaction_concurrency)
+        self.notice_delay = notice_delay
+        self.notices = {}  # channel ID -> (channel, notices waiting to be sent)
+        self.updates = {}  # message ID -> (channel, render) for embed edits waiting to be sent
+        self.tasks = set()
+        self.messages = 0
+        self.edits = 0
+        self.reactions = 0
+        self.notices_sent = 0
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def send(self, channel, content=None, embed=None):
+        # Discord rejects longer messages outright; callers that put a question at the end keep within the limit
+        if content is not None:
+            content = truncate(content, MESSAGE_LIMIT)
+        self.messages += 1
+        with self.metrics.stage('discord_send').time():
+            return await channel.send(content, embed=embed)
+
+    async def edit(self, channel, message_id, embed):
+        '''
+        Replaces the embed of a message the bot posted earlier, without fetching it first.
+        '''
+        self.edits += 1
+        with self.metrics.stage('discord_edit').time():
+            await channel.get_partial_message(message_id).edit(embed=embed)
+
+    def update(self, channel, message_id, render):
+        '''
+        Edits the embed of a message the bot posted, in the background within notice_delay; further updates to the
+        same message in the meantime go out with it as one edit. render() is called just before the edit and returns
+        the embed and a function to call once the edit has gone through, or None if there is nothing to edit any more.
+        '''
+        pending = message_id in self.updates
+        self.updates[message_id] = (channel, render)
+        if not pending:
+            self._spawn(self._update_later(message_id))
+
+    async def _update_later(self, message_id):
+        await asyncio.sleep(self.notice_delay)
+        channel, render = self.updates.pop(message_id)
+        rendered = render()
+        if rendered is None:
+            return
+        embed, edited = rendered
+        try:
+            await self.edit(channel, message_id, embed)
+        except discord.HTTPException:
+            logger.warning('Could not update message %s', message_id, exc_info=True)
+            return
+        edited()
+
+    def seed(self, message, emojis):
+        '''
+        Adds the reactions to a prompt in the background.
+        '''
+        self._spawn(self._seed(message, list(emojis)))
+
+    async def _seed(self, message, emojis):
+        async with self.seeding:
+            try:
+                with self.metrics.stage('discord_reactions').time():
+                    await add_reactions(message, emojis)
+                self.reactions += len(emojis)
+            except discord.HTTPException:
+                logger.warning('Could not add reactions to prompt %s', message.id, exc_info=True)
+
+    def notice(self, channel, text):
+        '''
+        Queues a message nobody has to respond to; it is sent within notice_delay together with any others for the
+        same channel.
+        '''
+        pending = self.notices.get(channel.id)
+        if pending is None:
+            self.notices[channel.id] = (channel, [text])
+            self._spawn(self._flush_later(channel.id))
+        else:
+            pending[1].append(text)
+
+    async def _flush_later(self, channel_id):
+        await asyncio.sleep(self.notice_delay)
+        await self.flush(channel_id)
+
+    async def flush(self, channel_id):
+        channel, texts = self.notices.pop(channel_id, (None, []))
+        chunk = ''
+        for text in texts:
+            self.notices_sent += 1
+            if chunk and len(chunk) + 1 + len(text) > MESSAGE_LIMIT:
+                await self._send_notices(channel, chunk)
+                chunk = ''
+            chunk = f'{chunk}\n{text}' if chunk else truncate(text, MESSAGE_LIMIT)
+        if chunk:
+            await self._send_notices(channel, chunk)
+
+    async def _send_notices(self, channel, text):
+        try:
+            await self.send(channel, text)
+        except discord.HTTPException:
+            logger.warning('Could not send notices to channel %s', channel.id, exc_info=True)
+
+    async def close(self):
+        for channel_id in list(self.notices):
+            await self.flush(channel_id)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self):
+        return {'messages': self.messages, 'edits': self.edits, 'reactions': self.reactions,
+                'notices': self.notices_sent}
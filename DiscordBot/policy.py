@@ -0,0 +1,231 @@
+import asyncio
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+import aiohttp
+
+# Marker used in place of a rating or score when a provider could not be reached in time
+UNSCORED = 'Unscored'
+
+# Requests per second and burst size for each provider, matched to the quota on our API keys
+CLAIM_BUSTER_RATE = (5, 10)
+MEANINGCLOUD_RATE = (2, 2)
+PERSPECTIVE_RATE = (1, 1)
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+# Consecutive failures before a provider's circuit opens, and how long it stays open before a trial call
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+# Total time one message may spend waiting on external providers, retries included
+MESSAGE_DEADLINE = 20
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class ProviderUnavailable(Exception):
+    pass
+
+
+@contextmanager
+def deadline_scope(seconds):
+    '''
+    Gives everything run inside the block, including tasks it starts, a shared budget of the given number of seconds.
+    '''
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class TokenBucket:
+    '''
+    Classic token bucket refilled at `rate` tokens per second up to `capacity`. A caller that finds the bucket empty
+    reserves the next token (the balance goes negative) and sleeps until it is due, which keeps waiters in FIFO order.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, timeout=None):
+        '''
+        Takes a token, waiting for one if necessary. Returns False without taking one if the wait would exceed timeout.
+        '''
+        self._refill()
+        wait = max(0, (1 - self.tokens) / self.rate)
+        if timeout is not None and wait > timeout:
+            return False
+        self.tokens -= 1
+        if wait:
+            await asyncio.sleep(wait)
+        return True
+
+
+class CircuitBreaker:
+    '''
+    Opens after `failure_threshold` consecutive failures so further calls fail immediately. Once `reset_timeout` has
+    passed a single trial call is let through; its outcome closes the circuit again or restarts the timer.
+    '''
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+
+def _is_retryable(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+def _retry_after(error):
+    headers = getattr(error, 'headers', None)
+    if headers and headers.get('Retry-After', '').isdigit():
+        return int(headers['Retry-After'])
+    return None
+
+
+class ProviderPolicy:
+    '''
+    Rate limiting, retries and circuit breaking for one external provider. Calls that can't finish within the current
+    deadline_scope, or are refused by the open circuit, raise ProviderUnavailable instead of piling up.
+    '''
+
+    def __init__(self, name, rate, capacity, max_retries=MAX_RETRIES):
+        self.name = name
+        self.bucket = TokenBucket(rate, capacity)
+        self.breaker = CircuitBreaker()
+        self.max_retries = max_retries
+
+    def _backoff(self, attempt):
+        # Full jitter: anywhere between zero and the exponential ceiling
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    async def _attempt(self, fn, args):
+        remaining = time_left()
+        if remaining is not None and remaining <= 0:
+            raise ProviderUnavailable(f'{self.name} deadline exceeded')
+        if not await self.bucket.acquire(remaining):
+            raise ProviderUnavailable(f'{self.name} rate limit would exceed deadline')
+        remaining = time_left()
+        if remaining is None:
+            return await fn(*args)
+        if remaining <= 0:
+            raise ProviderUnavailable(f'{self.name} deadline exceeded')
+        task = asyncio.ensure_future(fn(*args))
+        try:
+            done, _ = await asyncio.wait([task], timeout=remaining)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not done:
+            # Our own deadline ran out, not the provider's per-call timeout, so this says nothing about its health
+            task.cancel()
+            raise ProviderUnavailable(f'{self.name} deadline exceeded')
+        return task.result()
+
+    async def call(self, fn, *args):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise ProviderUnavailable(f'{self.name} circuit is open')
+            trial = self.breaker.trial_running
+            try:
+                result = await self._attempt(fn, args)
+            except Exception as e:
+                if not _is_retryable(e):
+                    # The provider answered, or was never reached, so this says nothing about its health
+                    raise
+                self.breaker.record_failure()
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                # However the attempt ended (deadline, rate limit, cancellation), the half-open trial is over, or the
+                # circuit would refuse every call from now on
+                if trial:
+                    self.breaker.trial_running = False
+            attempt += 1
+            delay = _retry_after(error) or self._backoff(attempt)
+            remaining = time_left()
+            if attempt > self.max_retries or (remaining is not None and delay >= remaining):
+                raise ProviderUnavailable(f'{self.name} failed after {attempt} attempts') from error
+            await asyncio.sleep(delay)
+
+
+class PolicyApis:
+    '''
+    Wraps ExternalApis so that every call goes through the policy of the provider behind it.
+    '''
+
+    def __init__(self, apis):
+        self.apis = apis
+        self.policies = {
+            'claim_buster': ProviderPolicy('ClaimBuster', *CLAIM_BUSTER_RATE),
+            'meaningcloud': ProviderPolicy('MeaningCloud', *MEANINGCLOUD_RATE),
+            'perspective': ProviderPolicy('Perspective', *PERSPECTIVE_RATE),
+        }
+
+    async def fact_check(self, input_claim):
+        return await self.policies['claim_buster'].call(self.apis.fact_check, input_claim)
+
+    async def extract_title(self, input_url):
+        return await self.policies['meaningcloud'].call(self.apis.extract_title, input_url)
+
+    async def summarize(self, input_url):
+        return await self.policies['meaningcloud'].call(self.apis.summarize, input_url)
+
+    async def eval_text(self, text):
+        return await self.policies['perspective'].call(self.apis.eval_text, text)
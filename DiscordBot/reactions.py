@@ -0,0 +1,59 @@
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('discord')
+
+# Upper bound on the number of prompts we remember; the oldest are forgotten first
+MAX_PROMPTS = 50000
+
+
+async def add_reactions(message, emojis):
+    for emoji in emojis:
+        await message.add_reaction(emoji)
+
+
+class ReactionDispatcher:
+    '''
+    Routes reactions to handlers registered by the prompt they were added to. Every prompt message the bot posts
+    registers a table of emoji -> handler under its message ID, so routing a reaction is a single dict lookup on the
+    raw payload, and reactions on any other message are dropped without touching the Discord API.
+    '''
+
+    def __init__(self, max_prompts=MAX_PROMPTS):
+        self.max_prompts = max_prompts
+        self.prompts = OrderedDict()  # message ID -> (emoji -> handler, once)
+
+    def register(self, message_id, handlers, once=True):
+        '''
+        Handlers are coroutine functions taking the raw reaction payload. A prompt registered with once=True is
+        forgotten as soon as one of its handlers has run, so a second reaction on it does nothing, unless the handler
+        returns False to say it didn't act on the reaction.
+        '''
+        self.prompts[message_id] = (handlers, once)
+        while len(self.prompts) > self.max_prompts:
+            self.prompts.popitem(last=False)
+
+    def forget(self, message_id):
+        self.prompts.pop(message_id, None)
+
+    def __contains__(self, message_id):
+        return message_id in self.prompts
+
+    async def dispatch(self, payload):
+        '''
+        Runs the handler for this reaction, if any. Returns whether one ran.
+        '''
+        entry = self.prompts.get(payload.message_id)
+        if entry is None:
+            return False
+        handlers, once = entry
+        handler = handlers.get(str(payload.emoji))
+        if handler is None:
+            return False
+        if once:
+            self.forget(payload.message_id)
+        if await handler(payload) is False:
+            if once:
+                self.prompts[payload.message_id] = entry
+            return False
+        return True
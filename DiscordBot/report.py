@@ -1,6 +1,44 @@
 from enum import Enum, auto
+from collections import OrderedDict
+import time
 import discord
-import re
+from links import MESSAGE_LINK_REGEX
+from output import truncate, MESSAGE_LIMIT
+from normalization import to_ascii
+
+# Reports that see no activity for this many seconds are dropped, and at most this many are kept at once
+REPORT_IDLE_TIMEOUT = 30 * 60
+MAX_REPORTS = 100000
+
+
+def regional_indicator(letter):
+    return chr(0x1F1E6 + ord(letter) - ord('a'))
+
+
+# Reasons a user can pick for their report: emoji -> (primary abuse type, prompt, [(letter, category)])
+ABUSE_TYPES = {
+    '1️⃣': ("Harassment/Bullying", "Please select the type of Harassment/Bullying:",
+           [('a', "Bullying"), ('b', "Sexual Harassment"), ('c', "Threat"), ('d', "Cyberstalking"),
+            ('e', "Hate Speech")]),
+    '2️⃣': ("False/Misleading Information", "Please select the type of False/Misleading Information:",
+           [('f', "Public Health"), ('g', "Elections"), ('h', "Politics"), ('i', "Fake News/Other")]),
+    '3️⃣': ("Violence/Graphic Imagery", "Please select the type of Violence/Graphic Imagery:",
+           [('k', "Terrorism"), ('l', "Gore"), ('m', "Self-Harm/Suicide"), ('n', "Sexually Explicit")]),
+    '4️⃣': ("Spam", "Please select the type of Spam:",
+           [('o', "Impersonation"), ('p', "Fraud/Phishing"), ('q', "Solicitation")]),
+    '5️⃣': ("Other", "Please select the closest category to Other:",
+           [('r', "Harm to Minors"), ('s', "Copyright Violation"), ('t', "Animal Cruelty"),
+            ('u', "Dangerous Organizations")]),
+}
+FALSE_INFORMATION = "False/Misleading Information"
+# Follow-up question for false information: emoji -> (option text, disinformation type)
+FALSE_INFO_TYPES = {
+    '⬅️': (":arrow_left: Purposefully falsified information for obvious political, financial, or other gains.",
+           "Purposefully falsified information for obvious political, financial, or other gains."),
+    '➡️': (":arrow_right: False information due to suspected hacking, or unintentional false information",
+           "False information due to suspected hacking, or unintentional false information\n"),
+}
+
 
 class State(Enum):
     REPORT_START = auto()
@@ -9,15 +47,30 @@ class State(Enum):
     REPORT_COMPLETE = auto()
 
 class Report:
+    '''
+    Everything we know about one user's report, from the reported message to the categories they picked.
+    '''
     START_KEYWORD = "report"
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
 
+    __slots__ = ('state', 'client', 'message', 'message_author', 'message_object', 'level_one', 'level_two',
+                 'level_three', 'more_details', 'awaiting_details', 'sent', 'last_active')
+
     def __init__(self, client):
         self.state = State.REPORT_START
         self.client = client
-        self.message = None
-    
+        self.message = ""  # content of the reported message
+        self.message_author = ""
+        self.message_object = None
+        self.level_one = ""
+        self.level_two = ""
+        self.level_three = ""
+        self.more_details = ""
+        self.awaiting_details = False  # set while we wait for the user to type out more details
+        self.sent = False
+        self.last_active = time.monotonic()
+
     async def handle_message(self, message):
         '''
         This function makes up the meat of the user-side reporting flow. It defines how we transition between states and what 
@@ -25,7 +78,9 @@ class Report:
         get you started and give you a model for working with Discord. 
         '''
 
-        if message.content == self.CANCEL_KEYWORD:
+        # Commands and links are matched on the ASCII form; anything stored for the moderators is kept as written
+        text = to_ascii(message.content)
+        if text == self.CANCEL_KEYWORD:
             self.state = State.REPORT_COMPLETE
             return ["Report cancelled."]
         
@@ -41,13 +96,17 @@ class Report:
 
         if self.state == State.AWAITING_MESSAGE:
             # Parse out the three ID strings from the message link
-            m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
+            m = MESSAGE_LINK_REGEX.search(text)
             if not m:
                 return ["I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."]
             guild = self.client.get_guild(int(m.group(1)))
-            if not guild:
+            if guild:
+                channel = guild.get_channel(int(m.group(2)))
+            elif self.client.is_remote_guild(int(m.group(1))):
+                # The guild is on another shard; its channels are only a REST call away
+                channel = await self.client.fetch_remote_channel(int(m.group(2)))
+            else:
                 return ["I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
-            channel = guild.get_channel(int(m.group(2)))
             if not channel:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
@@ -57,25 +116,28 @@ class Report:
 
             # Here we've found the message - it's up to you to decide what to do next!
             self.state = State.MESSAGE_IDENTIFIED
-            await message.author.send("I found this message:")
-            await message.author.send("```" + found_message.author.name + ": " + found_message.content + "```")
-            reply = "Please select the reason for reporting this message:"
-            await message.author.send(reply)
-
-            options = ":one: Harassment/Bullying\n"
+            self.message = found_message.content
+            self.message_author = found_message.author.name
+            self.message_object = found_message
+            options = "Please select the reason for reporting this message:\n"
+            options += ":one: Harassment/Bullying\n"
             options += ":two: False or Misleading Information\n"
             options += ":three: Violence/Graphic Imagery\n"
             options += ":four: Spam\n"
             options += ":five: Something Else\n"
-            options_msg = await message.author.send(options)
-            await options_msg.add_reaction('1️⃣')
-            await options_msg.add_reaction('2️⃣')
-            await options_msg.add_reaction('3️⃣')
-            await options_msg.add_reaction('4️⃣')
-            await options_msg.add_reaction('5️⃣')
-        
-        if self.state == State.MESSAGE_IDENTIFIED:
-            return ["ORIGINAL", found_message.content, found_message.author.name, found_message]
+            # What we found and the first question go out as one message, so a long message is quoted only in part
+            found = "I found this message:\n```{}```\n"
+            quoted = truncate(found_message.author.name + ": " + found_message.content,
+                              MESSAGE_LIMIT - len(found.format('')) - len(options))
+            await self.client.prompt(message.author, found.format(quoted) + options,
+                                     {emoji: self.client.choose_abuse_type for emoji in ABUSE_TYPES})
+            return []
+
+        if self.state == State.MESSAGE_IDENTIFIED and self.awaiting_details:
+            self.more_details = message.content
+            self.awaiting_details = False
+            await self.client.ask_block(message.channel, self.more_details)
+            return []
 
         return []
 
@@ -84,4 +146,57 @@ class Report:
     #     return ["Report Completed. To submit another report, paste a new message link."]
 
     def report_complete(self):
-        return self.state == State.REPORT_COMPLETE
\ No newline at end of file
+        return self.state == State.REPORT_COMPLETE
+
+class ReportStore:
+    '''
+    Map from user IDs to their open Report. Reports are kept in order of last activity, so looking one up, touching it
+    and evicting the idlest are all O(1).
+    '''
+
+    def __init__(self, idle_timeout=REPORT_IDLE_TIMEOUT, max_reports=MAX_REPORTS):
+        self.idle_timeout = idle_timeout
+        self.max_reports = max_reports
+        self.reports = OrderedDict()
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        report = self.get(user_id)
+        if report is None:
+            raise KeyError(user_id)
+        return report
+
+    def __setitem__(self, user_id, report):
+        report.last_active = time.monotonic()
+        self.reports[user_id] = report
+        self.reports.move_to_end(user_id)
+        self.evict_idle()
+        while len(self.reports) > self.max_reports:
+            self.reports.popitem(last=False)
+
+    def __len__(self):
+        return len(self.reports)
+
+    def get(self, user_id):
+        '''
+        Returns the user's report, or None if they have none or it has gone idle, and marks it as active.
+        '''
+        self.evict_idle()
+        report = self.reports.get(user_id)
+        if report is not None:
+            report.last_active = time.monotonic()
+            self.reports.move_to_end(user_id)
+        return report
+
+    def pop(self, user_id, default=None):
+        return self.reports.pop(user_id, default)
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self.reports:
+            user_id, report = next(iter(self.reports.items()))
+            if report.last_active > cutoff:
+                break
+            del self.reports[user_id]
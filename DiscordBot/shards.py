@@ -0,0 +1,205 @@
+'''
+Running the bot as several shard processes on one machine. Each process holds one gateway shard, and Discord sends it
+the events of the guilds that shard owns (DMs always go to shard 0). Cases, prompts and the ingest queue belong to a
+guild and so stay inside its shard. Points already live in SQLite, which every shard opens. API results and user
+reports whose guild is on another shard go through the SharedState store below.
+
+    python shards.py --shards 4                   # bot.py --shard-id N --shard-count 4, for N in 0..3
+    python shards.py --shards 4 -- python loadtest.py --shard-id {shard_id} --shard-count {shard_count} --shared-dir /tmp/shards
+
+A shard that crashes is restarted with exponential backoff; one that exits cleanly is left stopped. Ctrl-C stops
+every shard and waits for them to write out their state.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('discord')
+
+# Reports handed over from another shard are picked up this often
+HANDOFF_INTERVAL = 1.0
+# Expired API results are deleted from the shared store after this many new ones have been written
+PRUNE_EVERY = 1000
+# A crashed shard is restarted after RESTART_DELAY seconds, doubling up to MAX_RESTART_DELAY while it keeps crashing;
+# one that ran for STABLE_AFTER seconds starts over at RESTART_DELAY
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0
+# How long the launcher waits for shards to shut down cleanly before killing them
+STOP_TIMEOUT = 15.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS api_cache (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS api_cache_by_expiry ON api_cache (expires_at);
+CREATE TABLE IF NOT EXISTS handoffs (
+    id INTEGER PRIMARY KEY,
+    shard_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS handoffs_by_shard ON handoffs (shard_id, id);
+'''
+
+
+def shard_for(guild_id, shard_count):
+    '''
+    The shard Discord delivers a guild's events to.
+    '''
+    return (guild_id >> 22) % shard_count
+
+
+class SharedState:
+    '''
+    State the shard processes share, in one SQLite file in WAL mode: a second level behind each shard's in-memory API
+    caches, and a mailbox of user reports for the shard that owns the reported message's guild. Reads happen on the
+    event loop, which WAL keeps from waiting on writers; writes go through one background thread like the ledger's.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared')
+        self.reader = self._connect(check_same_thread=True)
+        self.reader.executescript(SCHEMA)
+        self.writer = self._connect(check_same_thread=False)
+        self.writes = 0
+        self.hits = 0
+
+    def _connect(self, check_same_thread):
+        connection = sqlite3.connect(self.path, check_same_thread=check_same_thread, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def cache_get(self, name, key):
+        '''
+        (expires_at, value) of a result another shard has stored, or None.
+        '''
+        row = self.reader.execute('SELECT expires_at, value FROM api_cache WHERE name = ? AND key = ? AND expires_at > ?',
+                                  (name, key, time.time())).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return row[0], json.loads(row[1])
+
+    def cache_put(self, name, key, expires_at, value):
+        self.writer_thread.submit(self._cache_put, name, key, expires_at, json.dumps(value))
+
+    def _cache_put(self, name, key, expires_at, value):
+        self.writer.execute('INSERT OR REPLACE INTO api_cache VALUES (?, ?, ?, ?)', (name, key, expires_at, value))
+        self.writes += 1
+        if self.writes % PRUNE_EVERY == 0:
+            self.writer.execute('DELETE FROM api_cache WHERE expires_at <= ?', (time.time(),))
+
+    def hand_off(self, shard_id, payload):
+        '''
+        Leaves a JSON-serializable payload for another shard to pick up with take_handoffs().
+        '''
+        self.writer_thread.submit(self._hand_off, shard_id, json.dumps(payload))
+
+    def _hand_off(self, shard_id, payload):
+        self.writer.execute('INSERT INTO handoffs (shard_id, payload, created_at) VALUES (?, ?, ?)',
+                            (shard_id, payload, time.time()))
+
+    async def take_handoffs(self, shard_id):
+        '''
+        Removes and returns everything handed off to this shard, oldest first.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.writer_thread, self._take_handoffs, shard_id)
+
+    def _take_handoffs(self, shard_id):
+        # One statement, so two processes polling for the same shard can never both take a payload
+        rows = self.writer.execute('DELETE FROM handoffs WHERE shard_id = ? RETURNING id, payload',
+                                   (shard_id,)).fetchall()
+        return [json.loads(payload) for _, payload in sorted(rows)]
+
+    def close(self):
+        self.writer_thread.submit(self.writer.close).result()
+        self.writer_thread.shutdown()
+        self.reader.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'writes': self.writes}
+
+
+class ShardLauncher:
+    '''
+    Runs one process per shard from a command template and keeps them running.
+    '''
+
+    def __init__(self, command, shard_count):
+        self.command = command
+        self.shard_count = shard_count
+        self.processes = {}  # shard ID -> running process
+        self.stopping = False
+
+    def _args(self, shard_id):
+        return [part.format(shard_id=shard_id, shard_count=self.shard_count) for part in self.command]
+
+    async def supervise(self, shard_id):
+        delay = RESTART_DELAY
+        while True:
+            started = time.monotonic()
+            # Each shard gets its own session so a Ctrl-C in the terminal reaches only the launcher, which then stops
+            # the shards one signal at a time
+            process = await asyncio.create_subprocess_exec(*self._args(shard_id), start_new_session=True)
+            self.processes[shard_id] = process
+            print(f'Shard {shard_id} started (pid {process.pid})')
+            code = await process.wait()
+            del self.processes[shard_id]
+            if self.stopping or code == 0:
+                print(f'Shard {shard_id} stopped')
+                return
+            if time.monotonic() - started >= STABLE_AFTER:
+                delay = RESTART_DELAY
+            print(f'Shard {shard_id} exited with {code}, restarting in {delay:.0f} s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+            if self.stopping:
+                return
+
+    async def stop(self):
+        self.stopping = True
+        processes = list(self.processes.values())
+        # SIGINT lets discord.py close the client, so each shard writes out its ledger and caches
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in processes)), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, lambda: asyncio.ensure_future(self.stop()))
+        await asyncio.gather(*(self.supervise(shard_id) for shard_id in range(self.shard_count)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, required=True, help='number of shard processes')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='command for each shard, with {shard_id} and {shard_count} filled in (default: bot.py)')
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        command = [sys.executable, 'bot.py', '--shard-id', '{shard_id}', '--shard-count', '{shard_count}']
+    asyncio.run(ShardLauncher(command, args.shards).run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import asyncio
+
+
+class SingleFlight:
+    '''
+    Collapses concurrent calls for the same key into one. The first caller starts the call as a task; anyone who asks
+    for the same key while it is still running waits on that task and gets the same result or exception. The task is
+    shielded so a caller being cancelled does not cancel the call for everyone else.
+    '''
+
+    def __init__(self):
+        self.in_flight = {}  # key -> running task
+        self.calls = 0  # calls that actually went out
+        self.shared = 0  # calls that were saved by joining one already in flight
+
+    async def do(self, key, fn, *args):
+        task = self.in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn(*args))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # Mark the exception as retrieved in case every waiter was cancelled before it arrived
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self.in_flight)}
@@ -0,0 +1,145 @@
+'''
+Warm restarts. The bot's in-flight state (open cases, the prompts still waiting for reactions and the reports users
+are halfway through) is written to a JSON snapshot every few seconds and read back on startup. Prompts are
+re-registered under the IDs of the messages they were posted as, so a reaction added after the restart lands where it
+would have before. Points already live in the ledger and channels are rediscovered from the guild cache, so neither
+is part of the snapshot.
+'''
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+logger = logging.getLogger('discord')
+
+# The state is captured this often and written out if it changed since the last snapshot
+SNAPSHOT_INTERVAL = 10.0
+# Bumped whenever the layout of a snapshot changes; snapshots of another version are not restored
+SNAPSHOT_VERSION = 1
+
+
+def message_ref(message):
+    '''
+    What a snapshot keeps of a discord.Message: enough to act on it again without fetching it.
+    '''
+    return {'guild_id': message.guild.id if message.guild else None, 'channel_id': message.channel.id,
+            'id': message.id, 'author_id': message.author.id, 'author_name': message.author.name,
+            'content': message.content}
+
+
+class RestoredMessage:
+    '''
+    Stands in for a discord.Message read back from a snapshot. It carries what the case and report flows look at and
+    reacts to or deletes the message through a partial message, so restoring costs no REST calls.
+    '''
+    __slots__ = ('id', 'channel', 'guild', 'author', 'content', 'partial')
+
+    def __init__(self, channel, guild, ref):
+        self.id = ref['id']
+        self.channel = channel
+        self.guild = guild
+        self.author = SimpleNamespace(id=ref['author_id'], name=ref['author_name'])
+        self.content = ref['content']
+        self.partial = channel.get_partial_message(ref['id'])
+
+    async def add_reaction(self, emoji):
+        await self.partial.add_reaction(emoji)
+
+    async def delete(self):
+        await self.partial.delete()
+
+
+def restore_message(client, ref):
+    channel = client.get_channel(ref['channel_id'])
+    if channel is None:
+        # Not in the cache, e.g. in a guild on another shard; a partial channel is all a partial message needs
+        channel = client.get_partial_messageable(ref['channel_id'], guild_id=ref['guild_id'])
+    guild = getattr(channel, 'guild', None) or client.get_guild(ref['guild_id']) or SimpleNamespace(id=ref['guild_id'])
+    return RestoredMessage(channel, guild, ref)
+
+
+class StateSnapshots:
+    '''
+    Writes what `capture` returns to `path` every `interval` seconds. The state is captured on the event loop, so it
+    is consistent, then serialized and written by a background thread: to a temporary file that is swapped in, so a
+    crash never leaves a half-written snapshot. Unchanged state is not written again. With `cache` (a CachedApis) the
+    API results are written out too, whenever there are new ones.
+    '''
+
+    def __init__(self, path, capture, cache=None, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.capture = capture
+        self.cache = cache
+        self.interval = interval
+        self.writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+        self.task = None
+        self.last = None  # the state last written, serialized
+        self.writes = 0
+        self.unchanged = 0
+
+    def load(self):
+        '''
+        The state of the last snapshot, or None if there is none or it can't be used.
+        '''
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('Could not read the snapshot %s; starting without it', self.path, exc_info=True)
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning('Snapshot %s is of version %s, not %s; starting without it', self.path,
+                           snapshot.get('version'), SNAPSHOT_VERSION)
+            return None
+        return snapshot['state']
+
+    async def save(self):
+        state = self.capture()
+        cached = self.cache.snapshot() if self.cache is not None else None
+        await asyncio.get_running_loop().run_in_executor(self.writer_thread, self._write, state, cached)
+
+    def _write(self, state, cached):
+        if cached is not None:
+            self.cache.save(cached)
+        data = json.dumps(state, ensure_ascii=False, default=str)
+        if data == self.last:
+            self.unchanged += 1
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f'{{"version": {SNAPSHOT_VERSION}, "saved_at": {time.time()}, "state": {data}}}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last = data
+        self.writes += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except Exception:
+                logger.exception('Could not write the snapshot %s', self.path)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        '''
+        Writes a last snapshot, so a clean shutdown loses nothing.
+        '''
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            await self.save()
+        self.writer_thread.shutdown()
+
+    def stats(self):
+        return {'writes': self.writes, 'unchanged': self.unchanged}
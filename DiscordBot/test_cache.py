@@ -0,0 +1,24 @@
+import pytest
+from cache import normalize_url
+from ingest import prepare_text
+from prescreen import PreScreener
+
+MALFORMED = ['http://example.com:abc/x', 'http://[oops/']
+
+
+def test_normalize_url_canonical_form():
+    assert normalize_url('HTTPS://Example.com:443/a/?utm_source=x&b=1#top') == 'https://example.com/a?b=1'
+    assert normalize_url('www.example.com:8080') == 'http://www.example.com:8080/'
+
+
+@pytest.mark.parametrize('url', MALFORMED)
+def test_normalize_url_malformed_falls_back_to_raw(url):
+    assert normalize_url(url.upper()) == url
+
+
+@pytest.mark.parametrize('url', MALFORMED)
+def test_malformed_link_does_not_skip_moderation(url):
+    content, urls, sig, timings = prepare_text(f'vaccines cause autism {url}')
+    assert urls == [url]
+    check, verdict = PreScreener().should_check(content, urls)
+    assert check
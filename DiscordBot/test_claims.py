@@ -0,0 +1,52 @@
+import pytest
+from claims import ClaimIndex, tokenize
+
+CLAIM = 'The COVID vaccine causes infertility in young women according to new study'
+
+
+@pytest.fixture
+def index():
+    index = ClaimIndex()
+    index.add(CLAIM, 'False')
+    index.add('Drinking bleach cures the coronavirus within hours says doctor', 'Pants on Fire!')
+    return index
+
+
+@pytest.mark.parametrize('text', [
+    'the covid vaccines cause infertility in young women, according to a new study',
+    'According to new study, the COVID vaccine causes infertility in young women!!',
+    'The COVID vaccine causes infertility in young women according to new study lol please share',
+])
+def test_rewording_matches(index, text):
+    match = index.match(text)
+    assert match is not None and match.claim == CLAIM and match.rating == 'False'
+
+
+@pytest.mark.parametrize('text', [
+    'The COVID vaccine prevents infertility in young women according to new study',
+    'The COVID vaccine reverses infertility in young women according to new study',
+])
+def test_swapped_verb_does_not_match(index, text):
+    assert index.match(text) is None
+
+
+@pytest.mark.parametrize('text', [
+    'The flu vaccine causes infertility in young women according to new study',
+    'The COVID vaccine causes infertility in young men according to new study',
+    'The COVID vaccine causes infertility in old women according to new study',
+])
+def test_swapped_entity_does_not_match(index, text):
+    assert index.match(text) is None
+
+
+@pytest.mark.parametrize('text', [
+    'The COVID vaccine does not cause infertility in young women according to new study',
+    'The COVID vaccine doesn’t cause infertility in young women according to new study',
+    'The COVID vaccine never causes infertility in young women according to new study',
+])
+def test_negation_does_not_match(index, text):
+    assert index.match(text) is None
+
+
+def test_negations_are_one_word():
+    assert tokenize("don't") == tokenize('do not') == tokenize('never') == ['not']
@@ -0,0 +1,106 @@
+import asyncio
+import time
+import pytest
+from policy import CircuitBreaker, ProviderPolicy, ProviderUnavailable, TokenBucket, deadline_scope
+
+
+def half_open(policy):
+    policy.breaker.failures = policy.breaker.failure_threshold
+    policy.breaker.opened_at = time.monotonic() - policy.breaker.reset_timeout
+
+
+async def answer():
+    return 'answer'
+
+
+def test_token_bucket_burst_then_refuses_past_timeout():
+    async def run():
+        bucket = TokenBucket(rate=10, capacity=2)
+        assert await bucket.acquire(0)
+        assert await bucket.acquire(0)
+        # The next token is 0.1 s away, and a refused caller must not take it
+        assert not await bucket.acquire(0.01)
+        assert bucket.tokens == pytest.approx(0, abs=0.05)
+        started = time.monotonic()
+        assert await bucket.acquire(1)
+        assert time.monotonic() - started == pytest.approx(0.1, abs=0.05)
+
+    asyncio.run(run())
+
+
+def test_circuit_breaker_opens_and_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+    breaker.opened_at -= 60
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.trial_running
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_trial_refused_by_rate_limit_does_not_wedge_circuit():
+    async def run():
+        policy = ProviderPolicy('Test', 1, 1)
+        half_open(policy)
+        policy.bucket.tokens = 0
+        with deadline_scope(0.1):
+            with pytest.raises(ProviderUnavailable, match='rate limit'):
+                await policy.call(answer)
+        assert not policy.breaker.trial_running
+        policy.bucket.tokens = 1
+        assert await policy.call(answer) == 'answer'
+        assert policy.breaker.state == 'closed'
+
+    asyncio.run(run())
+
+
+def test_trial_cancelled_while_waiting_for_a_token_is_released():
+    async def run():
+        policy = ProviderPolicy('Test', 10, 1)
+        half_open(policy)
+        policy.bucket.tokens = 0
+        call = asyncio.ensure_future(policy.call(answer))
+        await asyncio.sleep(0.01)
+        assert policy.breaker.trial_running
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        assert not policy.breaker.trial_running
+        assert policy.breaker.allow()
+
+    asyncio.run(run())
+
+
+def test_message_deadline_is_not_a_provider_failure():
+    async def slow():
+        await asyncio.sleep(1)
+
+    async def run():
+        policy = ProviderPolicy('Test', 100, 100)
+        with deadline_scope(0.05):
+            with pytest.raises(ProviderUnavailable, match='deadline'):
+                await policy.call(slow)
+        assert policy.breaker.failures == 0
+
+    asyncio.run(run())
+
+
+def test_per_call_timeout_is_a_provider_failure():
+    async def timed_out():
+        raise asyncio.TimeoutError()
+
+    async def run():
+        policy = ProviderPolicy('Test', 100, 100, max_retries=0)
+        with pytest.raises(ProviderUnavailable, match='failed after 1 attempts'):
+            await policy.call(timed_out)
+        assert policy.breaker.failures == 1
+
+    asyncio.run(run())